@@ -14,20 +14,15 @@ License: BSD (3-clause)
 # imports
 import sys
 import os
+import time
 from pathlib import Path
-import shutil
 
-from mne.utils import logger
+from concurrent.futures import ThreadPoolExecutor
 
-from config import (
-    FPATH_DATA_RAW,
-    FPATH_RAW_NOT_FOUND_MSG,
-    FNAME_RAW_VHDR_SES_1_TEMPLATE,
-    FNAME_RAW_VHDR_SES_2_TEMPLATE,
-    FNAME_SOURCEDATA_TEMPLATE,
-    FNAME_SOURCEDATA_PILOTS,
-    SUBJECT_IDS
-)
+# run the script in the pipeline worker instead, if one is running
+# (see worker.py)
+from worker import submit_to_worker
+submit_to_worker(__file__)
 
 from utils import parse_overwrite
 
@@ -36,6 +31,9 @@ from utils import parse_overwrite
 subj = 1
 session = 1
 overwrite = False
+mode = 'copy'
+all_subjects = False
+jobs = 1
 
 # %%
 # When not in an IPython session, get command line inputs
@@ -45,6 +43,9 @@ if not hasattr(sys, "ps1"):
         sub=subj,
         session=session,
         overwrite=overwrite,
+        mode=mode,
+        all_subjects=all_subjects,
+        jobs=jobs
     )
 
     defaults = parse_overwrite(defaults)
@@ -52,10 +53,34 @@ if not hasattr(sys, "ps1"):
     subj = defaults["sub"]
     session = defaults["session"]
     overwrite = defaults["overwrite"]
+    mode = defaults["mode"]
+    all_subjects = defaults["all_subjects"]
+    jobs = defaults["jobs"]
+
+# %%
+# imports of the processing modules
+# (only once the command line is parsed, so e.g. --help does not wait for
+# MNE to be imported)
+from mne.utils import logger
+
+from config import (
+    FPATH_DATA_RAW,
+    FPATH_RAW_NOT_FOUND_MSG,
+    FNAME_RAW_VHDR_SES_1_TEMPLATE,
+    FNAME_RAW_VHDR_SES_2_TEMPLATE,
+    FNAME_SOURCEDATA_TEMPLATE,
+    FNAME_SOURCEDATA_PILOTS,
+    SUBJECT_IDS
+)
+
+from utils import transfer_brainvision
+from run_batch import log_summary
+
 
 # %%
 # paths and overwrite settings
-if subj not in SUBJECT_IDS:
+# (the subject is not needed when processing all subjects)
+if not all_subjects and subj not in SUBJECT_IDS:
     raise ValueError(f"'{subj}' is not a valid subject ID.\nUse: {SUBJECT_IDS}")
 
 if not os.path.exists(FPATH_DATA_RAW):
@@ -64,66 +89,94 @@ if overwrite:
     logger.info("`overwrite` is set to ``True`` "
                 "but has been disabled in this script.")
 
+
 # %%
 # get raw data files and move them to subject (and session) specific directories
-
-# path to raw data
-if session == 1:
-    if subj == 77:
-        fname_raw = os.path.join(FPATH_DATA_RAW, 'Test0077_ML.vhdr')
-    elif subj == 99:
-        fname_raw = os.path.join(FPATH_DATA_RAW, 'Test0099.vhdr')
-    else:
-        fname_raw = FNAME_RAW_VHDR_SES_1_TEMPLATE.format(subj=subj)
-    # path to new sourcedata directory
-    # subj 77 has a weird name (account for that)
-    if subj == 77:
-        fname_sourcedata = FNAME_SOURCEDATA_PILOTS.format(
-            subj=subj,
-            session=session,
-            ext='_ML.vhdr'
-        )
-    elif subj == 99:
-        fname_sourcedata = FNAME_SOURCEDATA_PILOTS.format(
-            subj=subj,
-            session=session,
-            ext='.vhdr'
-        )
-    else:
+def get_fnames(subj, session):
+    """Get path to raw data and to new sourcedata directory."""
+    if session == 1:
+        if subj == 77:
+            fname_raw = os.path.join(FPATH_DATA_RAW, 'Test0077_ML.vhdr')
+        elif subj == 99:
+            fname_raw = os.path.join(FPATH_DATA_RAW, 'Test0099.vhdr')
+        else:
+            fname_raw = FNAME_RAW_VHDR_SES_1_TEMPLATE.format(subj=subj)
+        # path to new sourcedata directory
+        # subj 77 has a weird name (account for that)
+        if subj == 77:
+            fname_sourcedata = FNAME_SOURCEDATA_PILOTS.format(
+                subj=subj,
+                session=session,
+                ext='_ML.vhdr'
+            )
+        elif subj == 99:
+            fname_sourcedata = FNAME_SOURCEDATA_PILOTS.format(
+                subj=subj,
+                session=session,
+                ext='.vhdr'
+            )
+        else:
+            fname_sourcedata = FNAME_SOURCEDATA_TEMPLATE.format(
+                subj=subj,
+                session=session,
+                ext='.vhdr'
+            )
+    elif session == 2:
+        fname_raw = FNAME_RAW_VHDR_SES_2_TEMPLATE.format(subj=subj)
         fname_sourcedata = FNAME_SOURCEDATA_TEMPLATE.format(
             subj=subj,
             session=session,
-            ext='.vhdr'
+            ext='_2.vhdr'
         )
-elif session == 2:
-    fname_raw = FNAME_RAW_VHDR_SES_2_TEMPLATE.format(subj=subj)
-    fname_sourcedata = FNAME_SOURCEDATA_TEMPLATE.format(
-        subj=subj,
-        session=session,
-        ext='_2.vhdr'
-    )
+    else:
+        raise RuntimeError("Invalid session number provided. Session number"
+                           " must be 1 or 2.")
+
+    return fname_raw, fname_sourcedata
+
+
+def restructure(subj, session):
+    """Transfer the files of one subject to the sourcedata directory."""
+    fname_raw, fname_sourcedata = get_fnames(subj, session)
+
+    if os.path.isfile(fname_sourcedata):
+        logger.info("subject %s, session %s already in %s \n"
+                    "Skipping." % (subj, session,
+                                   Path(fname_sourcedata).parent))
+        return
+
+    if Path(fname_raw).exists():
+        # check if directory exists (if not created; no overwrite)
+        Path(fname_sourcedata).parent.mkdir(parents=True, exist_ok=True)
+
+        # the .vhdr file is written last, so a partially transferred
+        # subject is not skipped the next time
+        transfer_brainvision(fname_raw, fname_sourcedata, mode=mode)
+
+
+def restructure_subject(subject):
+    """Transfer the files of one subject (and report errors, if any)."""
+    status, error = 'ok', None
+    start = time.perf_counter()
+    try:
+        restructure(subject, session)
+    except Exception as err:  # noqa
+        # (e.g., a full disk or missing permissions for one subject)
+        status, error = 'failed', '%s: %s' % (type(err).__name__, err)
+    return dict(stage='00', subj=subject, session=session, status=status,
+                duration=time.perf_counter() - start, error=error)
+
+
+# %%
+# transfer the files (of all subjects at once, if requested)
+if all_subjects:
+    # a failure only affects the subject in question
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        results = list(pool.map(restructure_subject,
+                                sorted(int(subject)
+                                       for subject in SUBJECT_IDS)))
+    log_summary(results)
+    if any(res['status'] == 'failed' for res in results):
+        sys.exit(1)
 else:
-    raise RuntimeError("Invalid session number provided. Session number"
-                       " must be 1 or 2.")
-
-if os.path.isfile(fname_sourcedata):
-    logger.info("subject %s, session %s already in %s \n"
-                "Skipping." % (subj, session, Path(fname_sourcedata).parent))
-    sys.exit(0)
-
-# check if directory exists (if not created; no overwrite)
-Path(fname_sourcedata).parent.mkdir(parents=True, exist_ok=True)
-
-if Path(fname_raw).exists():
-    fnames_raw = [
-        fname_raw.split('.')[0] + ext
-        for ext in ['.vhdr', '.eeg', '.vmrk']
-    ]
-    fnames_sourcedata = [
-        fname_sourcedata.split('.')[0] + ext
-        for ext in ['.vhdr', '.eeg', '.vmrk']
-    ]
-
-    for raw, sourcedata in zip(fnames_raw, fnames_sourcedata):
-        print(raw, ' -> ',  sourcedata)
-        shutil.copy(raw, sourcedata)
+    restructure(subj, session)
@@ -13,28 +13,16 @@ License: BSD (3-clause)
 # imports
 import sys
 import os
-
-from pathlib import Path
+import json
+import csv
+import shutil
 
 import re
 
-from mne.io import read_raw_brainvision
-from mne.utils import logger
-from mne import Report
-
-from mne_bids import BIDSPath, write_raw_bids
-
-from config import (
-    FPATH_DATA_SOURCEDATA,
-    FPATH_DATA_BIDS,
-    FPATH_DATA_DERIVATIVES,
-    FPATH_SOURCEDATA_NOT_FOUND_MSG,
-    FNAME_SOURCEDATA_TEMPLATE,
-    FNAME_SOURCEDATA_PILOTS,
-    SUBJECT_IDS,
-    CHECK_SUBJECTS_SES_01,
-    montage
-)
+# run the script in the pipeline worker instead, if one is running
+# (see worker.py)
+from worker import submit_to_worker
+submit_to_worker(__file__)
 
 from utils import parse_overwrite
 
@@ -43,8 +31,8 @@ from utils import parse_overwrite
 subj = 1
 session = 1
 overwrite = False
-ext = '.vhdr'
 report = False
+cache = True
 
 # %%
 # When not in an IPython session, get command line inputs
@@ -54,7 +42,8 @@ if not hasattr(sys, "ps1"):
         sub=subj,
         session=session,
         overwrite=overwrite,
-        report=report
+        report=report,
+        cache=cache
     )
 
     defaults = parse_overwrite(defaults)
@@ -63,6 +52,41 @@ if not hasattr(sys, "ps1"):
     session = defaults["session"]
     overwrite = defaults["overwrite"]
     report = defaults["report"]
+    cache = defaults["cache"]
+
+# %%
+# imports of the processing modules
+# (only once the command line is parsed, so e.g. --help does not wait for
+# MNE to be imported)
+import numpy as np
+
+from mne.io import read_raw_brainvision
+from mne.utils import logger
+
+import mne_bids
+from mne_bids import BIDSPath, write_raw_bids
+
+from config import (
+    FPATH_DATA_SOURCEDATA,
+    FPATH_DATA_BIDS,
+    FPATH_SOURCEDATA_NOT_FOUND_MSG,
+    FNAME_SOURCEDATA_TEMPLATE,
+    FNAME_SOURCEDATA_PILOTS,
+    SUBJECT_IDS,
+    CHECK_SUBJECTS_SES_01,
+    montage,
+    sensors
+)
+
+from utils import file_lock
+from cache import fingerprint
+from report_utils import (
+    write_fragment,
+    fragment_fname,
+    figure_html,
+    table_html
+)
+
 
 # %%
 # paths and overwrite settings
@@ -76,83 +100,63 @@ if not os.path.exists(FPATH_DATA_SOURCEDATA):
 if overwrite:
     logger.info("`overwrite` is set to ``True`` ")
 
+# manifest of converted files, used to skip recordings that haven't changed
+FPATH_MANIFEST = FPATH_DATA_BIDS / 'code' / 'manifest'
+# recordings are converted here first and then moved into the data set
+FPATH_STAGING = FPATH_DATA_BIDS / 'code' / 'staging'
+
+
 # %%
 # path to file in question (i.e., which subject and session)
-if session == 1:
-    if subj == 77:
-        fname = FNAME_SOURCEDATA_PILOTS.format(
-            subj=subj,
-            session=session,
-            ext='_ML.vhdr'
-        )
-    elif subj == 99:
-        fname = FNAME_SOURCEDATA_PILOTS.format(
-            subj=subj,
-            session=session,
-            ext='.vhdr'
-        )
-    else:
+def get_recordings(subj, session):
+    """Get the files of a subject and session and their run numbers."""
+    ext = '.vhdr'
+    if session == 1:
+        if subj == 77:
+            fname = FNAME_SOURCEDATA_PILOTS.format(
+                subj=subj,
+                session=session,
+                ext='_ML.vhdr'
+            )
+        elif subj == 99:
+            fname = FNAME_SOURCEDATA_PILOTS.format(
+                subj=subj,
+                session=session,
+                ext='.vhdr'
+            )
+        else:
+            fname = FNAME_SOURCEDATA_TEMPLATE.format(
+                subj=subj,
+                session=session,
+                ext=ext
+            )
+        if subj in CHECK_SUBJECTS_SES_01:
+            # subject 116 does not comply with naming convention due to
+            # typo in name --> this fixes that
+            if subj == 116:
+                # remove the wrong name from string
+                fname = re.sub('_0116', '_00116', fname)
+
+    elif session == 2:
+        ext = '_2' + ext
         fname = FNAME_SOURCEDATA_TEMPLATE.format(
             subj=subj,
             session=session,
             ext=ext
         )
-    if subj in CHECK_SUBJECTS_SES_01:
-        # subject 116 does not comply with naming convention due to
-        # typo in name --> this fixes that
-        if subj == 116:
-            # remove the wrong name from string
-            fname = re.sub('_0116', '_00116', fname)
-
-elif session == 2:
-    ext = '_2' + ext
-    fname = FNAME_SOURCEDATA_TEMPLATE.format(
-        subj=subj,
-        session=session,
-        ext=ext
-    )
-else:
-    raise RuntimeError("Invalid session number provided. Session number"
-                       " must be 1 or 2.")
-
-# %%
-# 1) import the data
-raw = read_raw_brainvision(fname,
-                           eog=['32', '63', '64'],
-                           preload=False)
-# get sampling frequency
-sfreq = raw.info['sfreq']
-
-# add custom sensor positions and fiducials
-raw.set_montage(montage)
+    else:
+        raise RuntimeError("Invalid session number provided. Session number"
+                           " must be 1 or 2.")
 
-# %%
-# 2) export to bids
-
-# create bids path
-run = 1
-output_path = BIDSPath(subject=f'{subj:03}',
-                       task='vogel2004',
-                       session=str(session),
-                       run=run,
-                       datatype='eeg',
-                       root=FPATH_DATA_BIDS)
-# write file
-write_raw_bids(raw,
-               output_path,
-               montage=None,
-               overwrite=True)
+    run = 1
+    recordings = [dict(fname=fname, run=run, eog=['32', '63', '64'])]
 
-# %%
-# 3) check for subjects with more than one file.
-# Due to technical problems some sessions had to be saved in
-# two different files
-add_file = False
-if session == 1:
-    if subj in CHECK_SUBJECTS_SES_01:
-        if subj == 116:
-            sys.exit()
-        else:
+    # check for subjects with more than one file.
+    # Due to technical problems some sessions had to be saved in
+    # two different files
+    add_file = False
+    if session == 1:
+        if subj in CHECK_SUBJECTS_SES_01 and subj != 116:
             ext = '_' + CHECK_SUBJECTS_SES_01[subj].split(',')[-2].split('_')[-1]
             run = CHECK_SUBJECTS_SES_01[subj].split(',')[-1].split(' ')[-1]
             fname = FNAME_SOURCEDATA_TEMPLATE.format(
@@ -164,58 +168,185 @@ if session == 1:
                 fname = re.sub('_0119_', '_', fname)
             add_file = True
 
-elif session == 2:
-    if subj == 6:
-        ext = '_2_2.vhdr'
-        fname = FNAME_SOURCEDATA_TEMPLATE.format(
-            subj=subj,
-            session=session,
-            ext=ext
-        )
-        add_file = True
+    elif session == 2:
+        if subj == 6:
+            ext = '_2_2.vhdr'
+            fname = FNAME_SOURCEDATA_TEMPLATE.format(
+                subj=subj,
+                session=session,
+                ext=ext
+            )
+            add_file = True
+
+    if add_file:
+        recordings.append(dict(fname=fname, run=int(run),
+                               eog=['vEOG_o', 'vEOG_u']))
+
+    return recordings
+
+
+def get_bids_path(subj, session, run, root=FPATH_DATA_BIDS):
+    """Get the BIDS path of a recording."""
+    return BIDSPath(subject=f'{subj:03}',
+                    task='vogel2004',
+                    session=str(session),
+                    run=run,
+                    datatype='eeg',
+                    root=root)
+
+
+def get_fingerprint(recordings):
+    """Fingerprint of the source files (size, mtime) and parameters."""
+    sources = []
+    for recording in recordings:
+        for src_ext in ['.vhdr', '.eeg', '.vmrk']:
+            fname = os.path.splitext(recording['fname'])[0] + src_ext
+            stat = os.stat(fname)
+            sources.append((fname, stat.st_size, stat.st_mtime_ns))
+
+    return fingerprint(sources, recordings, sensors, mne_bids.__version__)
 
-if add_file:
-    # run BIDS transform for second file
-    raw = read_raw_brainvision(fname,
-                               eog=['vEOG_o', 'vEOG_u'],
+
+# %%
+def read_recording(recording):
+    """Import a recording (with the custom sensor positions)."""
+    raw = read_raw_brainvision(recording['fname'],
+                               eog=recording['eog'],
                                preload=False)
-    sfreq = raw.info['sfreq']
+
+    # add custom sensor positions and fiducials
     raw.set_montage(montage)
-    # create bids path
-    output_path = BIDSPath(subject=f'{subj:03}',
-                           task='vogel2004',
-                           session=str(session),
-                           run=int(run),
-                           datatype='eeg',
-                           root=FPATH_DATA_BIDS)
-    # write file
-    write_raw_bids(raw,
-                   output_path,
-                   overwrite=True)
+
+    return raw
+
+
+def convert(subj, session):
+    """Convert the recordings of a subject and session to BIDS."""
+    recordings = get_recordings(subj, session)
+    key = get_fingerprint(recordings)
+
+    # skip recordings that were already converted and haven't changed
+    # (unless overwrite is set)
+    fname_manifest = FPATH_MANIFEST / ('sub-%03d_ses-%s.json' % (subj,
+                                                                 session))
+    if cache and not overwrite and fname_manifest.exists():
+        with open(fname_manifest) as manifest:
+            manifest = json.load(manifest)
+        if manifest['key'] == key and all(
+                os.path.exists(fname) for fname in manifest['outputs']):
+            logger.info("subject %s, session %s has not changed since the "
+                        "last conversion. Skipping." % (subj, session))
+            # the report section may not have been requested before
+            if report and not fragment_fname(subj, '01', session).exists():
+                make_report(read_recording(recordings[-1]), subj, session,
+                            manifest['outputs'])
+            return 'skipped'
+
+    FPATH_MANIFEST.mkdir(parents=True, exist_ok=True)
+
+    # write the recordings to a BIDS root of their own, so that conversions
+    # of other subjects can run at the same time
+    staging = FPATH_STAGING / ('sub-%03d_ses-%s' % (subj, session))
+    shutil.rmtree(staging, ignore_errors=True)
+
+    outputs = []
+    for recording in recordings:
+        # 1) import the data
+        raw = read_recording(recording)
+
+        # 2) export to bids
+        write_raw_bids(raw,
+                       get_bids_path(subj, session, recording['run'],
+                                     root=staging),
+                       montage=None,
+                       overwrite=True)
+        output_path = get_bids_path(subj, session, recording['run'])
+        outputs.append(str(output_path.copy().update(extension='.vhdr')))
+
+    # 3) move them into the data set
+    # (only one process may update the dataset-level files at a time)
+    with file_lock(FPATH_MANIFEST / '.lock'):
+        publish(staging, subj, session)
+    shutil.rmtree(staging)
+
+    with open(fname_manifest, 'w') as manifest:
+        json.dump(dict(key=key, recordings=recordings, outputs=outputs),
+                  manifest, indent=2)
+
+    if report:
+        make_report(raw, subj, session, outputs)
+
+    return 'converted'
+
+
+def publish(staging, subj, session):
+    """Move a converted session from its staging root into the data set.
+
+    The session directory replaces the one in the data set, the rows of
+    ``participants.tsv`` are merged (keeping any columns added by hand) and
+    the other dataset-level files are only copied if they don't exist yet.
+    """
+    session_dir = os.path.join('sub-%03d' % subj, 'ses-%s' % session)
+    target = FPATH_DATA_BIDS / session_dir
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if target.exists():
+        old = staging / 'old'
+        os.replace(target, old)
+        os.replace(staging / session_dir, target)
+        shutil.rmtree(old)
+    else:
+        os.replace(staging / session_dir, target)
+
+    # participants.tsv
+    fname = FPATH_DATA_BIDS / 'participants.tsv'
+    rows, columns = {}, []
+    for fname_rows in [fname, staging / 'participants.tsv']:
+        if not fname_rows.exists():
+            continue
+        with open(fname_rows, newline='') as tsv:
+            reader = csv.DictReader(tsv, delimiter='\t')
+            columns += [col for col in reader.fieldnames if col not in columns]
+            for row in reader:
+                rows.setdefault(row['participant_id'], {}).update(row)
+
+    tmp = fname.with_name(fname.name + '.tmp')
+    with open(tmp, 'w', newline='') as tsv:
+        writer = csv.DictWriter(tsv, columns, restval='n/a', delimiter='\t',
+                                lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows[participant] for participant in sorted(rows))
+    os.replace(tmp, fname)
+
+    # dataset_description.json, participants.json, README
+    for fname in ['dataset_description.json', 'participants.json']:
+        if not (FPATH_DATA_BIDS / fname).exists():
+            shutil.copyfile(staging / fname, FPATH_DATA_BIDS / fname)
+    if not list(FPATH_DATA_BIDS.glob('README*')):
+        shutil.copyfile(staging / 'README', FPATH_DATA_BIDS / 'README')
+
+
+# %%
+def make_report(raw, subj, session, outputs, psd_duration=120.):
+    """Write the raw data section of the subject report.
+
+    The power spectrum is only computed from the first ``psd_duration``
+    seconds of the recording, so the data is not read as a whole.
+    """
+    tmax = min(psd_duration, raw.times[-1])
+    fig = raw.compute_psd(tmax=tmax).plot(show=False)
+    summary = table_html([
+        ('Files', ', '.join(os.path.basename(fname) for fname in outputs)),
+        ('Channels', ', '.join('%s %s' % (count, ch_type) for ch_type, count
+                               in zip(*np.unique(raw.get_channel_types(),
+                                                 return_counts=True)))),
+        ('Sampling rate', '%s Hz' % raw.info['sfreq']),
+        ('Duration', '%.1f s' % raw.times[-1]),
+        ('Annotations', len(raw.annotations))])
+
+    write_fragment(subj, '01', session, 'Raw data',
+                   summary + figure_html(fig),
+                   caption='Power spectrum of the first %.0f s' % tmax)
+
 
 # %%
-if report:
-    bidsdata_report = Report(title='Subject %s' % f'{subj:03}')
-    bidsdata_report.add_raw(raw=raw, title='Raw data',
-                            butterfly=False,
-                            # scalings=dict(eeg=100e-6, eog=100e-6),
-                            psd=True)
-
-    FPATH_REPORT = os.path.join(FPATH_DATA_DERIVATIVES,
-                                      'report',
-                                      'sub-%s' % f'{subj:03}')
-
-    if not Path(FPATH_REPORT).exists():
-        Path(FPATH_REPORT).mkdir(parents=True, exist_ok=True)
-
-    if overwrite:
-        logger.info("`overwrite` is set to ``True`` ")
-
-    for rep_ext in ['hdf5', 'html']:
-        FPATH_REPORT_O = os.path.join(
-            FPATH_REPORT,
-            'Subj_%s_preprocessing_report.%s' % (f'{subj:03}', rep_ext))
-
-        bidsdata_report.save(FPATH_REPORT_O,
-                             overwrite=overwrite,
-                             open_browser=False)
+convert(subj, session)
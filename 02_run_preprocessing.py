@@ -18,35 +18,13 @@ import warnings
 
 from pathlib import Path
 
-import numpy as np
-import matplotlib.pyplot as plt
-
-from mne import events_from_annotations
-from mne.preprocessing import compute_bridged_electrodes, ICA, corrmap
-from mne.utils import logger
-from mne import concatenate_raws, open_report
-from mne.viz import plot_bridged_electrodes
-
-from mne_bids import BIDSPath, read_raw_bids
-
-from config import (
-    FPATH_DATA_BIDS,
-    FPATH_DATA_DERIVATIVES,
-    FPATH_BIDS_NOT_FOUND_MSG,
-    FPATH_BIDSDATA_NOT_FOUND_MSG,
-    EOG_COMPONENTS_NOT_FOUND_MSG,
-    SUBJECT_IDS,
-    CHECK_SUBJECTS_SES_01,
-    BAD_SUBJECTS_SES_01,
-    BAD_SUBJECTS_SES_02,
-    eeg_markers,
-    ica_templates
-)
+# run the script in the pipeline worker instead, if one is running
+# (see worker.py)
+from worker import submit_to_worker
+submit_to_worker(__file__)
 
 from utils import parse_overwrite
 
-# from pyprep.prep_pipeline import PrepPipeline
-
 # %%
 # default settings (use subject 1, don't overwrite output files)
 subj = 1
@@ -54,6 +32,8 @@ session = 1
 overwrite = False
 report = False
 jobs = 1
+cache = True
+lazy = True
 
 # %%
 # When not in an IPython session, get command line inputs
@@ -64,7 +44,9 @@ if not hasattr(sys, "ps1"):
         session=session,
         overwrite=overwrite,
         report=report,
-        jobs=jobs
+        jobs=jobs,
+        cache=cache,
+        lazy=lazy
     )
 
     defaults = parse_overwrite(defaults)
@@ -74,6 +56,66 @@ if not hasattr(sys, "ps1"):
     overwrite = defaults["overwrite"]
     report = defaults["report"]
     jobs = defaults["jobs"]
+    cache = defaults["cache"]
+    lazy = defaults["lazy"]
+
+# %%
+# imports of the processing modules
+# (only once the command line is parsed, so e.g. --help does not wait for
+# MNE to be imported)
+import numpy as np
+
+from mne.preprocessing import compute_bridged_electrodes
+from mne.utils import logger
+from mne.viz import plot_bridged_electrodes
+
+from mne_bids import BIDSPath, read_raw_bids
+
+from config import (
+    FPATH_DATA_BIDS,
+    FPATH_DATA_DERIVATIVES,
+    FPATH_BIDS_NOT_FOUND_MSG,
+    FPATH_BIDSDATA_NOT_FOUND_MSG,
+    FNAME_ICA_PRIOR,
+    SUBJECT_IDS,
+    CHECK_SUBJECTS_SES_01,
+    BAD_SUBJECTS_SES_01,
+    BAD_SUBJECTS_SES_02,
+    EOG_TEMPLATE_LABELS,
+    EOG_TEMPLATE_THRESHOLDS,
+    EOG_ALL_COMPONENTS_SUBJECTS,
+    eeg_markers,
+    ica_templates
+)
+
+from profiling import start_profiling, step, save_profile, profile_fname
+from cache import (
+    fingerprint,
+    hash_file,
+    hash_bids_files,
+    cached_raw,
+    cached_ica
+)
+from raw_utils import find_task_blocks, extract_blocks
+from event_utils import (
+    events_fname,
+    read_markers,
+    build_event_index,
+    cached_event_index
+)
+from filter_utils import filter_raw, notch_filter_params
+from ica_utils import (
+    make_ica_training_data,
+    read_ica_prior,
+    fit_ica_with_prior,
+    find_eog_components,
+    select_bad_components,
+    save_eog_components
+)
+from report_utils import write_fragment, figure_html
+
+# from pyprep.prep_pipeline import PrepPipeline
+
 
 # %%
 # paths and overwrite settings
@@ -124,54 +166,99 @@ if not os.path.exists(bids_fname):
     warnings.warn(FPATH_BIDSDATA_NOT_FOUND_MSG.format(bids_fname))
     sys.exit()
 
-# %%
-# get the data
-raw = read_raw_bids(bids_fname)
-raw.load_data()
-
-# get sampling rate
-sfreq = raw.info['sfreq']
+# record run time and memory usage of the processing steps
+start_profiling()
 
 # %%
-# extract task relevant events
+# parameters of the preprocessing steps (together with the input files,
+# these identify the cached results of each step)
 ses = 'ses-%s' % session
 session_ids = eeg_markers[ses]
 markers = session_ids['vogel2004']['markers']
 
-# standardise event codes for import
-event_ids = {'Stimulus/S%s' % str(ev).rjust(3): ev for ev in markers.values()}
+# markers of the start and end of the task blocks, time (in seconds) to keep
+# before and after them, and number of blocks at the beginning to discard
+crop_params = dict(start_end=['task_start', 'task_end'],
+                   pad=[10., 6.],
+                   skip=1)
+# band-pass and notch filter are combined into one kernel and applied in
+# a single pass over the data (zero-phase FIR, see filter_utils.py), the
+# notch filter only to the EEG channels (as with raw.filter and
+# raw.notch_filter, the segments between boundaries are filtered separately)
+filter_picks = ['eeg', 'eog']
+notch_picks = ['eeg']
+filter_params = dict(l_freq=0.01, h_freq=80.0,
+                     filter_length='auto',
+                     l_trans_bandwidth='auto',
+                     h_trans_bandwidth='auto',
+                     fir_window='hamming',
+                     fir_design='firwin')
+notch_params = dict(freqs=[50., 100.])
+reference_params = dict(ref_channels='average', projection=True)
+
+# each key depends on the key of the previous step
+crop_key = fingerprint(hash_bids_files(bids_fname), subj, markers,
+                       crop_params)
+filter_key = fingerprint(crop_key, filter_picks, filter_params,
+                         notch_picks, notch_params)
+reference_key = fingerprint(filter_key, reference_params)
 
-# search for desired events in the data
-events, events_found = events_from_annotations(raw, event_id=event_ids)
 
 # %%
-# extract the desired section of recording (only odd-even task)
+# event markers and task blocks of the recording
+# (read from the .vmrk file once per recording and saved in the event
+# index, which is also used by 03_subject_level_erps.py)
+FPATH_EVENTS = events_fname(subj, session)
+fname_markers = bids_fname.copy().update(suffix='eeg', extension='.vmrk')
+if not os.path.exists(fname_markers):
+    fname_markers = bids_fname.copy().update(suffix='events',
+                                             extension='.tsv')
+
+
+def make_event_index():
+    """Read the event markers and find the task blocks."""
+    # (only the header of the recording is needed here)
+    raw = read_raw_bids(bids_fname)
+    events = read_markers(fname_markers, codes=markers.values())
+
+    # sample ranges of the task blocks
+    # (subject 99 (pilot) has a missing start marker at beginning of
+    # experiment, in this case the block starts with the recording)
+    starts, stops = find_task_blocks(
+        events,
+        start_code=markers[crop_params['start_end'][0]],
+        end_code=markers[crop_params['start_end'][1]],
+        n_times=raw.n_times,
+        sfreq=raw.info['sfreq'],
+        first_samp=raw.first_samp,
+        pad=crop_params['pad'],
+        skip=crop_params['skip'])
+
+    return build_event_index(events, markers, starts, stops,
+                             first_samp=raw.first_samp)
+
+
+with step('events'):
+    event_index = cached_event_index(FPATH_EVENTS, crop_key,
+                                     make_event_index, cache=cache)
 
-# set start and end markers (session 1)
-start_end = ['Stimulus/S 10', 'Stimulus/S 90']
 
-# time relevant to those events
-tmin = events[events[:, 2] == events_found[start_end[0]], 0] / sfreq - 10
-if subj == 99:
-    # subject 99 (pilot) has a missing start marker at beginning of experiment
-    tmin = np.concatenate(([0], tmin), axis=0)
-tmax = events[events[:, 2] == events_found[start_end[1]], 0] / sfreq + 6
-
-# extract data
-raw_task_bl1 = raw.copy().crop(tmin=float(tmin[1]), tmax=float(tmax[1]))
-raw_task_bl2 = raw.copy().crop(tmin=float(tmin[2]), tmax=float(tmax[2]))
-raw_task_bl3 = raw.copy().crop(tmin=float(tmin[3]), tmax=float(tmax[3]))
-raw_task_bl4 = raw.copy().crop(tmin=float(tmin[4]), tmax=float(tmax[4]))
-raw_task_bl5 = raw.copy().crop(tmin=float(tmin[5]), tmax=float(tmax[5]))
-del raw
+# %%
+# extract the desired section of recording (only odd-even task)
+def extract_task():
+    """Import the data and concatenate the task blocks."""
+    # get the data (if lazy, only the samples of the task blocks are read
+    # from the .eeg file later on)
+    with step('load'):
+        raw = read_raw_bids(bids_fname)
+        if not lazy:
+            raw.load_data()
 
-raw_task = concatenate_raws([raw_task_bl1,
-                             raw_task_bl2,
-                             raw_task_bl3,
-                             raw_task_bl4,
-                             raw_task_bl5])
+    # extract data (only the samples of the task blocks are copied)
+    with step('crop'):
+        return extract_blocks(raw, event_index['starts'],
+                              event_index['stops'])
 
-del raw_task_bl1, raw_task_bl2, raw_task_bl3, raw_task_bl4, raw_task_bl5
 
 # %%
 
@@ -229,18 +316,25 @@ del raw_task_bl1, raw_task_bl2, raw_task_bl3, raw_task_bl4, raw_task_bl5
 # # save bridges figure
 # fig.savefig(FPATH_BRIDGES, dpi=100, facecolor='white')
 
+
 # %%
-# apply filter to data
-raw_task = raw_task.filter(l_freq=0.01, h_freq=80.0,
-                           picks=['eeg', 'eog'],
-                           filter_length='auto',
-                           l_trans_bandwidth='auto',
-                           h_trans_bandwidth='auto',
-                           method='fir',
-                           phase='zero',
-                           fir_window='hamming',
-                           fir_design='firwin',
-                           n_jobs=jobs)
+# apply band-pass and notch filter (50Hz, 100Hz) to data
+def filter_task():
+    """Band-pass filter the task data and remove line noise."""
+    raw_task = cached_raw(crop_key, extract_task, cache=cache,
+                          step='crop', subj=subj, **crop_params)
+
+    with step('filter'):
+        raw_task = filter_raw(
+            raw_task, [filter_params, notch_filter_params(**notch_params)],
+            picks=notch_picks, n_jobs=jobs)
+        # (e.g., EOG channels: band-pass only)
+        band_picks = [ch for ch in filter_picks if ch not in notch_picks]
+        if band_picks:
+            raw_task = filter_raw(raw_task, [filter_params],
+                                  picks=band_picks, n_jobs=jobs)
+        return raw_task
+
 
 # # %%
 # # make a copy of the data in question
@@ -287,97 +381,135 @@ raw_task = raw_task.filter(l_freq=0.01, h_freq=80.0,
 # # interpolate any remaining bad channels
 # clean_raw.interpolate_bads()
 
+
 # add average reference
-clean_raw = raw_task.copy()
-clean_raw = clean_raw.set_eeg_reference(projection=True)
-clean_raw.apply_proj()
-del raw_task
+def reference_task():
+    """Re-reference the filtered data to the average of all EEG channels."""
+    clean_raw = cached_raw(filter_key, filter_task, cache=cache,
+                           step='filter', picks=filter_picks,
+                           notch_picks=notch_picks, notch=notch_params,
+                           **filter_params)
+    with step('reference'):
+        clean_raw = clean_raw.set_eeg_reference(**reference_params)
+        clean_raw.apply_proj()
 
-# apply notch filter (50Hz)
-line_noise = [50., 100.]
-clean_raw = clean_raw.notch_filter(freqs=line_noise, n_jobs=jobs)
+    return clean_raw
+
+
+# only the steps after the last cached step are computed
+clean_raw = cached_raw(reference_key, reference_task, cache=cache,
+                       step='reference', **reference_params)
 
 # %%
 # prepare ICA
 
 # set ICA parameters
+# (method='picard' finds the same solution as extended infomax, stops once
+# it has converged (tol) and can start from a prior (see ica_prior below),
+# but requires the python-picard package)
 method = 'infomax'
-fit_params = dict(extended=True)
+if method == 'picard':
+    fit_params = dict(ortho=False, extended=True, tol=1e-7, max_iter=500)
+else:
+    fit_params = dict(extended=True)
+# peak-to-peak thresholds of the training data per channel type
+# (reject='auto' chooses one for each EEG channel by cross-validation, see
+# reject_utils.py, but it also drops many segments with eye movements,
+# which the ICA needs to find the EOG components)
 reject = dict(eeg=250e-6)
-ica = ICA(n_components=0.951,
-          method=method,
-          fit_params=fit_params)
-
-# run ICA:
+ica_params = dict(n_components=0.951,
+                  method=method,
+                  fit_params=fit_params)
+# training data:
 # - filter data to remove drifts
 # - only use every 2nd sample
-ica.fit(clean_raw.copy().filter(l_freq=1.0, h_freq=None, n_jobs=jobs),
-        decim=2,
-        reject=reject,
-        reject_by_annotation=True)
+# - drop segments with large artefacts
+# (set max_duration to only use a fixed amount of data (in seconds))
+training_params = dict(l_freq=1.0,
+                       decim=2,
+                       reject=reject,
+                       reject_by_annotation=True,
+                       max_duration=None)
+
+# start the fit from topographies shared across subjects (only with
+# method='picard', infomax runs for the same number of iterations anyway):
+# - 'group': components found in most of the fitted ICAs
+#   (see make_ica_prior.py, starts from scratch if not available)
+# - None: start from scratch
+# (the EOG templates alone are not a good start, the other components
+# then need more iterations than from scratch)
+ica_prior = None
+if ica_prior == 'group' and not FNAME_ICA_PRIOR.exists():
+    logger.info('No ICA prior found in %s, starting from scratch.'
+                % FNAME_ICA_PRIOR)
+    ica_prior = None
+if ica_prior == 'group':
+    prior_maps, prior_ch_names = read_ica_prior(FNAME_ICA_PRIOR)
+    prior_key = hash_file(FNAME_ICA_PRIOR)
+else:
+    prior_maps, prior_ch_names, prior_key = None, None, None
+
+# the fitted ICA is re-used as long as the training data,
+# the fit parameters and the prior don't change
+ica_key = fingerprint(reference_key, ica_params, training_params,
+                      ica_prior, prior_key)
+
+FPATH_ICA = os.path.join(
+    FPATH_DATA_DERIVATIVES,
+    'preprocessing',
+    'sub-%s' % str_subj,
+    'ica',
+    'sub-%s_task-%s_ica.fif' % (str_subj, 'vogel2004'))
+FPATH_EOG_COMPONENTS = FPATH_ICA.replace('_ica.fif', '_eog-components.json')
+
+
+def fit_ica():
+    """Fit ICA on the high-pass filtered and decimated data."""
+    # only the samples used for fitting are filtered and kept in memory
+    with step('ica_data'):
+        training_raw = make_ica_training_data(clean_raw, **training_params,
+                                              n_jobs=jobs)
+
+    with step('ica_fit'):
+        ica = fit_ica_with_prior(training_raw, prior_maps, prior_ch_names,
+                                 **ica_params)
+
+    return ica
+
+
+# run ICA
+ica = cached_ica(FPATH_ICA, ica_key, fit_ica, cache=cache,
+                 **ica_params, **training_params, prior=ica_prior)
 
 # %%
 # look for components that show high correlation with the artefact templates
-try:
-    # lower the correlation threshold for subject 14
-    # (allows corrmap to select 2 components for vertical eye movements)
-    if subj == 999:
-        threshold = 0.85
-    else:
-        threshold = 'auto'
-    corrmap([ica],
-            template=np.array(ica_templates['vertical_eye']),
-            threshold=threshold, label='vertical_eog', show=False)
-    plt.close('all')
-except:
-    logger.info(
-        EOG_COMPONENTS_NOT_FOUND_MSG.format(
-            type='vertical eye movement',
-            subj=subj)
-    )
-finally:
-    logger.info("\nDone looking for vertical eye movement components\n")
-
-try:
-    # raise the correlation threshold for subject 14
-    # (makes corrmap very strict about potential horizontal eye movements
-    # components)
-    if subj == 999:
-        threshold = 0.90
-    else:
-        threshold = 'auto'
-    corrmap([ica],
-            template=np.array(ica_templates['horizontal_eye']),
-            label='horizontal_eog', show=False, threshold=threshold)
-    plt.close('all')
-except:
-    logger.info(
-        EOG_COMPONENTS_NOT_FOUND_MSG.format(
-            type='horizontal eye movement',
-            subj=subj)
-    )
-finally:
-    logger.info("\nDone looking for horizontal eye movement components\n")
+# (subject specific thresholds are defined in config.py)
+with step('corrmap'):
+    eog_components = find_eog_components(
+        [ica],
+        ica_templates,
+        labels=EOG_TEMPLATE_LABELS,
+        thresholds=[EOG_TEMPLATE_THRESHOLDS.get(subj, dict())],
+        subjects=[subj])[0]
+logger.info("\nDone looking for eye movement components\n")
 
 # %%
 # get the identified components and exclude them
-bad_components = []
-for label in ica.labels_:
-    if subj != 999:
-        # only take the first component that was identified by the template
-        bad_components.extend([ica.labels_[label][0]])
-    else:
-        # only take the first component that was identified by the template
-        bad_components.extend(ica.labels_[label])
+bad_components = select_bad_components(
+    ica.labels_, first_only=subj not in EOG_ALL_COMPONENTS_SUBJECTS)
 logger.info('\n Found bad components:\n %s' % bad_components)
 
 # add bad components to exclusion list
-ica.exclude = list(np.unique(bad_components))
+ica.exclude = bad_components
+
+# keep track of the identified components
+save_eog_components(FPATH_EOG_COMPONENTS, eog_components, bad_components)
 
 
 # %%
 # remove the identified components and save preprocessed data
-ica.apply(clean_raw)
+with step('ica_apply'):
+    ica.apply(clean_raw)
 
 # create path for preprocessed dara
 FPATH_PREPROCESSED = os.path.join(
@@ -391,43 +523,20 @@ if not Path(FPATH_PREPROCESSED).exists():
     Path(FPATH_PREPROCESSED).parent.mkdir(parents=True, exist_ok=True)
 
 # save file
-clean_raw.save(FPATH_PREPROCESSED, overwrite=overwrite)
+with step('save'):
+    clean_raw.save(FPATH_PREPROCESSED, overwrite=overwrite)
 
 # %%
-if report:
-    FPATH_REPORT = os.path.join(FPATH_DATA_DERIVATIVES,
-                                'report',
-                                'sub-%s' % f'{subj:03}')
-
-    FPATH_REPORT_I = os.path.join(
-        FPATH_REPORT,
-        'Subj_%s_preprocessing_report.hdf5' % f'{subj:03}')
-
-    bidsdata_report = open_report(FPATH_REPORT_I)
-
-    if 'ica' in bidsdata_report.tags and overwrite:
-        bidsdata_report.remove(title='ICA cleaning')
-
-    fig = ica.plot_components(show=False)
-    plt.close('all')
-
-    bidsdata_report.add_figure(
-        fig=fig,
-        tags='ica',
-        title='ICA cleaning',
-        caption='Identified EOG components: %s' % ', '.join(
-            str(x) for x in bad_components),
-        image_format='PNG'
-    )
-
-    if overwrite:
-        logger.info("`overwrite` is set to ``True`` ")
+with step('report'):
+    if report:
+        # (only the section of this stage is written)
+        write_fragment(subj, '02', session, 'ICA cleaning',
+                       figure_html(ica.plot_components(show=False)),
+                       caption='Identified EOG components: %s' % ', '.join(
+                           str(x) for x in bad_components))
 
-    for rep_ext in ['hdf5', 'html']:
-        FPATH_REPORT_O = os.path.join(
-            FPATH_REPORT,
-            'Subj_%s_preprocessing_report.%s' % (f'{subj:03}', rep_ext))
-
-        bidsdata_report.save(FPATH_REPORT_O,
-                             overwrite=overwrite,
-                             open_browser=False)
+# %%
+# save run time and memory usage of the processing steps
+save_profile(profile_fname(subj, session, '02'),
+             subject=subj, session=session, stage='02',
+             jobs=jobs, cache=cache, lazy=lazy)
@@ -18,24 +18,10 @@ import warnings
 
 from pathlib import Path
 
-import matplotlib.pyplot as plt
-
-# import numpy as np
-
-from mne.viz import plot_compare_evokeds
-from mne.utils import logger
-from mne.io import read_raw_fif
-from mne import events_from_annotations, Epochs, open_report
-
-from config import (
-    FPATH_DATA_BIDS,
-    FPATH_DATA_DERIVATIVES,
-    FPATH_BIDS_NOT_FOUND_MSG,
-    FPATH_BIDSDATA_NOT_FOUND_MSG,
-    SUBJECT_IDS,
-    BAD_SUBJECTS_SES_01,
-    BAD_SUBJECTS_SES_02
-)
+# run the script in the pipeline worker instead, if one is running
+# (see worker.py)
+from worker import submit_to_worker
+submit_to_worker(__file__)
 
 from utils import parse_overwrite
 
@@ -46,6 +32,7 @@ session = 1
 overwrite = False
 report = False
 jobs = 1
+lazy = True
 
 # %%
 # When not in an IPython session, get command line inputs
@@ -55,7 +42,9 @@ if not hasattr(sys, "ps1"):
         sub=subj,
         session=session,
         overwrite=overwrite,
-        report=report
+        report=report,
+        jobs=jobs,
+        lazy=lazy
     )
 
     defaults = parse_overwrite(defaults)
@@ -64,6 +53,45 @@ if not hasattr(sys, "ps1"):
     session = defaults["session"]
     overwrite = defaults["overwrite"]
     report = defaults["report"]
+    jobs = defaults["jobs"]
+    lazy = defaults["lazy"]
+
+# %%
+# imports of the processing modules
+# (only once the command line is parsed, so e.g. --help does not wait for
+# MNE to be imported)
+import matplotlib.pyplot as plt
+
+# import numpy as np
+
+from mne.viz import plot_compare_evokeds
+from mne.utils import logger
+from mne.io import read_raw_fif
+from mne import Epochs, write_evokeds
+
+from config import (
+    FPATH_DATA_BIDS,
+    FPATH_DATA_DERIVATIVES,
+    FPATH_BIDS_NOT_FOUND_MSG,
+    FPATH_BIDSDATA_NOT_FOUND_MSG,
+    SUBJECT_IDS,
+    BAD_SUBJECTS_SES_01,
+    BAD_SUBJECTS_SES_02
+)
+
+from profiling import start_profiling, step, save_profile, profile_fname
+from cache import fingerprint
+from filter_utils import filter_epochs, filter_evoked
+from erp_utils import grouped_averages, erp_fname
+from event_utils import events_fname, read_event_index, task_trials
+from epoch_store import epochs_fname, save_epochs
+from reject_utils import (
+    compute_reject_log,
+    drop_rejected,
+    save_reject_log,
+    read_reject_log
+)
+from report_utils import write_fragment, figure_html
 
 # %%
 # paths and overwrite settings
@@ -108,95 +136,167 @@ if not os.path.exists(FPATH_PREPROCESSED):
     warnings.warn(FPATH_BIDSDATA_NOT_FOUND_MSG.format(FPATH_PREPROCESSED))
     sys.exit()
 
-# %%
-# get the data
-raw = read_raw_fif(FPATH_PREPROCESSED)
-raw.load_data()
+# record run time and memory usage of the processing steps
+start_profiling()
 
-# add mastoid reference
-raw.set_eeg_reference(['29', '28'])
+# %%
+# get the data (if lazy, only the samples around the events of interest are
+# read from disk when creating the epochs)
+with step('load'):
+    raw = read_raw_fif(FPATH_PREPROCESSED, preload=not lazy)
 
-# only keep eeg channels
-raw.pick_types(eeg=True)
 # sampling rate
 sfreq = raw.info['sfreq']
 
 # %%
-# create a dictionary with event IDs for standardised handling
-condition_ids = {'Stimulus/S 21': 2,
-                 'Stimulus/S 41': 4,
-                 'Stimulus/S 61': 6
-                 }
-
 # event codes for segmentation
 event_ids = {'set_size_2': 2,
              'set_size_4': 4,
              'set_size_6': 6
              }
 
-# extract events
-events, ids = events_from_annotations(raw, event_id=condition_ids,
-                                      regexp=None)
+# events of the set size markers (in the preprocessed data) and description
+# of each trial (cue side, response, etc.) from the event index of the
+# recording (see event_utils.py, saved by 02_run_preprocessing.py)
+FPATH_EVENTS = events_fname(subj, session)
+if not FPATH_EVENTS.exists():
+    warnings.warn(FPATH_BIDSDATA_NOT_FOUND_MSG.format(FPATH_EVENTS))
+    sys.exit()
+
+with step('events'):
+    event_index, _ = read_event_index(FPATH_EVENTS)
+    events, metadata = task_trials(event_index)
 
 # %%
 # extract set size epochs
 tmin = -0.5
 tmax = 1.5
-set_epochs = Epochs(raw, events,
-                    event_ids,
-                    on_missing='ignore',
-                    tmin=tmin,
-                    tmax=tmax,
-                    baseline=None,
-                    preload=True,
-                    reject_by_annotation=True,
-                    reject=dict(eeg=200e-6),
-                    )
-
-# filter epochs for visualisation
-set_epochs = set_epochs.filter(l_freq=None, h_freq=40.0,
-                               picks=['eeg'],
-                               filter_length='auto',
-                               l_trans_bandwidth='auto',
-                               h_trans_bandwidth='auto',
-                               method='fir',
-                               phase='zero',
-                               fir_window='hamming',
-                               fir_design='firwin',
-                               n_jobs=jobs)
+# (only keep eeg channels)
+epochs_params = dict(picks='eeg',
+                     tmin=tmin,
+                     tmax=tmax,
+                     baseline=None,
+                     reject_by_annotation=True)
+# mastoid reference
+ref_channels = ['29', '28']
+with step('epoching'):
+    set_epochs = Epochs(raw, events,
+                        event_ids,
+                        on_missing='ignore',
+                        preload=True,
+                        **epochs_params)
+
+    # add mastoid reference
+    set_epochs.set_eeg_reference(ref_channels)
+
+# reject epochs based on the peak-to-peak amplitudes of the re-referenced
+# data: a number (in volts) is used for all channels, 'auto' chooses a
+# threshold for each channel by cross-validation instead, which changes
+# the epochs kept for each subject (see reject_utils.py)
+reject = 200e-6
+# (only used with reject='auto')
+reject_params = dict(n_thresholds=30, z_range=(2., 12.), n_folds=5,
+                     seed=0)
+
+# the rejection log is re-used as long as the data, the epochs and the
+# parameters don't change (the files are identified by their size and
+# modification time, so they are not read to compute the key)
+FPATH_REJECT_LOG = epochs_fname(subj, session, 'reject-log', '.npz')
+with step('reject'):
+    reject_key = fingerprint(
+        [(os.path.basename(fname), os.stat(fname).st_size,
+          os.stat(fname).st_mtime_ns)
+         for fname in (FPATH_PREPROCESSED, FPATH_EVENTS)],
+        event_ids, epochs_params, ref_channels, reject, reject_params)
+    reject_log = None
+    if FPATH_REJECT_LOG.exists() and not overwrite:
+        reject_log, log_key = read_reject_log(FPATH_REJECT_LOG)
+        if log_key != reject_key:
+            reject_log = None
+    if reject_log is None:
+        # (the data of the epochs is used without copying it)
+        reject_log = compute_reject_log(set_epochs.get_data(copy=False),
+                                        set_epochs.ch_names, reject=reject,
+                                        n_jobs=jobs, **reject_params)
+        save_reject_log(FPATH_REJECT_LOG, reject_log, key=reject_key)
+    else:
+        logger.info('Re-using rejection log: %s' % FPATH_REJECT_LOG)
+    drop_rejected(set_epochs, reject_log)
+
+# save the accepted epochs (unfiltered) for model training
+# (see epoch_store.py)
+with step('store'):
+    save_epochs(set_epochs, metadata, subj, session)
+
+# low-pass filter for visualisation
+lowpass = dict(l_freq=None, h_freq=40.0,
+               filter_length='auto',
+               l_trans_bandwidth='auto',
+               h_trans_bandwidth='auto',
+               fir_window='hamming',
+               fir_design='firwin')
+# the filter is linear, so it can be applied to the averages instead of
+# each epoch (same result, set to False to filter the epochs)
+filter_evokeds = True
+
+if not filter_evokeds:
+    with step('filter'):
+        set_epochs = filter_epochs(set_epochs, [lowpass], picks=['eeg'],
+                                   n_jobs=jobs)
 
 # %%
 # make set size erps
-set_2 = set_epochs['set_size_2'].copy().apply_baseline((-0.20, 0.00)).average()
-set_4 = set_epochs['set_size_4'].copy().apply_baseline((-0.20, 0.00)).average()
-set_6 = set_epochs['set_size_6'].copy().apply_baseline((-0.20, 0.00)).average()
+# (all conditions are averaged in one pass over the epochs, the baseline
+# is applied after filtering)
+baseline = (-0.20, 0.00)
+with step('averaging'):
+    evokeds = grouped_averages(set_epochs,
+                               ['set_size_2', 'set_size_4', 'set_size_6'])
+
+if filter_evokeds:
+    with step('filter'):
+        for evoked in evokeds.values():
+            filter_evoked(evoked, [lowpass], picks=['eeg'], n_jobs=jobs)
+
+for evoked in evokeds.values():
+    evoked.apply_baseline(baseline)
+set_2 = evokeds['set_size_2']
+set_4 = evokeds['set_size_4']
+set_6 = evokeds['set_size_6']
+
+# save the erps (used by 04_group_level_erps.py)
+with step('save'):
+    FPATH_ERPS = erp_fname(subj, session)
+    FPATH_ERPS.parent.mkdir(parents=True, exist_ok=True)
+    write_evokeds(FPATH_ERPS, list(evokeds.values()), overwrite=True)
 
 # channels to plot
 channels_right = ['39', '40', '46']
 channels_left = ['15', '16', '24']
 
 # make ERP figure
-plt.rcParams.update({'font.size': 14})
-fig_erp, ax = plt.subplots(2, 1, figsize=(15, 15))
-for n_roi, channels in enumerate([channels_right, channels_left]):
-    if int(channels[0]) < 32:
-        roi = 'Left'
-    else:
-        roi = 'Right'
-
-    plot_compare_evokeds({'Set size 2': set_2,
-                          'Set size 4': set_4,
-                          'Set size 6': set_6, },
-                         picks=channels,
-                         combine='mean',
-                         ylim=dict(eeg=[-10, 10]),
-                         invert_y=True,
-                         title='% s channels: %s' % (roi, ', '.join(
-                             str(ch) for ch in channels)),
-                         axes=ax[n_roi],
-                         show=False)
-fig_erp.subplots_adjust(hspace=0.5)
-plt.close('all')
+with step('plot'):
+    plt.rcParams.update({'font.size': 14})
+    fig_erp, ax = plt.subplots(2, 1, figsize=(15, 15))
+    for n_roi, channels in enumerate([channels_right, channels_left]):
+        if int(channels[0]) < 32:
+            roi = 'Left'
+        else:
+            roi = 'Right'
+
+        plot_compare_evokeds({'Set size 2': set_2,
+                              'Set size 4': set_4,
+                              'Set size 6': set_6, },
+                             picks=channels,
+                             combine='mean',
+                             ylim=dict(eeg=[-10, 10]),
+                             invert_y=True,
+                             title='% s channels: %s' % (roi, ', '.join(
+                                 str(ch) for ch in channels)),
+                             axes=ax[n_roi],
+                             show=False)
+    fig_erp.subplots_adjust(hspace=0.5)
+    plt.close('all')
 
 # # make topomap figure
 # plt.rcParams.update({'font.size': 14})
@@ -207,36 +307,17 @@ plt.close('all')
 #                           colorbar=False)
 
 # %%
-if report:
-    FPATH_REPORT = os.path.join(FPATH_DATA_DERIVATIVES,
-                                'report',
-                                'sub-%s' % f'{subj:03}')
-
-    FPATH_REPORT_I = os.path.join(
-        FPATH_REPORT,
-        'Subj_%s_preprocessing_report.hdf5' % f'{subj:03}')
-
-    bidsdata_report = open_report(FPATH_REPORT_I)
-
-    if 'epochs' in bidsdata_report.tags and overwrite:
-        bidsdata_report.remove(title='Set size ERPs')
-
-    bidsdata_report.add_figure(
-        fig=fig_erp,
-        tags='epochs',
-        title='Set size ERPs',
-        section='epochs',
-        image_format='PNG'
-    )
+with step('report'):
+    if report:
+        # (only the section of this stage is written)
+        write_fragment(subj, '03', session, 'Set size ERPs',
+                       figure_html(fig_erp),
+                       caption='%s epochs (set size 2: %s, 4: %s, 6: %s)'
+                       % (len(set_epochs), set_2.nave, set_4.nave,
+                          set_6.nave))
 
-    if overwrite:
-        logger.info("`overwrite` is set to ``True`` ")
-
-    for rep_ext in ['hdf5', 'html']:
-        FPATH_REPORT_O = os.path.join(
-            FPATH_REPORT,
-            'Subj_%s_preprocessing_report.%s' % (f'{subj:03}', rep_ext))
-
-        bidsdata_report.save(FPATH_REPORT_O,
-                             overwrite=overwrite,
-                             open_browser=False)
+# %%
+# save run time and memory usage of the processing steps
+save_profile(profile_fname(subj, session, '03'),
+             subject=subj, session=session, stage='03', jobs=jobs,
+             lazy=lazy)
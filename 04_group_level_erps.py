@@ -0,0 +1,165 @@
+"""
+========================
+Group-level ERP analysis
+========================
+
+Computes grand averages of the set size ERPs (see
+``03_subject_level_erps.py``) and their confidence intervals across
+subjects. The ERPs of each subject are read only once: the running mean
+and variance (Welford's algorithm) are kept in
+``derivatives/group/ses-X/running_stats.npz``, so memory use does not
+depend on the number of subjects and re-running the script after adding
+new subjects only reads the ERPs of the new subjects. If the ERPs of a
+subject that was added before changed, the statistics are computed again
+from all subjects.
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+# %%
+# imports
+import sys
+
+from utils import parse_overwrite
+
+# %%
+# default settings (use session 1, keep the subjects added before)
+session = 1
+overwrite = False
+
+# confidence level of the confidence intervals
+confidence = 0.95
+
+# %%
+# When not in an IPython session, get command line inputs
+# https://docs.python.org/3/library/sys.html#sys.ps1
+if not hasattr(sys, "ps1"):
+    defaults = dict(
+        session=session,
+        overwrite=overwrite
+    )
+
+    defaults = parse_overwrite(defaults)
+
+    session = defaults["session"]
+    overwrite = defaults["overwrite"]
+
+# %%
+# imports of the processing modules
+# (only once the command line is parsed, so e.g. --help does not wait for
+# MNE to be imported)
+from mne import EvokedArray, read_evokeds, write_evokeds
+from mne.io import read_info, write_info
+from mne.utils import logger
+
+from config import FPATH_DATA_GROUP
+
+from cache import hash_file
+from run_batch import get_subjects
+from erp_utils import (
+    erp_fname,
+    init_running_stats,
+    update_running_stats,
+    running_stats_summary,
+    save_running_stats,
+    read_running_stats
+)
+
+# %%
+# paths
+FPATH_GROUP = FPATH_DATA_GROUP / ('ses-%s' % session)
+FPATH_RUNNING_STATS = FPATH_GROUP / 'running_stats.npz'
+# measurement info of the ERPs (channels, sampling rate, etc.)
+FPATH_INFO = FPATH_GROUP / 'erp-info.fif'
+FPATH_GRAND_AVERAGE = FPATH_GROUP / (
+    'sub-group_ses-%s_task-vogel2004_grand-ave.fif' % session)
+FPATH_CONFIDENCE = FPATH_GROUP / (
+    'sub-group_ses-%s_task-vogel2004_ci-ave.fif' % session)
+
+# start from scratch if overwrite is True
+running_stats = None
+if FPATH_RUNNING_STATS.exists() and not overwrite:
+    running_stats = read_running_stats(FPATH_RUNNING_STATS)
+    logger.info('Resuming from %s subjects.'
+                % len(running_stats['subjects']))
+
+# %%
+# find the subjects that have not been added yet
+found, new_subjects = dict(), []
+for subj in get_subjects(session):
+    fname = erp_fname(subj, session)
+    if not fname.exists():
+        continue
+
+    found[str(subj)] = (subj, fname, hash_file(fname))
+    added = running_stats['subjects'].get(str(subj)) \
+        if running_stats is not None else None
+    if added is None:
+        new_subjects.append(found[str(subj)])
+
+# the contribution of a subject can't be removed from the running
+# statistics, so they are computed again if the ERPs of a subject changed
+# (or were removed) since it was added
+if running_stats is not None:
+    changed_subjects = [subj for subj, key
+                        in running_stats['subjects'].items()
+                        if subj not in found or found[subj][2] != key]
+    if changed_subjects:
+        logger.info('The ERPs of subject(s) %s changed since they were '
+                    'added, computing the group statistics again.'
+                    % ', '.join(changed_subjects))
+        running_stats = None
+        new_subjects = list(found.values())
+
+# %%
+# add the ERPs of the new subjects (one at a time)
+for subj, fname, key in new_subjects:
+    evokeds = read_evokeds(fname, verbose=False)
+    if running_stats is None:
+        running_stats = init_running_stats([evoked.comment
+                                            for evoked in evokeds],
+                                           evokeds[0].ch_names,
+                                           evokeds[0].times)
+        FPATH_GROUP.mkdir(parents=True, exist_ok=True)
+        FPATH_INFO.unlink(missing_ok=True)
+        write_info(FPATH_INFO, evokeds[0].info)
+
+    update_running_stats(running_stats, evokeds, subj, key=key)
+    save_running_stats(FPATH_RUNNING_STATS, running_stats)
+    del evokeds
+
+if running_stats is None:
+    logger.info('No subject-level ERPs found, run '
+                '03_subject_level_erps.py first.')
+    sys.exit()
+
+logger.info('Added %s new subject(s), %s subjects in total.'
+            % (len(new_subjects), len(running_stats['subjects'])))
+
+# %%
+# grand averages and confidence intervals
+mean, lower, upper = running_stats_summary(running_stats,
+                                           confidence=confidence)
+info = read_info(FPATH_INFO, verbose=False)
+
+
+def make_evoked(data, comment, nave):
+    """Evoked response with the channels and times of the ERPs."""
+    return EvokedArray(data, info.copy(), tmin=running_stats['tmin'],
+                       comment=comment, nave=max(nave, 1), verbose=False)
+
+
+grand_averages, confidence_bands = [], []
+for n_cond, cond in enumerate(running_stats['conditions']):
+    nave = int(running_stats['count'][n_cond].min())
+    logger.info('%s: %s subjects' % (cond, nave))
+
+    grand_averages.append(make_evoked(mean[n_cond], cond, nave))
+    confidence_bands.extend([
+        make_evoked(lower[n_cond], '%s/lower' % cond, nave),
+        make_evoked(upper[n_cond], '%s/upper' % cond, nave)])
+
+write_evokeds(FPATH_GRAND_AVERAGE, grand_averages, overwrite=True)
+write_evokeds(FPATH_CONFIDENCE, confidence_bands, overwrite=True)
+logger.info('\nGrand averages saved to %s\n' % FPATH_GROUP)
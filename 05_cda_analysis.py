@@ -0,0 +1,158 @@
+"""
+==================================
+Contralateral delay activity (CDA)
+==================================
+
+Computes the CDA (contralateral minus ipsilateral activity, relative to the
+cued hemifield) of every stored trial (see ``epoch_store.py``) and channel
+pair, and the retention-window amplitudes of each trial, subject and set
+size. The lateralised activity of all channel pairs is kept in
+``derivatives/cda/ses-X/cda.npz``, so changing the channels of interest
+(``roi``) does not require reading the epochs again. The average waveforms
+of each subject and set size are only computed again if the epochs, the
+baseline or the set sizes changed, and the amplitudes of other retention
+windows are derived from them. The amplitudes of each trial, however, are
+computed while the epochs are read, so with ``trial_amplitudes = True``
+changing the window reads the epochs again (set it to False to compare
+windows quickly).
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+# %%
+# imports
+import sys
+import csv
+
+from utils import parse_overwrite
+
+# %%
+# default settings (use session 1, re-use the lateralised activity)
+session = 1
+overwrite = False
+
+# posterior channels of the left hemisphere (each is paired with the
+# mirror-symmetric channel of the right hemisphere)
+roi = ['15', '16', '24']
+# retention window and baseline (in s, relative to the set size marker)
+window = (0.3, 0.9)
+baseline = (-0.2, 0.0)
+set_sizes = (2, 4, 6)
+# write the retention-window amplitude of each trial?
+trial_amplitudes = True
+
+# %%
+# When not in an IPython session, get command line inputs
+# https://docs.python.org/3/library/sys.html#sys.ps1
+if not hasattr(sys, "ps1"):
+    defaults = dict(
+        session=session,
+        overwrite=overwrite
+    )
+
+    defaults = parse_overwrite(defaults)
+
+    session = defaults["session"]
+    overwrite = defaults["overwrite"]
+
+# %%
+# imports of the processing modules
+# (only once the command line is parsed, so e.g. --help does not wait for
+# MNE to be imported)
+import numpy as np
+
+from mne.utils import logger
+
+from config import FPATH_DATA_CDA
+
+from cache import fingerprint, hash_file
+from run_batch import get_subjects
+from epoch_store import read_epoch_store, epochs_fname
+from cda_utils import (
+    cda_batch,
+    roi_average,
+    window_average,
+    save_cda,
+    read_cda
+)
+
+# %%
+# paths
+FPATH_CDA = FPATH_DATA_CDA / ('ses-%s' % session)
+FPATH_PAIRS = FPATH_CDA / 'cda.npz'
+FPATH_TRIALS = FPATH_CDA / (
+    'sub-group_ses-%s_task-vogel2004_cda-trials.tsv' % session)
+FPATH_SUBJECTS = FPATH_CDA / (
+    'sub-group_ses-%s_task-vogel2004_cda.tsv' % session)
+
+# %%
+# open the stored epochs of all subjects (memory-mapped)
+subjects = [subj for subj in get_subjects(session)
+            if epochs_fname(subj, session).exists()]
+if not subjects:
+    logger.info('No stored epochs found, run 03_subject_level_erps.py '
+                'first.')
+    sys.exit()
+store = read_epoch_store(subjects, session)
+
+# the average lateralised activity of all pairs only changes with the
+# epochs, the baseline and the set sizes
+key = fingerprint(baseline, set_sizes,
+                  [(subj,
+                    hash_file(epochs_fname(subj, session)),
+                    hash_file(epochs_fname(subj, session, 'metadata',
+                                           '.tsv')))
+                   for subj in subjects])
+
+cda = None
+if FPATH_PAIRS.exists() and not overwrite:
+    cda, cda_key = read_cda(FPATH_PAIRS)
+    if cda_key != key:
+        cda = None
+    # (the amplitudes of each trial were computed for another window)
+    elif trial_amplitudes and not np.array_equal(cda['window'], window):
+        logger.info('The retention window changed, computing the '
+                    'amplitudes of each trial again.')
+        cda = None
+
+if cda is None:
+    logger.info('Computing the CDA of %s trials (%s subjects).'
+                % (len(store['metadata']['epoch']), len(subjects)))
+    cda = cda_batch(store, window=window, baseline=baseline,
+                    set_sizes=set_sizes)
+    save_cda(FPATH_PAIRS, cda, key=key)
+
+# %%
+# average over the channel pairs of interest
+amplitudes, waveforms = roi_average(cda, roi)
+subject_amplitudes = window_average(waveforms, cda['times'], window)
+
+if trial_amplitudes:
+    metadata = store['metadata']
+    rows = cda['rows']
+    with open(FPATH_TRIALS, 'w', newline='') as file:
+        writer = csv.writer(file, delimiter='\t')
+        writer.writerow(['subject', 'trial', 'set_size', 'cue_side', 'cda'])
+        writer.writerows(zip(metadata['subject'][rows],
+                             metadata['trial'][rows],
+                             metadata['set_size'][rows],
+                             metadata['cue_side'][rows],
+                             np.round(amplitudes * 1e6, 4)))
+
+with open(FPATH_SUBJECTS, 'w', newline='') as file:
+    writer = csv.writer(file, delimiter='\t')
+    writer.writerow(['subject', 'set_size', 'n_trials', 'cda'])
+    for n_subj, subj in enumerate(cda['subjects']):
+        for n_size, set_size in enumerate(cda['set_sizes']):
+            writer.writerow([subj, set_size,
+                             cda['counts'][n_subj, n_size],
+                             np.round(subject_amplitudes[n_subj, n_size]
+                                      * 1e6, 4)])
+
+for n_size, set_size in enumerate(cda['set_sizes']):
+    logger.info('Set size %s: %.2f µV (mean of %s subjects)'
+                % (set_size,
+                   np.nanmean(subject_amplitudes[:, n_size]) * 1e6,
+                   np.sum(cda['counts'][:, n_size] > 0)))
+logger.info('\nCDA saved to %s\n' % FPATH_CDA)
@@ -0,0 +1,139 @@
+"""Mini-batches of stored epochs for model training.
+
+Batches are assembled from the memory-mapped epochs of the epoch store
+(see ``epoch_store.py``). The next batches are read in background threads
+while the current batch is used, into a fixed set of batch arrays that are
+re-used for the whole epoch of training (no allocation per batch).
+"""
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from mne.utils import logger
+
+from epoch_store import get_epochs
+
+
+def batch_rows(metadata, batch_size=64, rows=None, shuffle=True,
+               stratify=None, drop_last=False, seed=None):
+    """Split the rows of the metadata into mini-batches.
+
+    Parameters
+    ----------
+    metadata : dict of np.ndarray
+        The metadata of the epoch store (see ``read_epoch_store``).
+    batch_size : int
+        Number of epochs per batch.
+    rows : np.ndarray of int | None
+        Rows to use. If None, all rows.
+    shuffle : bool
+        Whether to shuffle the rows.
+    stratify : str | list of str | None
+        Column(s) of the metadata (e.g., ``'set_size'`` or
+        ``['subject', 'set_size']``). If given, the rows of each group are
+        spread evenly over the batches, so that each batch has about the
+        same composition as the whole data.
+    drop_last : bool
+        Whether to drop the last batch if it is smaller than
+        ``batch_size``.
+    seed : int | None
+        Seed of the random number generator.
+
+    Returns
+    -------
+    batches : list of np.ndarray
+        The rows of each batch (sorted within each batch, which makes
+        reading from disk faster).
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.arange(len(metadata['epoch'])) if rows is None \
+        else np.asarray(rows)
+    order = rng.permutation(len(rows)) if shuffle else np.arange(len(rows))
+
+    if stratify is not None:
+        columns = [stratify] if isinstance(stratify, str) else stratify
+        _, group = np.unique(np.stack([metadata[column][rows]
+                                       for column in columns]).T.astype(str),
+                             axis=0, return_inverse=True)
+        group = group.ravel()[order]
+        # the k-th of the n rows of a group is placed at (k + offset) / n,
+        # i.e., the rows of each group are evenly spaced
+        rank = np.empty(len(order))
+        for n_group in range(group.max() + 1):
+            mask = group == n_group
+            offset = rng.uniform() if shuffle else 0.5
+            rank[mask] = (np.arange(mask.sum()) + offset) / mask.sum()
+        order = order[np.argsort(rank, kind='stable')]
+
+    n_batches = len(order) // batch_size if drop_last \
+        else -(-len(order) // batch_size)
+    return [np.sort(rows[order[start:start + batch_size]])
+            for start in range(0, n_batches * batch_size, batch_size)]
+
+
+def iter_batches(store, batch_size=64, rows=None, shuffle=True,
+                 stratify=None, drop_last=False, seed=None, prefetch=4,
+                 n_jobs=2):
+    """Iterate over mini-batches of stored epochs.
+
+    The next ``prefetch`` batches are read in ``n_jobs`` background
+    threads. The batches are written to ``prefetch + 1`` arrays that are
+    re-used, i.e., the epochs of a batch are only valid until the next
+    batch is requested (copy them if they are needed longer). The
+    throughput (in trials per second) and the time spent waiting for data
+    are logged at the end.
+
+    Parameters
+    ----------
+    store : dict
+        The epoch store (see ``epoch_store.read_epoch_store``).
+    batch_size, rows, shuffle, stratify, drop_last, seed
+        See ``batch_rows``.
+    prefetch : int
+        Number of batches read ahead.
+    n_jobs : int
+        Number of threads reading batches.
+
+    Yields
+    ------
+    epochs : np.ndarray, shape (n_epochs, n_channels, n_times)
+        The epochs of the batch (a C-contiguous float32 array).
+    rows : np.ndarray of int
+        The rows of ``store['metadata']`` of the epochs.
+    """
+    batches = batch_rows(store['metadata'], batch_size=batch_size,
+                         rows=rows, shuffle=shuffle, stratify=stratify,
+                         drop_last=drop_last, seed=seed)
+    prefetch = max(prefetch, 1)
+    buffers = [np.empty((batch_size,) + tuple(store['info']['shape'][1:]),
+                        dtype=np.float32) for _ in range(prefetch + 1)]
+
+    def read(n_batch):
+        """Read a batch into its buffer."""
+        batch = batches[n_batch]
+        buffer = buffers[n_batch % len(buffers)][:len(batch)]
+        return get_epochs(store, batch, out=buffer)
+
+    start, waiting, n_trials = time.perf_counter(), 0., 0
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        pending = [pool.submit(read, n_batch)
+                   for n_batch in range(min(prefetch, len(batches)))]
+        for n_batch, batch in enumerate(batches):
+            # the buffer of the previous batch is free again
+            if n_batch + prefetch < len(batches):
+                pending.append(pool.submit(read, n_batch + prefetch))
+
+            wait_start = time.perf_counter()
+            epochs = pending.pop(0).result()
+            waiting += time.perf_counter() - wait_start
+
+            n_trials += len(batch)
+            yield epochs, batch
+
+    duration = time.perf_counter() - start
+    logger.info('Loaded %s trials in %s batches: %.0f trials/s '
+                '(%.1f s of %.1f s waiting for data)'
+                % (n_trials, len(batches), n_trials / max(duration, 1e-9),
+                   waiting, duration))
@@ -0,0 +1,206 @@
+"""Content-addressed cache for intermediate results of the pipeline.
+
+Cache entries are identified by a key, i.e., a hash of the input files and
+the exact parameters of all processing steps that led to the result.
+An entry is only considered complete once its .json sidecar has been
+written. Least recently used entries are removed when the cache grows
+beyond ``CACHE_MAX_SIZE``.
+"""
+import os
+import json
+import hashlib
+
+from pathlib import Path
+
+from mne.utils import logger
+
+from config import FPATH_DATA_CACHE, CACHE_MAX_SIZE
+from profiling import step
+
+
+def fingerprint(*parts):
+    """Create a hash from (json serialisable) keys and parameters."""
+    parts = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha1(parts.encode()).hexdigest()
+
+
+def hash_file(fname, chunk_size=2 ** 24):
+    """Hash the content of a file.
+
+    The hash is stored along with the size and modification time of the
+    file, so unchanged files are only read once.
+    """
+    fname = Path(fname).resolve()
+    stat = fname.stat()
+    fname_memo = FPATH_DATA_CACHE / 'hashes' / (
+            fingerprint(str(fname)) + '.json')
+
+    if fname_memo.exists():
+        with open(fname_memo) as memo:
+            memo = json.load(memo)
+        if memo['size'] == stat.st_size and \
+                memo['mtime_ns'] == stat.st_mtime_ns:
+            return memo['hash']
+
+    sha1 = hashlib.sha1()
+    with open(fname, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            sha1.update(chunk)
+
+    fname_memo.parent.mkdir(parents=True, exist_ok=True)
+    with open(fname_memo, 'w') as memo:
+        json.dump(dict(fname=str(fname),
+                       size=stat.st_size,
+                       mtime_ns=stat.st_mtime_ns,
+                       hash=sha1.hexdigest()), memo, indent=2)
+
+    return sha1.hexdigest()
+
+
+def hash_bids_files(bids_path):
+    """Hash all files of a BIDS recording (e.g., .vhdr, .eeg, events.tsv)."""
+    basename = bids_path.copy().update(suffix=None, extension=None).basename
+    fnames = sorted(Path(bids_path.directory).glob('%s_*' % basename))
+
+    return fingerprint([(fname.name, hash_file(fname)) for fname in fnames])
+
+
+def _cache_files(key):
+    """Get all files belonging to a cache entry."""
+    return sorted(FPATH_DATA_CACHE.glob('%s*' % key))
+
+
+def read_cached_raw(key):
+    """Read raw data from the cache (returns None if not cached)."""
+    fname_sidecar = FPATH_DATA_CACHE / ('%s.json' % key)
+    if not fname_sidecar.exists():
+        return None
+
+    logger.info('Reading cached data: %s' % key)
+    # mark entry as recently used
+    for fname in _cache_files(key):
+        os.utime(fname)
+
+    # (imported here, so that hashing files does not import mne.io)
+    from mne.io import read_raw_fif
+
+    with step('cache_read'):
+        return read_raw_fif(FPATH_DATA_CACHE / ('%s-raw.fif' % key),
+                            preload=True)
+
+
+def save_cached_raw(raw, key, **params):
+    """Save raw data to the cache and remove old cache entries."""
+    FPATH_DATA_CACHE.mkdir(parents=True, exist_ok=True)
+
+    # save in double precision, so cached results are identical to
+    # the non-cached ones
+    with step('cache_write'):
+        raw.save(FPATH_DATA_CACHE / ('%s-raw.fif' % key),
+                 fmt='double', overwrite=True)
+
+    # the sidecar marks the entry as complete
+    with open(FPATH_DATA_CACHE / ('%s.json' % key), 'w') as sidecar:
+        json.dump(params, sidecar, indent=2, default=str)
+
+    evict_cache(CACHE_MAX_SIZE)
+
+
+def cached_raw(key, func, cache=True, **params):
+    """Get raw data from the cache or compute (and cache) it.
+
+    Parameters
+    ----------
+    key : str
+        The cache key (see ``fingerprint``).
+    func : callable
+        Function that computes the raw data if it is not cached.
+    cache : bool
+        Whether to use the cache at all.
+    **params
+        Parameters of the step, stored in the sidecar for reference.
+
+    Returns
+    -------
+    raw : mne.io.Raw
+        The (cached) raw data.
+    """
+    if not cache:
+        return func()
+
+    raw = read_cached_raw(key)
+    if raw is None:
+        raw = func()
+        save_cached_raw(raw, key, **params)
+
+    return raw
+
+
+def evict_cache(max_size):
+    """Remove least recently used cache entries until size < max_size."""
+    entries = {}
+    for fname in FPATH_DATA_CACHE.glob('*.json'):
+        key = fname.stem
+        files = _cache_files(key)
+        entries[key] = (max(os.path.getmtime(f) for f in files),
+                        sum(os.path.getsize(f) for f in files),
+                        files)
+
+    size = sum(entry[1] for entry in entries.values())
+    for key, (_, entry_size, files) in sorted(entries.items(),
+                                              key=lambda e: e[1][0]):
+        if size <= max_size:
+            break
+        logger.info('Removing cached data: %s' % key)
+        # remove the sidecar first, so the entry is never half complete
+        for fname in sorted(files, key=lambda f: f.suffix != '.json'):
+            fname.unlink(missing_ok=True)
+        size -= entry_size
+
+
+def cached_ica(fname, key, func, cache=True, **params):
+    """Load a fitted ICA from disk or fit (and save) it.
+
+    The ICA is saved along with a .json sidecar containing the fingerprint
+    of its training data and fit parameters. It is only re-used if the
+    fingerprint matches.
+
+    Parameters
+    ----------
+    fname : str | pathlib.Path
+        Path to the ICA file (should end with ``_ica.fif``).
+    key : str
+        The fingerprint of the training data and fit parameters.
+    func : callable
+        Function that fits the ICA if it can't be re-used.
+    cache : bool
+        Whether to re-use a saved ICA at all.
+    **params
+        Parameters of the fit, stored in the sidecar for reference.
+
+    Returns
+    -------
+    ica : mne.preprocessing.ICA
+        The fitted ICA.
+    """
+    fname = Path(fname)
+    fname_sidecar = fname.with_suffix('.json')
+
+    if cache and fname.exists() and fname_sidecar.exists():
+        with open(fname_sidecar) as sidecar:
+            sidecar = json.load(sidecar)
+        if sidecar['key'] == key:
+            logger.info('Re-using fitted ICA: %s' % fname)
+            from mne.preprocessing import read_ica
+
+            with step('cache_read'):
+                return read_ica(fname)
+
+    ica = func()
+
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    ica.save(fname, overwrite=True)
+    with open(fname_sidecar, 'w') as sidecar:
+        json.dump(dict(key=key, **params), sidecar, indent=2, default=str)
+
+    return ica
@@ -0,0 +1,262 @@
+"""Contralateral delay activity (CDA) from the stored epochs.
+
+The CDA is the difference between the activity of channels contralateral
+and ipsilateral to the cued hemifield. Channels are paired by mirroring the
+sensor positions (``sensor_positions.json``) at the midline, so that the
+lateralised activity of each trial can be computed for all channel pairs at
+once::
+
+    contra - ipsi = sign * (right - left)
+
+with ``sign = 1`` for trials with a left cue and ``sign = -1`` for trials
+with a right cue. Averages and retention-window amplitudes are computed for
+all pairs, so changing the channels of interest only selects other pairs.
+"""
+import os
+
+from pathlib import Path
+
+import numpy as np
+
+from config import sensors
+from epoch_store import get_epochs
+
+# channel pairs found in this process (by tolerance)
+_PAIRS = dict()
+
+
+def channel_pairs(tolerance=0.005):
+    """Pairs of mirror-symmetric channels (left, right).
+
+    Parameters
+    ----------
+    tolerance : float
+        Maximum distance (in m) between the position of a channel and the
+        mirrored position of its partner. Channels on the midline are not
+        paired.
+
+    Returns
+    -------
+    pairs : list of tuple of str
+        The left and right channel of each pair (ordered by the channels of
+        the left hemisphere, as in ``sensor_positions.json``).
+    """
+    if tolerance in _PAIRS:
+        return _PAIRS[tolerance]
+
+    ch_names = list(sensors['ch_pos'])
+    pos = np.array([sensors['ch_pos'][ch] for ch in ch_names])
+    mirrored = pos * [-1., 1., 1.]
+    distance = np.linalg.norm(pos[:, np.newaxis] - mirrored[np.newaxis],
+                              axis=2)
+    partner = np.argmin(distance, axis=1)
+
+    # mutual nearest neighbours on opposite sides of the midline
+    found = (distance[np.arange(len(pos)), partner] <= tolerance) & \
+        (partner[partner] == np.arange(len(pos))) & (pos[:, 0] < 0) & \
+        (pos[partner, 0] > 0)
+    pairs = [(ch_names[left], ch_names[partner[left]])
+             for left in np.flatnonzero(found)]
+
+    _PAIRS[tolerance] = pairs
+    return pairs
+
+
+def pair_indices(ch_names, pairs=None, roi=None):
+    """Indices of the channels of each pair in a list of channels.
+
+    Parameters
+    ----------
+    ch_names : list of str
+        The channels of the data.
+    pairs : list of tuple of str | None
+        The channel pairs. If None, all pairs of ``channel_pairs()``.
+    roi : list of str | None
+        Only keep the pairs that include one of these channels (of either
+        hemisphere). If None, all pairs.
+
+    Returns
+    -------
+    pairs : list of tuple of str
+        The pairs whose channels are both in ``ch_names``.
+    left, right : np.ndarray of int
+        Indices of the left and right channel of each pair.
+    """
+    pairs = channel_pairs() if pairs is None else pairs
+    if roi is not None:
+        pairs = [pair for pair in pairs if set(pair) & set(roi)]
+    pairs = [pair for pair in pairs
+             if pair[0] in ch_names and pair[1] in ch_names]
+    if not pairs:
+        raise ValueError('None of the channel pairs is in the data.')
+
+    left = np.array([ch_names.index(pair[0]) for pair in pairs])
+    right = np.array([ch_names.index(pair[1]) for pair in pairs])
+    return pairs, left, right
+
+
+def lateralised_waveforms(data, cue_side, left, right, out=None):
+    """Contralateral minus ipsilateral activity of each trial and pair.
+
+    Parameters
+    ----------
+    data : np.ndarray, shape (n_epochs, n_channels, n_times)
+        The epochs.
+    cue_side : np.ndarray of str, shape (n_epochs,)
+        The cued side of each epoch ('left' or 'right', trials without a
+        cue are NaN in the result).
+    left, right : np.ndarray of int, shape (n_pairs,)
+        Indices of the channels of each pair (see ``pair_indices``).
+    out : np.ndarray | None
+        Array to write the result to. If None, a new array is created.
+
+    Returns
+    -------
+    waveforms : np.ndarray, shape (n_epochs, n_pairs, n_times)
+        The lateralised activity.
+    """
+    sign = np.select([cue_side == 'left', cue_side == 'right'], [1., -1.],
+                     default=np.nan).astype(data.dtype)
+    out = np.subtract(data[:, right], data[:, left], out=out)
+    out *= sign[:, np.newaxis, np.newaxis]
+    return out
+
+
+def window_average(data, times, window):
+    """Mean of the data (last axis) within a time window (in s)."""
+    mask = (times >= window[0]) & (times <= window[1])
+    return data[..., mask].mean(axis=-1)
+
+
+def cda_batch(store, rows=None, pairs=None, window=(0.3, 0.9),
+              baseline=(-0.2, 0.), set_sizes=(2, 4, 6), batch_size=256):
+    """Compute the CDA of many trials and subjects in one pass.
+
+    The epochs are read from the epoch store in batches, and the
+    lateralised activity of all trials of a batch is computed at once.
+
+    Parameters
+    ----------
+    store : dict
+        The epoch store (see ``epoch_store.read_epoch_store``).
+    rows : np.ndarray of int | None
+        Rows of ``store['metadata']`` to use. If None, all rows.
+    pairs : list of tuple of str | None
+        The channel pairs. If None, all pairs of ``channel_pairs()``.
+    window : tuple of float
+        The retention window (in s) of the amplitudes.
+    baseline : tuple of float | None
+        Interval (in s) subtracted from the lateralised activity.
+    set_sizes : tuple of int
+        The set sizes to average.
+    batch_size : int
+        Number of epochs read and processed at once.
+
+    Returns
+    -------
+    cda : dict
+        ``amplitudes`` (mean activity in the retention window of each row
+        and pair, NaN for trials without a cue), ``waveforms`` (average of
+        each subject, set size and pair, shape (n_subjects, n_set_sizes,
+        n_pairs, n_times)), ``counts`` (number of trials of each subject
+        and set size), and the ``rows``, ``subjects``, ``set_sizes``,
+        ``pairs``, ``times`` and ``window``.
+    """
+    metadata, info = store['metadata'], store['info']
+    rows = np.arange(len(metadata['epoch'])) if rows is None \
+        else np.asarray(rows)
+    pairs, left, right = pair_indices(info['ch_names'], pairs)
+    n_times = info['shape'][2]
+    times = info['tmin'] + np.arange(n_times) / info['sfreq']
+
+    # average of each subject and set size (trials with other set sizes
+    # or without a cue are not counted)
+    subjects = np.unique(metadata['subject'][rows])
+    group = np.searchsorted(subjects, metadata['subject'][rows]) * \
+        len(set_sizes) + np.argmax(metadata['set_size'][rows, np.newaxis]
+                                   == np.array(set_sizes), axis=1)
+    valid = np.isin(metadata['set_size'][rows], set_sizes) & \
+        np.isin(metadata['cue_side'][rows], ['left', 'right'])
+    n_groups = len(subjects) * len(set_sizes)
+
+    sums = np.zeros((n_groups, len(pairs) * n_times))
+    counts = np.zeros(n_groups)
+    amplitudes = np.full((len(rows), len(pairs)), np.nan)
+    buffer = np.empty((min(batch_size, len(rows)),) +
+                      tuple(info['shape'][1:]), dtype=np.float32)
+    waves = np.empty((len(buffer), len(pairs), n_times), dtype=np.float32)
+    for start in range(0, len(rows), batch_size):
+        stop = min(start + batch_size, len(rows))
+        n_batch = stop - start
+        data = get_epochs(store, rows[start:stop], out=buffer[:n_batch])
+        batch = lateralised_waveforms(
+            data, metadata['cue_side'][rows[start:stop]], left, right,
+            out=waves[:n_batch])
+        if baseline is not None:
+            batch -= window_average(batch, times, baseline)[..., np.newaxis]
+        amplitudes[start:stop] = window_average(batch, times, window)
+
+        # sums of each group by a product with an indicator matrix
+        weights = (group[start:stop, np.newaxis] == np.arange(n_groups)) & \
+            valid[start:stop, np.newaxis]
+        sums += weights.T.astype(np.float64) @ np.nan_to_num(
+            batch.reshape(n_batch, -1))
+        counts += weights.sum(axis=0)
+
+    shape = (len(subjects), len(set_sizes), len(pairs), n_times)
+    with np.errstate(invalid='ignore'):
+        waveforms = sums / counts[:, np.newaxis]
+
+    return dict(amplitudes=amplitudes,
+                waveforms=waveforms.reshape(shape),
+                counts=counts.reshape(shape[:2]).astype(np.int64),
+                rows=rows,
+                subjects=subjects,
+                set_sizes=np.array(set_sizes),
+                pairs=pairs,
+                times=times,
+                window=np.array(window))
+
+
+def roi_average(cda, roi):
+    """Average the CDA over the pairs of a region of interest.
+
+    Parameters
+    ----------
+    cda : dict
+        The CDA of all pairs (see ``cda_batch``).
+    roi : list of str
+        Channels of interest (pairs that include one of them are used).
+
+    Returns
+    -------
+    amplitudes : np.ndarray, shape (n_rows,)
+        Retention-window amplitude of each trial.
+    waveforms : np.ndarray, shape (n_subjects, n_set_sizes, n_times)
+        Average of each subject and set size (see ``window_average`` for
+        the amplitudes in other time windows).
+    """
+    use = np.array([bool(set(pair) & set(roi)) for pair in cda['pairs']])
+    if not use.any():
+        raise ValueError('None of the channels %s is part of a pair.' % roi)
+
+    return cda['amplitudes'][:, use].mean(axis=1), \
+        cda['waveforms'][:, :, use].mean(axis=2)
+
+
+def save_cda(fname, cda, key=None):
+    """Save the CDA of all pairs to a .npz file (replaced atomically)."""
+    fname = Path(fname)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    fname_tmp = fname.with_name(fname.stem + '.tmp.npz')
+    np.savez(fname_tmp, key=str(key),
+             **{name: np.asarray(values) for name, values in cda.items()})
+    os.replace(fname_tmp, fname)
+
+
+def read_cda(fname):
+    """Read the CDA saved with ``save_cda`` (and its key)."""
+    with np.load(fname) as file:
+        cda = {name: file[name] for name in file.files}
+    cda['pairs'] = [tuple(pair) for pair in cda['pairs'].tolist()]
+    return cda, str(cda.pop('key'))
@@ -0,0 +1,94 @@
+"""
+===============================
+Check the EOG template matching
+===============================
+
+Compares the components selected by ``ica_utils.find_eog_components`` with
+those selected by ``mne.preprocessing.corrmap`` for many random sets of
+component topographies (some of them noisy copies of the EOG templates),
+with the 'auto' threshold and with the fixed thresholds used in
+``config.py``. Exits with an error if any selection differs.
+
+    python check_template_matching.py
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+# %%
+# imports
+import sys
+
+import numpy as np
+
+from mne import create_info
+from mne.preprocessing import ICA, corrmap
+from mne.utils import logger, use_log_level
+
+from config import ica_templates
+
+from ica_utils import find_eog_components
+
+# %%
+# number of random ICAs
+n_icas = 300
+
+
+# %%
+def make_ica(maps):
+    """An ICA object with the given topographies (without fitting it)."""
+    n_components, n_channels = maps.shape
+    ica = ICA(n_components=n_components)
+    ica.info = create_info([str(ch) for ch in range(n_channels)], 100.,
+                           'eeg')
+    ica.ch_names = ica.info['ch_names']
+    ica.n_components_ = n_components
+    # (the topographies are the product of both matrices)
+    ica.pca_components_ = maps
+    ica.mixing_matrix_ = np.eye(n_components)
+    ica.labels_ = dict()
+    return ica
+
+
+templates = {name: np.array(values) for name, values
+             in ica_templates.items()}
+n_channels = len(next(iter(templates.values())))
+rng = np.random.default_rng(42)
+mismatches = 0
+for n_ica in range(n_icas):
+    # random topographies, some of them similar to the templates
+    maps = rng.standard_normal((15, n_channels))
+    for template in templates.values():
+        for comp in rng.choice(len(maps), rng.integers(0, 3),
+                               replace=False):
+            maps[comp] = rng.choice([-1, 1]) * rng.uniform(0.5, 3.) \
+                * template + rng.uniform(0.2, 1.) \
+                * np.std(template) * rng.standard_normal(n_channels)
+
+    for threshold in ('auto', 0.85, 0.90):
+        with use_log_level('error'):
+            found = find_eog_components(
+                [make_ica(maps)], templates,
+                thresholds=[{name: threshold for name in templates}])[0]
+        for name, template in templates.items():
+            ica = make_ica(maps)
+            try:
+                with use_log_level('error'):
+                    corrmap([ica], template=template, threshold=threshold,
+                            label=name, plot=False, show=False)
+            except RuntimeError:
+                # (corrmap raises if no component matches)
+                pass
+            # (corrmap stores the components as a set, i.e., unordered)
+            expected = sorted(int(comp) for comp in ica.labels_.get(name, []))
+            if sorted(found.get(name, [])) != expected:
+                mismatches += 1
+                logger.info('ICA %s, %s, threshold %s: corrmap selects %s, '
+                            'find_eog_components selects %s'
+                            % (n_ica, name, threshold, expected,
+                               found.get(name, [])))
+
+logger.info('%s mismatches in %s comparisons'
+            % (mismatches, n_icas * 3 * len(templates)))
+if mismatches:
+    sys.exit(1)
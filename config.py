@@ -17,8 +17,6 @@ import numpy as np
 
 import json
 
-from mne.channels import make_dig_montage
-
 # -----------------------------------------------------------------------------
 # check number of available CPUs in system
 jobs = multiprocessing.cpu_count()
@@ -39,6 +37,27 @@ FPATH_DATA_SOURCEDATA = Path(paths["sourcedata"])
 FPATH_DATA_BIDS = Path(paths["bidsdata"])
 # path to derivatives
 FPATH_DATA_DERIVATIVES = Path(paths["derivatives"])
+# path to cache of intermediate results (e.g., filtered data)
+FPATH_DATA_CACHE = FPATH_DATA_DERIVATIVES / "cache"
+# path to run time and memory profiles of the pipeline stages
+FPATH_DATA_PROFILING = FPATH_DATA_DERIVATIVES / "profiling"
+# path to the subject-level ERPs (see 03_subject_level_erps.py)
+FPATH_DATA_ERPS = FPATH_DATA_DERIVATIVES / "erps"
+# path to the event index of each recording (see event_utils.py)
+FPATH_DATA_EVENTS = FPATH_DATA_DERIVATIVES / "events"
+# path to the epochs of all subjects (see epoch_store.py)
+FPATH_DATA_EPOCHS = FPATH_DATA_DERIVATIVES / "epochs"
+# path to the group-level results (see 04_group_level_erps.py)
+FPATH_DATA_GROUP = FPATH_DATA_DERIVATIVES / "group"
+# path to the CDA of all trials (see 05_cda_analysis.py)
+FPATH_DATA_CDA = FPATH_DATA_DERIVATIVES / "cda"
+# path to the subject reports (see report_utils.py)
+FPATH_DATA_REPORT = FPATH_DATA_DERIVATIVES / "report"
+# topographies shared by the ICAs of many subjects (see make_ica_prior.py)
+FNAME_ICA_PRIOR = FPATH_DATA_DERIVATIVES / "preprocessing" / "ica_prior.json"
+
+# maximum size of the cache in bytes (least recently used entries are removed)
+CACHE_MAX_SIZE = 50e9
 
 # the paths raw data in brainvision format (.vhdr)
 FNAME_RAW_VHDR_SES_1_TEMPLATE = os.path.join(
@@ -127,31 +146,76 @@ FPATH_DERIVATIVES_NOT_FOUND_MSG = (
 EOG_COMPONENTS_NOT_FOUND_MSG = "No {type} ICA components found; subject {subj}"
 
 # -----------------------------------------------------------------------------
-# eeg parameters
+# eeg parameters and templates
+# (read on first access, e.g., ``from config import montage``, so importing
+# this file is fast and does not import MNE)
+
+
+def _read_json(fname):
+    """Read a .json file (relative to the repository)."""
+    with open(fname) as file:
+        return json.load(file)
+
+
+def _make_montage():
+    """Create the eeg montage from the sensor positions."""
+    from mne.channels import make_dig_montage
+
+    sensors = _load('sensors')
+    return make_dig_montage(
+        ch_pos=sensors["ch_pos"],
+        nasion=sensors["nasion"],
+        lpa=sensors["lpa"],
+        rpa=sensors["rpa"],
+        coord_frame=sensors["coord_frame"]
+    )
 
-# import eeg markers
-with open("./eeg_markers.json") as eeg_markers:
-    eeg_markers = json.load(eeg_markers)
 
 # create eeg montage (old)
 # montage = _read_theta_phi_in_degrees('./sensors/easycap-M7.txt',
 #                                      head_size=0.1,
 #                                      add_fiducials=True)
 
-# create eeg montage
-with open("./sensor_positions.json") as sensors:
-    sensors = json.load(sensors)
-
-montage = make_dig_montage(
-    ch_pos=sensors["ch_pos"],
-    nasion=sensors["nasion"],
-    lpa=sensors["lpa"],
-    rpa=sensors["rpa"],
-    coord_frame=sensors["coord_frame"]
+_LAZY_VALUES = dict(
+    # eeg markers
+    eeg_markers=lambda: _read_json("./eeg_markers.json"),
+    # sensor positions and eeg montage
+    sensors=lambda: _read_json("./sensor_positions.json"),
+    montage=_make_montage,
+    # ica templates
+    ica_templates=lambda: _read_json("./ica_templates.json")
 )
 
+
+def _load(name):
+    """Load a value on first access (and keep it)."""
+    if name not in globals():
+        globals()[name] = _LAZY_VALUES[name]()
+    return globals()[name]
+
+
+def __getattr__(name):
+    """Get the eeg parameters and templates (see ``_LAZY_VALUES``)."""
+    if name in _LAZY_VALUES:
+        return _load(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 # -----------------------------------------------------------------------------
 # templates
-# import ica markers
-with open("./ica_templates.json") as temp:
-    ica_templates = json.load(temp)
+# labels given to the components that match each template
+EOG_TEMPLATE_LABELS = dict(vertical_eye="vertical_eog",
+                           horizontal_eye="horizontal_eog")
+
+# subject specific correlation thresholds for the templates
+# (default is 'auto', see mne.preprocessing.corrmap)
+EOG_TEMPLATE_THRESHOLDS = {
+    # lower the threshold for vertical eye movements (allows selecting 2
+    # components) and raise the threshold for horizontal eye movements
+    # (very strict about potential horizontal eye movement components)
+    999: dict(vertical_eye=0.85, horizontal_eye=0.90),
+}
+
+# subjects for which all matching components are removed
+# (for all others, only the first component identified by each template)
+EOG_ALL_COMPONENTS_SUBJECTS = {999}
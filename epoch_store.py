@@ -0,0 +1,193 @@
+"""On-disk store of the epochs of all subjects (e.g., for model training).
+
+The accepted epochs of each subject and session are saved as one
+memory-mappable ``.npy`` array with shape (n_epochs, n_channels, n_times)
+(in float32). Each epoch is a contiguous block of the file, so arbitrary
+epochs can be read without loading the rest. A ``.tsv`` table with one row
+per trial (including rejected trials) describes the epochs, and a ``.json``
+sidecar contains the channels and time points.
+"""
+import os
+import csv
+import json
+
+import numpy as np
+
+from config import FPATH_DATA_EPOCHS
+
+# columns of the metadata table and their types
+METADATA_COLUMNS = dict(subject=int, session=int, trial=int, sample=int,
+                        set_size=int, cue_side=str, response=str,
+                        bad_annotation=bool, bad_amplitude=bool,
+                        drop_reason=str, epoch=int)
+
+
+def epochs_fname(subj, session, kind='epochs', ext='.npy'):
+    """Path to the files of a subject and session in the store."""
+    return FPATH_DATA_EPOCHS / ('sub-%03d' % subj) / (
+        'sub-%03d_ses-%s_task-vogel2004_%s%s' % (subj, session, kind, ext))
+
+
+def save_epochs(epochs, metadata, subj, session, chunk_size=64):
+    """Save the epochs of a subject and session to the store.
+
+    Parameters
+    ----------
+    epochs : mne.Epochs
+        The (preloaded) accepted epochs.
+    metadata : dict of np.ndarray
+        Description of all trials (i.e., of all events used to create the
+        epochs, see ``event_utils.task_trials``).
+    subj, session : int
+        Subject and session.
+    chunk_size : int
+        Number of epochs converted and written at once.
+    """
+    fname = epochs_fname(subj, session)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+
+    # data (written in chunks to avoid a full copy of the epochs)
+    data = epochs.get_data(copy=False)
+    fname_tmp = fname.with_name(fname.stem + '.tmp.npy')
+    array = np.lib.format.open_memmap(fname_tmp, mode='w+',
+                                      dtype=np.float32, shape=data.shape)
+    for start in range(0, len(data), chunk_size):
+        array[start:start + chunk_size] = data[start:start + chunk_size]
+    array.flush()
+    del array
+    os.replace(fname_tmp, fname)
+
+    # one row per trial, rejected trials have epoch -1
+    n_trials = len(epochs.drop_log)
+    epoch = np.full(n_trials, -1)
+    epoch[epochs.selection] = np.arange(len(epochs.selection))
+    # epochs are dropped because of annotations (e.g., 'BAD_segment') or
+    # because of the amplitudes of some channels (named in the drop log)
+    ch_names = set(epochs.info['ch_names'])
+    rows = dict(subject=np.full(n_trials, subj),
+                session=np.full(n_trials, session),
+                trial=np.arange(n_trials),
+                **{key: metadata[key] for key in
+                   ('sample', 'set_size', 'cue_side', 'response')},
+                bad_annotation=[any(reason.lower().startswith('bad')
+                                    for reason in log)
+                                for log in epochs.drop_log],
+                bad_amplitude=[any(reason in ch_names for reason in log)
+                               for log in epochs.drop_log],
+                drop_reason=['/'.join(log) or 'n/a'
+                             for log in epochs.drop_log],
+                epoch=epoch)
+    with open(epochs_fname(subj, session, 'metadata', '.tsv'), 'w',
+              newline='') as file:
+        writer = csv.writer(file, delimiter='\t')
+        writer.writerow(list(METADATA_COLUMNS))
+        writer.writerows(zip(*[rows[column]
+                               for column in METADATA_COLUMNS]))
+
+    with open(epochs_fname(subj, session, 'epochs', '.json'), 'w') as file:
+        json.dump(dict(ch_names=epochs.ch_names,
+                       sfreq=epochs.info['sfreq'],
+                       tmin=float(epochs.times[0]),
+                       shape=list(data.shape),
+                       dtype='float32',
+                       unit='V'), file, indent=2)
+
+
+def read_metadata(fname):
+    """Read a metadata table into a dict of (typed) columns."""
+    with open(fname, newline='') as file:
+        rows = list(csv.reader(file, delimiter='\t'))
+    columns = dict(zip(rows[0], zip(*rows[1:])))
+
+    metadata = dict()
+    for column, values in columns.items():
+        kind = METADATA_COLUMNS.get(column, str)
+        if kind is bool:
+            metadata[column] = np.array([value == 'True' for value in values])
+        else:
+            metadata[column] = np.array(values, dtype=kind)
+    return metadata
+
+
+def read_epoch_store(subjects, session, accepted_only=True):
+    """Open the stored epochs of several subjects.
+
+    The epochs are not loaded, only memory-mapped.
+
+    Parameters
+    ----------
+    subjects : list of int
+        The subjects (subjects without stored epochs are skipped).
+    session : int
+        The session.
+    accepted_only : bool
+        Whether to only include the accepted epochs in the metadata.
+
+    Returns
+    -------
+    store : dict
+        ``metadata`` (dict of columns, one row per trial of all subjects),
+        ``data`` (memory-mapped array of each subject) and ``info``
+        (channels, sampling rate and time of the first sample).
+    """
+    tables, data, info = [], dict(), None
+    for subj in subjects:
+        fname = epochs_fname(subj, session)
+        if not fname.exists():
+            continue
+        with open(epochs_fname(subj, session, 'epochs', '.json')) as file:
+            subj_info = json.load(file)
+        if info is None:
+            info = subj_info
+        elif subj_info['ch_names'] != info['ch_names'] or \
+                subj_info['shape'][2] != info['shape'][2]:
+            raise ValueError('Subject %s: epochs have different channels '
+                             'or time points than those of subject %s.'
+                             % (subj, tables[0]['subject'][0]))
+
+        data[subj] = np.load(fname, mmap_mode='r')
+        tables.append(read_metadata(
+            epochs_fname(subj, session, 'metadata', '.tsv')))
+
+    if not tables:
+        raise RuntimeError('No stored epochs found for session %s.'
+                           % session)
+    metadata = {column: np.concatenate([table[column] for table in tables])
+                for column in tables[0]}
+    if accepted_only:
+        keep = metadata['epoch'] >= 0
+        metadata = {column: values[keep]
+                    for column, values in metadata.items()}
+
+    return dict(metadata=metadata, data=data, info=info)
+
+
+def get_epochs(store, rows, out=None):
+    """Read the epochs of some rows of the metadata into one array.
+
+    Parameters
+    ----------
+    store : dict
+        The epoch store (see ``read_epoch_store``).
+    rows : np.ndarray of int
+        Rows of ``store['metadata']`` (accepted epochs only).
+    out : np.ndarray | None
+        Array to write the epochs to, shape (len(rows), n_channels,
+        n_times). If None, a new array is created.
+
+    Returns
+    -------
+    epochs : np.ndarray, shape (len(rows), n_channels, n_times)
+        The epochs (in the order of ``rows``).
+    """
+    rows = np.asarray(rows)
+    if out is None:
+        out = np.empty((len(rows),) + tuple(store['info']['shape'][1:]),
+                       dtype=np.float32)
+    subjects = store['metadata']['subject'][rows]
+    epochs = store['metadata']['epoch'][rows]
+    for subj in np.unique(subjects):
+        mask = subjects == subj
+        out[mask] = store['data'][subj][epochs[mask]]
+
+    return out
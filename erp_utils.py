@@ -0,0 +1,256 @@
+"""Utility functions for computing ERPs from epoched data."""
+import os
+import json
+
+from pathlib import Path
+
+import numpy as np
+
+from scipy import stats
+
+from mne import EvokedArray, pick_info
+from mne.baseline import rescale
+
+from config import FPATH_DATA_ERPS
+from filter_utils import pick_indices
+
+
+def erp_fname(subj, session):
+    """Path to the ERPs of a subject and session."""
+    return FPATH_DATA_ERPS / ('sub-%03d' % subj) / (
+        'sub-%03d_ses-%s_task-vogel2004-ave.fif' % (subj, session))
+
+
+def _condition_matrix(epochs, conditions):
+    """Indicator matrix of the epochs of each condition."""
+    codes = np.array([epochs.event_id[cond] for cond in conditions])
+    return (epochs.events[:, 2][:, np.newaxis]
+            == codes[np.newaxis, :]).astype(np.float64)
+
+
+def grouped_averages(epochs, conditions=None, baseline=None,
+                     standard_error=False, picks=None, chunk_size=256):
+    """Compute the ERPs of several conditions in one pass over the epochs.
+
+    The averages of all conditions are computed with a single matrix
+    product over the epoch array, without copying the epochs of each
+    condition. Baseline correction is applied to the averages, which
+    gives the same result as::
+
+        epochs[cond].copy().apply_baseline(baseline).average()
+
+    Parameters
+    ----------
+    epochs : mne.Epochs
+        The (preloaded) epochs.
+    conditions : list of str | None
+        Conditions (keys of ``epochs.event_id``). If None, all conditions.
+    baseline : tuple | None
+        The baseline interval (see ``mne.Epochs.apply_baseline``).
+    standard_error : bool
+        Whether to also compute the standard error of each condition
+        (as ``epochs[cond].standard_error()``, after baseline correction).
+    picks : str | list | None
+        Channels to average. If None, all data channels.
+    chunk_size : int
+        Number of epochs processed at once when computing standard errors.
+
+    Returns
+    -------
+    evokeds : dict of mne.Evoked
+        The average of each condition.
+    errors : dict of mne.Evoked
+        The standard error of each condition (only returned if
+        ``standard_error=True``).
+    """
+    if not epochs.preload:
+        raise ValueError('The epochs must be preloaded.')
+    conditions = list(epochs.event_id) if conditions is None else conditions
+    picks = pick_indices(epochs.info, picks)
+    info = pick_info(epochs.info, picks)
+
+    # (the epoch array is used directly to avoid copying it)
+    data = epochs.get_data(copy=False)
+    n_epochs, _, n_times = data.shape
+    if len(picks) < data.shape[1]:
+        data = data[:, picks]
+    weights = _condition_matrix(epochs, conditions)
+    n_averaged = weights.sum(axis=0)
+
+    # sums of all conditions, shape (n_conditions, n_channels, n_times)
+    sums = (weights.T @ data.reshape(n_epochs, -1)).reshape(
+        len(conditions), len(picks), n_times)
+    with np.errstate(invalid='ignore'):
+        averages = sums / n_averaged[:, np.newaxis, np.newaxis]
+
+    evokeds = dict()
+    for n_cond, cond in enumerate(conditions):
+        evokeds[cond] = EvokedArray(averages[n_cond], info.copy(),
+                                    tmin=epochs.times[0], comment=cond,
+                                    nave=int(n_averaged[n_cond]),
+                                    baseline=baseline, verbose=False)
+    if not standard_error:
+        return evokeds
+
+    # squared deviations from the (baseline corrected) averages
+    if baseline is not None:
+        averages = rescale(averages, epochs.times, baseline, mode='mean',
+                           copy=True, verbose=False)
+    condition = np.argmax(weights, axis=1)
+    squares = np.zeros_like(averages)
+    for start in range(0, n_epochs, chunk_size):
+        stop = min(start + chunk_size, n_epochs)
+        chunk = data[start:stop]
+        if baseline is not None:
+            chunk = rescale(chunk, epochs.times, baseline, mode='mean',
+                            copy=True, verbose=False)
+        chunk = (chunk - averages[condition[start:stop]]) ** 2
+        squares += (weights[start:stop].T @ chunk.reshape(
+            stop - start, -1)).reshape(squares.shape)
+
+    errors = dict()
+    for n_cond, cond in enumerate(conditions):
+        n_cond_epochs = n_averaged[n_cond]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            error = np.sqrt(squares[n_cond] / n_cond_epochs) / \
+                np.sqrt(n_cond_epochs)
+        errors[cond] = EvokedArray(error, info.copy(), tmin=epochs.times[0],
+                                   comment=cond, nave=int(n_cond_epochs),
+                                   kind='standard_error', verbose=False)
+
+    return evokeds, errors
+
+
+def init_running_stats(conditions, ch_names, times):
+    """Empty running mean and variance of ERPs across subjects.
+
+    Parameters
+    ----------
+    conditions : list of str
+        The conditions (i.e., comments of the evoked responses).
+    ch_names : list of str
+        The channels.
+    times : np.ndarray
+        The time points of the evoked responses.
+
+    Returns
+    -------
+    running_stats : dict
+        The mean, the sum of squared deviations (``m2``) and the number of
+        subjects (``count``) of each condition and channel, and the subjects
+        that have been added (see ``update_running_stats``).
+    """
+    shape = (len(conditions), len(ch_names))
+    return dict(mean=np.zeros(shape + (len(times),)),
+                m2=np.zeros(shape + (len(times),)),
+                count=np.zeros(shape, dtype=np.int64),
+                conditions=list(conditions),
+                ch_names=list(ch_names),
+                tmin=float(times[0]),
+                subjects=dict())
+
+
+def update_running_stats(running_stats, evokeds, subject, key=None):
+    """Add the ERPs of one subject to the running mean and variance.
+
+    Uses Welford's algorithm, i.e., the ERPs of previous subjects are not
+    needed. Conditions without epochs and channels that are missing for a
+    subject (e.g., bad channels) are skipped for that subject, channels
+    that are not in ``running_stats`` are ignored.
+
+    Parameters
+    ----------
+    running_stats : dict
+        The running statistics (see ``init_running_stats``). They are
+        modified in place.
+    evokeds : list of mne.Evoked
+        The ERPs of the subject (one per condition).
+    subject : int
+        The subject ID.
+    key : str | None
+        Fingerprint of the ERPs (e.g., hash of the file), stored to detect
+        changes later on.
+
+    Returns
+    -------
+    running_stats : dict
+        The updated running statistics.
+    """
+    conditions, ch_names = running_stats['conditions'], \
+        running_stats['ch_names']
+    mean = running_stats['mean']
+    data = np.zeros_like(mean)
+    present = np.zeros(running_stats['count'].shape, dtype=bool)
+    for evoked in evokeds:
+        if evoked.comment not in conditions or evoked.nave < 1:
+            continue
+        if evoked.data.shape[1] != mean.shape[2]:
+            raise ValueError('Subject %s: ERPs have %s time points, expected '
+                             '%s.' % (subject, evoked.data.shape[1],
+                                      mean.shape[2]))
+        n_cond = conditions.index(evoked.comment)
+        common = [ch for ch in evoked.ch_names if ch in ch_names]
+        rows = [ch_names.index(ch) for ch in common]
+        data[n_cond, rows] = evoked.data[[evoked.ch_names.index(ch)
+                                          for ch in common]]
+        present[n_cond, rows] = True
+
+    running_stats['count'] += present
+    present = present[..., np.newaxis]
+    delta = np.where(present, data - mean, 0.)
+    mean += delta / np.maximum(running_stats['count'], 1)[..., np.newaxis]
+    running_stats['m2'] += delta * np.where(present, data - mean, 0.)
+    running_stats['subjects'][str(subject)] = key
+
+    return running_stats
+
+
+def running_stats_summary(running_stats, confidence=0.95):
+    """Mean and confidence interval of the mean across subjects.
+
+    Parameters
+    ----------
+    running_stats : dict
+        The running statistics (see ``update_running_stats``).
+    confidence : float
+        Confidence level of the interval (based on the t-distribution).
+
+    Returns
+    -------
+    mean : np.ndarray, shape (n_conditions, n_channels, n_times)
+        The mean across subjects.
+    lower, upper : np.ndarray, shape (n_conditions, n_channels, n_times)
+        Lower and upper bound of the confidence interval (NaN if there are
+        less than two subjects).
+    """
+    count = running_stats['count'][..., np.newaxis].astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sem = np.sqrt(running_stats['m2'] / (count - 1)) / np.sqrt(count)
+        t_crit = stats.t.ppf((1 + confidence) / 2, count - 1)
+    half_width = np.where(count > 1, t_crit * sem, np.nan)
+    mean = np.where(count > 0, running_stats['mean'], np.nan)
+
+    return mean, mean - half_width, mean + half_width
+
+
+def save_running_stats(fname, running_stats):
+    """Save running statistics to a .npz file (replaced atomically)."""
+    fname = Path(fname)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    meta = {key: running_stats[key]
+            for key in ('conditions', 'ch_names', 'tmin', 'subjects')}
+    fname_tmp = fname.with_name(fname.stem + '.tmp.npz')
+    np.savez(fname_tmp, mean=running_stats['mean'],
+             m2=running_stats['m2'], count=running_stats['count'],
+             meta=json.dumps(meta))
+    os.replace(fname_tmp, fname)
+
+
+def read_running_stats(fname):
+    """Read running statistics saved with ``save_running_stats``."""
+    with np.load(fname) as file:
+        running_stats = dict(mean=file['mean'], m2=file['m2'],
+                             count=file['count'])
+        running_stats.update(json.loads(str(file['meta'])))
+
+    return running_stats
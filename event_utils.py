@@ -0,0 +1,288 @@
+"""Event markers of the recordings and a per-recording event index.
+
+The stimulus markers are read directly from the BrainVision marker file
+(``.vmrk``) or the BIDS ``events.tsv`` into an events array (as returned by
+``mne.events_from_annotations``, with the codes of ``eeg_markers.json``).
+The task blocks and the description of each trial (set size, cue side,
+response) are derived from the markers once per recording and saved as a
+small ``.npz`` file in ``derivatives/events/sub-XXX`` (the *event index*),
+which is read by all later stages instead of the annotations of the data.
+"""
+import os
+import re
+import csv
+
+from pathlib import Path
+
+import numpy as np
+
+from mne.utils import logger
+
+from config import FPATH_DATA_EVENTS
+from profiling import step
+
+# e.g., 'Mk2=Stimulus,S 21,30001,1,0' (positions are 1-based)
+_VMRK_STIMULUS = re.compile(rb'^Mk\d+=Stimulus,S *(\d+,\d+),',
+                            re.MULTILINE)
+
+
+def events_fname(subj, session):
+    """Path to the event index of a subject and session."""
+    return FPATH_DATA_EVENTS / ('sub-%03d' % subj) / (
+        'sub-%03d_ses-%s_task-vogel2004_events.npz' % (subj, session))
+
+
+def _make_events(samples, codes, keep=None):
+    """Sorted events array of the markers with the given codes."""
+    samples = np.asarray(samples, dtype=np.int64)
+    codes = np.asarray(codes, dtype=np.int64)
+    if keep is not None:
+        mask = np.isin(codes, np.fromiter(keep, dtype=np.int64))
+        samples, codes = samples[mask], codes[mask]
+    order = np.argsort(samples, kind='stable')
+    return np.column_stack([samples[order],
+                            np.zeros(len(order), dtype=np.int64),
+                            codes[order]])
+
+
+def read_vmrk(fname, codes=None):
+    """Read the stimulus markers of a BrainVision marker file.
+
+    Parameters
+    ----------
+    fname : str | pathlib.Path
+        Path to the ``.vmrk`` file.
+    codes : iterable of int | None
+        The marker codes to keep (e.g., ``markers.values()``). If None, all
+        stimulus markers are kept.
+
+    Returns
+    -------
+    events : np.ndarray, shape (n_events, 3)
+        Sample (0-based, as in MNE) and code of each marker.
+    """
+    with open(fname, 'rb') as file:
+        found = _VMRK_STIMULUS.findall(file.read())
+    # (the 'code,position' pairs of all markers are parsed at once)
+    found = np.fromstring(b','.join(found).decode(), dtype=np.int64,
+                          sep=',').reshape(-1, 2)
+    return _make_events(found[:, 1] - 1, found[:, 0], keep=codes)
+
+
+def read_events_tsv(fname, codes=None):
+    """Read the stimulus markers of a BIDS events.tsv file.
+
+    Parameters
+    ----------
+    fname : str | pathlib.Path
+        Path to the ``events.tsv`` file (must have a ``sample`` column).
+    codes : iterable of int | None
+        The marker codes to keep. If None, all stimulus markers are kept.
+
+    Returns
+    -------
+    events : np.ndarray, shape (n_events, 3)
+        Sample and code of each marker (e.g., 'Stimulus/S 21' has code 21).
+    """
+    with open(fname, newline='') as file:
+        rows = list(csv.reader(file, delimiter='\t'))
+    columns = dict(zip(rows[0], zip(*rows[1:])))
+    if 'sample' not in columns:
+        raise ValueError('%s has no sample column.' % fname)
+
+    trial_types = np.array(columns['trial_type'], dtype=str)
+    stimulus = np.char.startswith(trial_types, 'Stimulus/S')
+    return _make_events(
+        np.array(columns['sample'])[stimulus].astype(np.int64),
+        np.char.lstrip(np.char.replace(trial_types[stimulus],
+                                       'Stimulus/S', '')).astype(np.int64),
+        keep=codes)
+
+
+def read_markers(fname, codes=None):
+    """Read the stimulus markers of a ``.vmrk`` or ``events.tsv`` file."""
+    if Path(fname).suffix == '.vmrk':
+        return read_vmrk(fname, codes=codes)
+    return read_events_tsv(fname, codes=codes)
+
+
+def trial_metadata(events, trials, markers):
+    """Describe each trial by the markers surrounding its set size marker.
+
+    Parameters
+    ----------
+    events : np.ndarray, shape (n_events, 3)
+        All events of the recording (with the codes of ``markers``).
+    trials : np.ndarray, shape (n_trials, 3)
+        The events of the set size markers (a subset of ``events``).
+    markers : dict
+        The marker codes (see ``eeg_markers.json``).
+
+    Returns
+    -------
+    metadata : dict of np.ndarray
+        The sample and set size of each trial, the cue side ('left' or
+        'right') preceding each set size marker and the response ('same' or
+        'diff') following it ('n/a' if not found within the trial).
+    """
+    samples, codes = events[:, 0], events[:, 2]
+    trials, trial_codes = trials[:, 0], trials[:, 2]
+    # samples of the previous and next trial (markers must lie in between)
+    previous = np.concatenate([[-1], trials[:-1]])
+    following = np.concatenate([trials[1:], [np.iinfo(np.int64).max]])
+
+    def nearest(labels, before):
+        """Label of the closest marker before (or after) each trial."""
+        label_codes = np.array([markers[label] for label in labels])
+        mask = np.isin(codes, label_codes)
+        found_samples, found_codes = samples[mask], codes[mask]
+        names = np.array([label.split('_')[-1] for label in labels] +
+                         ['n/a'])
+        if before:
+            idx = np.searchsorted(found_samples, trials, side='left') - 1
+            valid = idx >= 0
+            valid[valid] = found_samples[idx[valid]] > previous[valid]
+        else:
+            idx = np.searchsorted(found_samples, trials, side='right')
+            valid = idx < len(found_samples)
+            valid[valid] = found_samples[idx[valid]] < following[valid]
+        which = np.full(len(trials), len(labels))
+        which[valid] = np.argmax(found_codes[idx[valid], np.newaxis]
+                                 == label_codes[np.newaxis, :], axis=1)
+        return names[which]
+
+    set_size_codes = {markers['set_size_%s' % size]: size
+                      for size in (2, 4, 6)}
+    return dict(sample=trials,
+                set_size=np.array([set_size_codes.get(code, -1)
+                                   for code in trial_codes]),
+                cue_side=nearest(['cue_left', 'cue_right'], before=True),
+                response=nearest(['resp_same', 'resp_diff'],
+                                 before=False))
+
+
+def build_event_index(events, markers, starts, stops, first_samp=0):
+    """Describe the task blocks and trials of a recording.
+
+    Parameters
+    ----------
+    events : np.ndarray, shape (n_events, 3)
+        All markers of the recording (see ``read_markers``).
+    markers : dict
+        The marker codes (see ``eeg_markers.json``).
+    starts, stops : np.ndarray
+        First and last (inclusive) sample of each task block, relative to
+        the first sample (see ``raw_utils.find_task_blocks``).
+    first_samp : int
+        The first sample of the recording (event samples include it).
+
+    Returns
+    -------
+    index : dict of np.ndarray
+        ``events``, the task blocks (``starts``, ``stops``), ``first_samp``
+        and, for each trial (i.e., set size marker), its ``sample`` in the
+        recording, its ``task_sample`` in the concatenated task blocks (see
+        ``raw_utils.extract_blocks``, -1 if outside of the blocks), its
+        ``block`` (-1 if outside) and the columns of ``trial_metadata``.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64)
+    set_size_codes = [markers['set_size_%s' % size] for size in (2, 4, 6)]
+    # (the codes are kept with the samples, as other markers may share the
+    # sample of a set size marker)
+    trial_events = events[np.isin(events[:, 2], set_size_codes)]
+    trials = trial_events[:, 0]
+    metadata = trial_metadata(events, trial_events, markers)
+
+    # block of each trial and its sample once the blocks are concatenated
+    relative = trials - first_samp
+    block = np.searchsorted(starts, relative, side='right') - 1
+    inside = block >= 0
+    inside[inside] = relative[inside] <= stops[block[inside]]
+    block[~inside] = -1
+    offsets = np.concatenate(([0], np.cumsum(stops - starts + 1)))
+    task_sample = np.full(len(trials), -1, dtype=np.int64)
+    if len(starts):
+        task_sample[inside] = first_samp + starts[0] \
+            + offsets[block[inside]] + relative[inside] \
+            - starts[block[inside]]
+
+    return dict(events=events, starts=starts, stops=stops,
+                first_samp=np.int64(first_samp),
+                task_sample=task_sample, block=block, **metadata)
+
+
+def task_trials(index):
+    """Events and description of the trials within the task blocks.
+
+    Parameters
+    ----------
+    index : dict
+        The event index (see ``build_event_index``).
+
+    Returns
+    -------
+    events : np.ndarray, shape (n_trials, 3)
+        Events of the set size markers in the concatenated task blocks
+        (i.e., the preprocessed data), with the set size as code.
+    metadata : dict of np.ndarray
+        ``sample`` (in the preprocessed data), ``set_size``, ``cue_side``
+        and ``response`` of each trial.
+    """
+    keep = index['block'] >= 0
+    events = np.column_stack([index['task_sample'][keep],
+                              np.zeros(keep.sum(), dtype=np.int64),
+                              index['set_size'][keep]])
+    metadata = dict(sample=index['task_sample'][keep],
+                    **{column: index[column][keep]
+                       for column in ('set_size', 'cue_side', 'response')})
+    return events, metadata
+
+
+def save_event_index(fname, index, key=None):
+    """Save an event index to a .npz file (replaced atomically)."""
+    fname = Path(fname)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    fname_tmp = fname.with_name(fname.stem + '.tmp.npz')
+    np.savez(fname_tmp, key=str(key), **index)
+    os.replace(fname_tmp, fname)
+
+
+def read_event_index(fname):
+    """Read an event index saved with ``save_event_index`` (and its key)."""
+    with np.load(fname) as file:
+        index = {name: file[name] for name in file.files}
+    return index, str(index.pop('key'))
+
+
+def cached_event_index(fname, key, func, cache=True):
+    """Read the event index of a recording or compute (and save) it.
+
+    Parameters
+    ----------
+    fname : str | pathlib.Path
+        Path to the event index (see ``events_fname``).
+    key : str
+        Fingerprint of the recording and the parameters of the index (e.g.,
+        the markers and the task blocks).
+    func : callable
+        Function that computes the index if the saved one can't be re-used.
+    cache : bool
+        Whether to re-use a saved index at all.
+
+    Returns
+    -------
+    index : dict of np.ndarray
+        The event index (see ``build_event_index``).
+    """
+    fname = Path(fname)
+    if cache and fname.exists():
+        with step('cache_read'):
+            index, index_key = read_event_index(fname)
+        if index_key == key:
+            logger.info('Re-using event index: %s' % fname)
+            return index
+
+    index = func()
+    save_event_index(fname, index, key=key)
+    return index
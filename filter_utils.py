@@ -0,0 +1,437 @@
+"""FIR filtering with cached filter kernels and fused filter chains.
+
+Filters are specified by the parameters of ``mne.filter.create_filter``
+(e.g., ``dict(l_freq=0.01, h_freq=80.)``). Each kernel is designed once per
+sampling rate and set of parameters and kept on disk (in
+``derivatives/cache/filters``). Consecutive (linear, zero-phase) filters are
+combined into a single kernel and applied in one FFT overlap-add pass, which
+can be split into blocks of channels that are filtered in parallel threads.
+The result is the same as that of applying the filters one after another
+with MNE's FIR defaults, except for a few samples at the edges of the data.
+"""
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from scipy.fft import rfft, irfft, next_fast_len
+
+from mne import channel_indices_by_type
+from mne.filter import create_filter
+
+from config import FPATH_DATA_CACHE
+from cache import fingerprint
+
+# kernels designed (or read from disk) in this process
+_KERNELS = dict()
+
+# channel types for which MNE keeps track of the filter settings
+DATA_CHANNEL_TYPES = ('eeg', 'mag', 'grad', 'seeg', 'ecog', 'dbs')
+
+
+def notch_filter_params(freqs, notch_widths=None, trans_bandwidth=1.0,
+                        **params):
+    """Band-stop filter parameters of ``raw.notch_filter(freqs)``.
+
+    Parameters
+    ----------
+    freqs : list of float
+        Frequencies to remove (e.g., ``[50., 100.]``).
+    notch_widths : list of float | None
+        Width of each stop band. If None, ``freqs / 200`` is used.
+    trans_bandwidth : float
+        Width of the transition bands in Hz.
+    **params
+        Further parameters of ``mne.filter.create_filter``.
+
+    Returns
+    -------
+    params : dict
+        Parameters for ``design_fir``.
+    """
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=np.float64))
+    if notch_widths is None:
+        notch_widths = freqs / 200.
+    notch_widths = np.broadcast_to(notch_widths, freqs.shape)
+
+    # same as mne.filter.notch_filter (for method='fir')
+    tb_2 = trans_bandwidth / 2.
+    lows = freqs - notch_widths / 2. - tb_2
+    highs = freqs + notch_widths / 2. + tb_2
+
+    return dict(params, l_freq=highs.tolist(), h_freq=lows.tolist(),
+                l_trans_bandwidth=tb_2, h_trans_bandwidth=tb_2)
+
+
+def design_fir(sfreq, l_freq, h_freq, **params):
+    """Design a zero-phase FIR filter (or re-use a cached design).
+
+    Parameters
+    ----------
+    sfreq : float
+        The sampling frequency.
+    l_freq, h_freq : float | list of float | None
+        Band edges, see ``mne.filter.create_filter``.
+    **params
+        Further parameters of ``mne.filter.create_filter``, e.g.,
+        ``filter_length``, ``fir_window`` or ``fir_design``.
+
+    Returns
+    -------
+    h : np.ndarray
+        The filter kernel.
+    """
+    params = dict(dict(filter_length='auto', l_trans_bandwidth='auto',
+                       h_trans_bandwidth='auto', fir_window='hamming',
+                       fir_design='firwin'), **params)
+    params.update(method='fir', phase='zero')
+    params.pop('picks', None)
+
+    key = fingerprint(float(sfreq), l_freq, h_freq, params)
+    if key in _KERNELS:
+        return _KERNELS[key]
+
+    fname = FPATH_DATA_CACHE / 'filters' / ('%s.npy' % key)
+    if fname.exists():
+        h = np.load(fname)
+    else:
+        h = create_filter(None, sfreq, l_freq, h_freq, verbose=False,
+                          **params)
+        fname.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file first, so other processes never read
+        # a half written kernel
+        fname_tmp = fname.with_suffix('.%s.npy' % os.getpid())
+        np.save(fname_tmp, h)
+        os.replace(fname_tmp, fname)
+
+    _KERNELS[key] = h
+    return h
+
+
+def fuse_kernels(kernels):
+    """Combine zero-phase FIR kernels into one (by convolution)."""
+    h = np.ones(1)
+    for kernel in kernels:
+        h = np.convolve(h, kernel)
+    return h
+
+
+def _fft_length(n_h, n_x):
+    """FFT length with the lowest cost for overlap-add filtering.
+
+    Same cost function as ``mne.filter`` (number of multiplications plus
+    a penalty for long FFTs).
+    """
+    min_fft = 2 * n_h - 1
+    if n_x < min_fft:
+        # use only a single block
+        return next_fast_len(n_x + n_h - 1)
+
+    n_fft = 2 ** np.arange(np.ceil(np.log2(min_fft)),
+                           np.ceil(np.log2(n_x)) + 1, dtype=int)
+    cost = (np.ceil(n_x / (n_fft - n_h + 1).astype(np.float64))
+            * n_fft * (np.log2(n_fft) + 1))
+    cost += 4e-5 * n_fft * n_x
+    return int(n_fft[np.argmin(cost)])
+
+
+def _pad(x, n_pad, pad='reflect_limited'):
+    """Pad the last axis (as ``mne.filter`` does)."""
+    if n_pad == 0:
+        return x
+    if pad != 'reflect_limited':
+        return np.pad(x, ((0, 0), (n_pad, n_pad)), mode=pad)
+    # mirror the edges (and pad with zeros if the data is too short)
+    n_times = x.shape[-1]
+    zeros = np.zeros(x.shape[:-1] + (max(n_pad - n_times + 1, 0),))
+    return np.concatenate([zeros,
+                           2 * x[:, :1] - x[:, n_pad:0:-1],
+                           x,
+                           2 * x[:, -1:] - x[:, -2:-n_pad - 2:-1],
+                           zeros], axis=-1)
+
+
+def _overlap_add(x, h_fft, n_h, n_fft, n_edge, shift, pad):
+    """Filter the rows of x (with padded edges)."""
+    n_times = x.shape[-1]
+    x_ext = _pad(x, n_edge, pad)
+    n_x = x_ext.shape[-1]
+    x_filtered = np.zeros_like(x)
+
+    n_seg = n_fft - n_h + 1
+    for start in range(0, n_x, n_seg):
+        start_filt = max(0, start - shift)
+        stop_filt = min(start - shift + n_fft, n_times)
+        if stop_filt <= start_filt:
+            # the segment does not contribute to the output
+            continue
+
+        prod = irfft(rfft(x_ext[:, start:start + n_seg], n_fft) * h_fft,
+                     n_fft)
+        start_prod = max(0, shift - start)
+        stop_prod = start_prod + stop_filt - start_filt
+        x_filtered[:, start_filt:stop_filt] += prod[:, start_prod:stop_prod]
+
+    return x_filtered
+
+
+def apply_fir(data, h, n_jobs=1, pad='reflect_limited', samples=None,
+              block_size=8):
+    """Apply a zero-phase FIR kernel along the last axis.
+
+    Parameters
+    ----------
+    data : np.ndarray, shape (..., n_times)
+        The data to filter.
+    h : np.ndarray
+        The filter kernel (e.g., from ``design_fir`` or ``fuse_kernels``).
+    n_jobs : int
+        Number of threads filtering blocks of channels in parallel.
+    pad : str
+        How to pad the edges of the data, 'reflect_limited' (mirror the
+        edges) or any mode of ``np.pad`` (e.g., 'edge').
+    samples : np.ndarray | None
+        Indices of the samples to return (e.g., every second sample for
+        decimated data). Only these samples are kept in memory.
+    block_size : int
+        Number of channels filtered at once (limits the memory used for
+        the FFTs).
+
+    Returns
+    -------
+    data : np.ndarray, shape (..., n_samples)
+        The filtered data (a new array).
+    """
+    shape = data.shape
+    x = np.asarray(data, dtype=np.float64).reshape(-1, shape[-1])
+    if samples is None:
+        samples = slice(None)
+    else:
+        shape = shape[:-1] + (len(samples),)
+    if len(h) == 1:
+        return (x[:, samples] * h[0]).reshape(shape)
+
+    n_times = x.shape[-1]
+    # the edges are padded (at most with the length of the kernel)
+    n_edge = max(min(len(h), n_times) - 1, 0)
+    n_x = n_times + 2 * n_edge
+
+    # if the kernel is longer than the (padded) data, only the taps that
+    # reach the output samples are needed (e.g., for very low high-pass
+    # frequencies), which makes the FFTs shorter
+    center = (len(h) - 1) // 2
+    first = max(0, center + n_edge - n_x + 1)
+    h = h[first:center + n_edge + n_times]
+    shift = n_edge + center - first
+
+    n_h = len(h)
+    n_fft = _fft_length(n_h, n_x)
+    # the kernel is transformed only once for all channels
+    h_fft = rfft(h, n_fft)
+
+    out = np.empty((len(x), shape[-1]))
+
+    def filter_block(start):
+        stop = start + block_size
+        out[start:stop] = _overlap_add(x[start:stop], h_fft, n_h, n_fft,
+                                       n_edge, shift, pad)[:, samples]
+
+    starts = range(0, len(x), block_size)
+    if n_jobs == 1:
+        for start in starts:
+            filter_block(start)
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(filter_block, starts))
+
+    return out.reshape(shape)
+
+
+def pick_indices(info, picks):
+    """Indices of the channels given by name, type or index.
+
+    As in MNE, None means all data channels (e.g., not EOG channels).
+    """
+    indices = channel_indices_by_type(info, picks)
+    if picks is None:
+        indices = {ch_type: idx for ch_type, idx in indices.items()
+                   if ch_type in DATA_CHANNEL_TYPES}
+    return np.array(sorted(idx for idx_type in indices.values()
+                           for idx in idx_type), dtype=int)
+
+
+def _update_info(info, filters, picks):
+    """Keep track of the pass band (as ``raw.filter`` does)."""
+    types = info.get_channel_types()
+    picked = [types[idx] for idx in picks]
+    for ch_type in DATA_CHANNEL_TYPES:
+        if types.count(ch_type) != picked.count(ch_type):
+            # only a subset of the data channels was filtered
+            return
+
+    for params in filters:
+        l_freq, h_freq = params.get('l_freq'), params.get('h_freq')
+        if isinstance(l_freq, (list, tuple)) or \
+                isinstance(h_freq, (list, tuple)):
+            # band-stop filters don't change the pass band
+            continue
+        if l_freq is not None and h_freq is not None and l_freq > h_freq:
+            continue
+        with info._unlock():
+            if h_freq is not None and (info['lowpass'] is None
+                                       or h_freq < info['lowpass']):
+                info['lowpass'] = float(h_freq)
+            if l_freq is not None and (info['highpass'] is None
+                                       or l_freq > info['highpass']):
+                info['highpass'] = float(l_freq)
+
+
+def contiguous_segments(raw, skip_by_annotation):
+    """Contiguous sample ranges between (e.g., 'edge') annotations.
+
+    Samples covered by the annotations are excluded and the data is split
+    at annotations of zero duration (e.g., boundaries of concatenated
+    data). Returns the first and last (exclusive) sample of each range.
+    """
+    n_times = raw.n_times
+    mask = np.ones(n_times, dtype=bool)
+    cuts = np.zeros(n_times, dtype=bool)
+
+    annotations = raw.annotations
+    kinds = [kind.upper() for kind in skip_by_annotation]
+    for onset, duration, description in zip(annotations.onset,
+                                            annotations.duration,
+                                            annotations.description):
+        if not any(description.upper().startswith(kind) for kind in kinds):
+            continue
+        start, stop = raw.time_as_index(
+            [onset - raw.first_time, onset + duration - raw.first_time],
+            use_rounding=True)
+        mask[start:stop] = False
+        if 0 <= start < n_times:
+            cuts[start] = True
+
+    # a segment starts after a masked sample or at an annotation
+    first = mask & (cuts | ~np.concatenate(([False], mask[:-1])))
+    last = mask & ~np.concatenate((mask[1:] & ~cuts[1:], [False]))
+
+    return np.flatnonzero(first), np.flatnonzero(last) + 1
+
+
+def filter_raw(raw, filters, picks=None, n_jobs=1,
+               skip_by_annotation=('edge', 'bad_acq_skip')):
+    """Apply a chain of FIR filters to continuous data in one pass.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The (preloaded) data. It is modified in place.
+    filters : list of dict
+        Parameters of each filter (see ``design_fir`` and
+        ``notch_filter_params``).
+    picks : str | list | None
+        Channels to filter. If None, all data channels are filtered.
+    n_jobs : int
+        Number of threads.
+    skip_by_annotation : tuple of str
+        As in ``raw.filter``, segments between annotations starting with
+        these strings (e.g., boundaries of concatenated data) are filtered
+        separately.
+
+    Returns
+    -------
+    raw : mne.io.Raw
+        The filtered data.
+    """
+    picks = pick_indices(raw.info, picks)
+    h = fuse_kernels([design_fir(raw.info['sfreq'], **params)
+                      for params in filters])
+    starts, stops = contiguous_segments(raw, skip_by_annotation)
+
+    def fir(data):
+        for start, stop in zip(starts, stops):
+            data[:, start:stop] = apply_fir(data[:, start:stop], h,
+                                            n_jobs=n_jobs)
+        return data
+
+    raw.apply_function(fir, picks=picks, channel_wise=False)
+    _update_info(raw.info, filters, picks)
+
+    return raw
+
+
+def filter_epochs(epochs, filters, picks=None, n_jobs=1, pad='edge'):
+    """Apply a chain of FIR filters to each epoch in one pass.
+
+    Parameters
+    ----------
+    epochs : mne.Epochs
+        The (preloaded) epochs. They are modified in place.
+    filters : list of dict
+        Parameters of each filter (see ``design_fir``).
+    picks : str | list | None
+        Channels to filter. If None, all data channels are filtered.
+    n_jobs : int
+        Number of threads.
+    pad : str
+        How to pad the edges of each epoch (see ``apply_fir``), the default
+        is the same as in ``epochs.filter``.
+
+    Returns
+    -------
+    epochs : mne.Epochs
+        The filtered epochs.
+    """
+    picks = pick_indices(epochs.info, picks)
+    h = fuse_kernels([design_fir(epochs.info['sfreq'], **params)
+                      for params in filters])
+
+    def fir(data):
+        data[:, picks] = apply_fir(data[:, picks], h, n_jobs=n_jobs,
+                                   pad=pad)
+        return data
+
+    # (all channels are passed to fir, the picks are filtered inside)
+    epochs.apply_function(fir, picks=np.arange(len(epochs.ch_names)),
+                          channel_wise=False)
+    _update_info(epochs.info, filters, picks)
+
+    return epochs
+
+
+def filter_evoked(evoked, filters, picks=None, n_jobs=1, pad='edge'):
+    """Apply a chain of FIR filters to an evoked response in one pass.
+
+    As the filters are linear, filtering the average of some epochs gives
+    the same result as averaging the filtered epochs (with the same
+    ``pad``), so low-pass filters for visualisation can be applied to the
+    evoked responses instead of to each epoch.
+
+    Parameters
+    ----------
+    evoked : mne.Evoked
+        The evoked response. It is modified in place.
+    filters : list of dict
+        Parameters of each filter (see ``design_fir``).
+    picks : str | list | None
+        Channels to filter. If None, all data channels are filtered.
+    n_jobs : int
+        Number of threads.
+    pad : str
+        How to pad the edges (see ``apply_fir``), the default is the same
+        as in ``evoked.filter``.
+
+    Returns
+    -------
+    evoked : mne.Evoked
+        The filtered evoked response.
+    """
+    picks = pick_indices(evoked.info, picks)
+    h = fuse_kernels([design_fir(evoked.info['sfreq'], **params)
+                      for params in filters])
+
+    evoked.data[picks] = apply_fir(evoked.data[picks], h, n_jobs=n_jobs,
+                                   pad=pad)
+    _update_info(evoked.info, filters, picks)
+
+    return evoked
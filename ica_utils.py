@@ -0,0 +1,563 @@
+"""Utility functions for working with fitted ICA decompositions."""
+import json
+
+from pathlib import Path
+
+import numpy as np
+
+from mne import pick_info
+from mne.io import RawArray
+from mne.preprocessing import ICA
+from mne.utils import logger
+
+from config import EOG_COMPONENTS_NOT_FOUND_MSG
+from reject_utils import find_thresholds
+from filter_utils import (
+    design_fir,
+    apply_fir,
+    contiguous_segments,
+    pick_indices
+)
+
+# thresholds used by ``mne.preprocessing.corrmap`` when threshold='auto'
+AUTO_THRESHOLDS = np.arange(60, 95, dtype=np.float64) / 100.
+
+
+def _zscore_rows(x):
+    """Standardise each row of a matrix (for computing correlations)."""
+    x = x - x.mean(axis=-1, keepdims=True)
+    return x / x.std(axis=-1, keepdims=True)
+
+
+def _select_components(maps, corrs, target, thresholds):
+    """Components above each threshold and the resulting new templates.
+
+    Vectorised version of ``mne.preprocessing.ica._find_max_corrs`` for a
+    single ICA and many thresholds at once.
+    """
+    abs_corrs = np.abs(corrs)
+    # (n_components, n_thresholds)
+    selected = abs_corrs[:, np.newaxis] > thresholds[np.newaxis, :]
+    n_selected = selected.sum(axis=0)
+
+    median_corrs = np.array(
+        [np.median(abs_corrs[sel]) if sel.any() else 0.
+         for sel in selected.T])
+
+    # same as corrmap: average of the selected maps, each sign corrected
+    # and scaled to unit norm
+    weights = selected * np.sign(corrs)[:, np.newaxis]
+    unit_maps = maps / np.linalg.norm(maps, axis=1, keepdims=True)
+    new_targets = weights.T @ unit_maps
+    new_targets /= np.maximum(n_selected, 1)[:, np.newaxis]
+
+    sim_i_o = np.zeros(len(thresholds))
+    valid = n_selected > 0
+    if valid.any():
+        sim_i_o[valid] = np.abs(
+            _zscore_rows(new_targets[valid]) @ _zscore_rows(target)
+        ) / maps.shape[1]
+
+    return selected, median_corrs, new_targets, sim_i_o
+
+
+def match_templates(maps, corrs, template, threshold='auto'):
+    """Find the components of one ICA that match a template.
+
+    Parameters
+    ----------
+    maps : np.ndarray, shape (n_components, n_channels)
+        The topographies of the ICA components.
+    corrs : np.ndarray, shape (n_components,)
+        Correlation of each topography with the template.
+    template : np.ndarray, shape (n_channels,)
+        The template topography.
+    threshold : float | 'auto'
+        Correlation threshold. If 'auto', the threshold is selected as in
+        ``mne.preprocessing.corrmap``.
+
+    Returns
+    -------
+    components : list of int
+        Indices of the matching components.
+    """
+    if threshold == 'auto':
+        thresholds = AUTO_THRESHOLDS
+    elif 0 < threshold <= 1:
+        thresholds = np.array([threshold], dtype=np.float64)
+    else:
+        raise ValueError("threshold must be 'auto' or a correlation "
+                         "between 0 and 1, got %s" % threshold)
+
+    # first pass: thresholds for which the selected maps resemble the template
+    _, _, new_targets, sim_i_o = _select_components(
+        maps, corrs, template, thresholds)
+    if not sim_i_o.any():
+        return []
+
+    # second pass: correlate all maps with the refined template and use the
+    # threshold with the highest median correlation
+    new_target = new_targets[np.argmax(sim_i_o)]
+    new_corrs = _zscore_rows(maps) @ _zscore_rows(new_target) / maps.shape[1]
+    selected, median_corrs, _, _ = _select_components(
+        maps, new_corrs, new_target, thresholds)
+
+    return [int(comp) for comp in
+            np.flatnonzero(selected[:, np.argmax(median_corrs)])]
+
+
+def find_eog_components(icas, templates, labels=None, thresholds=None,
+                        subjects=None):
+    """Label components matching the EOG templates for many ICAs at once.
+
+    The correlations between all component topographies (of all ICAs) and
+    all templates are computed in one matrix operation. Afterwards,
+    the matching components are selected for each ICA individually (i.e.,
+    as calling ``mne.preprocessing.corrmap`` for each ICA and template).
+
+    Parameters
+    ----------
+    icas : list of mne.preprocessing.ICA
+        The fitted ICAs.
+    templates : dict
+        Template topographies (e.g., from ``ica_templates.json``).
+    labels : dict | None
+        The label to use for each template, e.g., ``vertical_eog`` for
+        ``vertical_eye``. Defaults to the template names.
+    thresholds : list of dict | None
+        Threshold for each ICA and template. Missing entries use 'auto'.
+    subjects : list | None
+        Subject IDs of the ICAs (only used for logging).
+
+    Returns
+    -------
+    components : list of dict
+        The matching components for each ICA and label. The labels are also
+        added to ``ica.labels_``.
+    """
+    labels = labels or {name: name for name in templates}
+    thresholds = thresholds or [dict() for _ in icas]
+    subjects = subjects or list(range(len(icas)))
+
+    names = list(templates)
+    templates = np.array([templates[name] for name in names])
+
+    # topographies of all components, shape (n_components_total, n_channels)
+    maps = [ica.get_components().T for ica in icas]
+    for subj, ica_maps in zip(subjects, maps):
+        if ica_maps.shape[1] != templates.shape[1]:
+            raise ValueError('Subject %s: ICA has %s channels but the '
+                             'templates have %s values.'
+                             % (subj, ica_maps.shape[1], templates.shape[1]))
+    bounds = np.cumsum([0] + [len(ica_maps) for ica_maps in maps])
+
+    # correlation of every topography with every template
+    all_corrs = (_zscore_rows(np.concatenate(maps))
+                 @ _zscore_rows(templates).T) / templates.shape[1]
+
+    components = []
+    for ica, ica_maps, start, stop, subj_thresholds, subj in zip(
+            icas, maps, bounds[:-1], bounds[1:], thresholds, subjects):
+        subj_components = dict()
+        for n_temp, name in enumerate(names):
+            found = match_templates(ica_maps,
+                                    all_corrs[start:stop, n_temp],
+                                    templates[n_temp],
+                                    subj_thresholds.get(name, 'auto'))
+            if found:
+                subj_components[labels[name]] = found
+                ica.labels_[labels[name]] = found
+            else:
+                logger.info(EOG_COMPONENTS_NOT_FOUND_MSG.format(
+                    type=labels[name], subj=subj))
+        components.append(subj_components)
+
+    return components
+
+
+def select_bad_components(labels, first_only=True):
+    """Get the components to exclude from the labelled components.
+
+    Parameters
+    ----------
+    labels : dict
+        Labelled components (e.g., ``ica.labels_``).
+    first_only : bool
+        Whether to only take the first component identified by each
+        template.
+
+    Returns
+    -------
+    bad_components : list of int
+        The (unique) components to exclude.
+    """
+    bad_components = []
+    for label in labels:
+        if first_only:
+            bad_components.extend([labels[label][0]])
+        else:
+            bad_components.extend(labels[label])
+
+    return [int(comp) for comp in np.unique(bad_components)]
+
+
+def save_eog_components(fname, eog_components, bad_components):
+    """Save the labelled and excluded components to a .json file."""
+    Path(fname).parent.mkdir(parents=True, exist_ok=True)
+    with open(fname, 'w') as file:
+        json.dump(dict(labels=eog_components, exclude=bad_components),
+                  file, indent=2)
+
+
+def make_ica_training_data(raw, l_freq=1.0, decim=1, reject=None,
+                           reject_by_annotation=True, tstep=2.0,
+                           max_duration=None, picks=None, n_jobs=1):
+    """Prepare the data for fitting an ICA.
+
+    The result is the data that ``ica.fit`` uses when called as::
+
+        ica.fit(raw.copy().filter(l_freq=l_freq, h_freq=None), decim=decim,
+                reject=reject, reject_by_annotation=reject_by_annotation,
+                tstep=tstep)
+
+    but no filtered copy of the full recording is made: each segment of
+    the recording is high-pass filtered (in blocks of channels) and only
+    the samples that are used for the fit are kept.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The (preloaded) data.
+    l_freq : float
+        High-pass frequency in Hz (see ``filter_utils.design_fir``).
+    decim : int
+        Only use every ``decim`` sample.
+    reject : dict | 'auto' | None
+        Peak-to-peak amplitude thresholds per channel type (e.g.,
+        ``dict(eeg=250e-6)``), or ``'auto'`` for one threshold per EEG
+        channel (see ``reject_utils.find_thresholds``). Segments of
+        ``tstep`` seconds exceeding them are dropped.
+    reject_by_annotation : bool
+        Whether to omit samples covered by 'bad' annotations.
+    tstep : float
+        Length of the segments used for rejection in seconds.
+    max_duration : float | None
+        Maximum amount of data (in seconds of the original recording). If
+        there is more data, evenly spaced samples are selected.
+    picks : str | list | None
+        Channels to use. If None, all data channels (minus bad channels).
+    n_jobs : int
+        Number of threads used for filtering (and for choosing the
+        thresholds if ``reject='auto'``).
+
+    Returns
+    -------
+    training_raw : mne.io.RawArray
+        The training data. Fit the ICA with ``ica.fit(training_raw)``.
+    """
+    sfreq = raw.info['sfreq']
+    picks = [idx for idx in pick_indices(raw.info, picks)
+             if raw.ch_names[idx] not in raw.info['bads']]
+    info = pick_info(raw.info, picks)
+
+    # samples used for fitting (as raw.get_data(reject_by_annotation='omit')
+    # followed by data[:, ::decim])
+    if reject_by_annotation:
+        starts, stops = contiguous_segments(raw, ('bad',))
+        samples = np.concatenate([np.arange(start, stop, dtype=np.int64)
+                                  for start, stop in zip(starts, stops)])
+    else:
+        samples = np.arange(raw.n_times, dtype=np.int64)
+    samples = samples[::decim]
+
+    # filter the data between boundaries of concatenated data (as
+    # raw.filter does), other samples are used as they are
+    h = design_fir(sfreq, l_freq, None)
+    segments, position = [], 0
+    for start, stop in zip(*contiguous_segments(raw,
+                                                ('edge', 'bad_acq_skip'))):
+        if start > position:
+            segments.append((position, start, False))
+        segments.append((start, stop, True))
+        position = stop
+    if position < raw.n_times:
+        segments.append((position, raw.n_times, False))
+
+    data = np.empty((len(picks), len(samples)))
+    for start, stop, filtered in segments:
+        first, last = np.searchsorted(samples, [start, stop])
+        if first == last:
+            continue
+        segment = raw.get_data(picks, start, stop)
+        keep = samples[first:last] - start
+        if filtered:
+            data[:, first:last] = apply_fir(segment, h, n_jobs=n_jobs,
+                                            samples=keep)
+        else:
+            data[:, first:last] = segment[:, keep]
+        del segment
+
+    # drop segments with high peak-to-peak amplitudes
+    if reject is not None:
+        step = int(np.ceil(np.ceil(tstep * sfreq) / decim))
+        n_windows = data.shape[1] // step
+        windows = data[:, :n_windows * step].reshape(len(picks), n_windows,
+                                                     step)
+        ptp = windows.max(axis=-1) - windows.min(axis=-1)
+        good = np.ones(n_windows, dtype=bool)
+        ch_types = np.array(info.get_channel_types())
+        if isinstance(reject, str) and reject == 'auto':
+            # one threshold per EEG channel, chosen by cross-validation
+            # (see reject_utils.py)
+            eeg = ch_types == 'eeg'
+            thresholds, _, _ = find_thresholds(
+                windows[eeg].transpose(1, 0, 2), ptp[eeg].T, n_jobs=n_jobs)
+            good &= (ptp[eeg] <= thresholds[:, np.newaxis]).all(axis=0)
+        else:
+            for ch_type, threshold in reject.items():
+                good &= (ptp[ch_types == ch_type] <= threshold).all(axis=0)
+        logger.info('Dropped %s of %s segments (%s s) for the ICA fit'
+                    % (n_windows - good.sum(), n_windows, tstep))
+        if not good.any():
+            raise RuntimeError('No clean segment found. Please consider '
+                               'updating your rejection thresholds.')
+        data = windows[:, good].reshape(len(picks), -1)
+
+    # further subsample (evenly spaced)
+    if max_duration is not None:
+        n_samples = int(max_duration * sfreq / decim)
+        if data.shape[1] > n_samples:
+            data = data[:, np.linspace(0, data.shape[1] - 1,
+                                       n_samples).astype(int)]
+
+    with info._unlock():
+        info['highpass'] = max(float(l_freq), info['highpass'] or 0.)
+
+    return RawArray(data, info, verbose=False)
+
+
+def make_ica_prior(icas, threshold=0.9, min_subjects=0.5, max_maps=None):
+    """Find component topographies that recur in the ICAs of many subjects.
+
+    Components are grouped greedily: the topography with matching
+    components (absolute correlation above ``threshold``) in most other
+    ICAs and its best match in each of these ICAs form a group, which is
+    then removed from the pool. The average (sign aligned) topography of
+    each group is used as a prior for fitting new ICAs (see
+    ``fit_ica_with_prior``).
+
+    Parameters
+    ----------
+    icas : list of mne.preprocessing.ICA
+        The fitted ICAs.
+    threshold : float
+        Minimum absolute correlation of matching topographies.
+    min_subjects : float
+        Minimum fraction of ICAs that must contain a component of a group.
+    max_maps : int | None
+        Maximum number of topographies. If None, all groups are kept.
+
+    Returns
+    -------
+    maps : np.ndarray, shape (n_maps, n_channels)
+        The average (z-scored) topography of each group, sorted by the
+        number of ICAs in the group.
+    support : np.ndarray, shape (n_maps,)
+        Fraction of ICAs with a component in each group.
+    ch_names : list of str
+        The channels (common to all ICAs) of the topographies.
+    """
+    ch_names = [ch for ch in icas[0].ch_names
+                if all(ch in ica.ch_names for ica in icas)]
+    maps = [ica.get_components()[[ica.ch_names.index(ch)
+                                  for ch in ch_names]].T
+            for ica in icas]
+    bounds = np.cumsum([0] + [len(ica_maps) for ica_maps in maps])
+    owner = np.repeat(np.arange(len(icas)), np.diff(bounds))
+    maps = _zscore_rows(np.concatenate(maps))
+    corrs = maps @ maps.T / maps.shape[1]
+
+    available = np.ones(len(maps), dtype=bool)
+    prior, support = [], []
+    while available.any() and len(prior) < (max_maps or len(maps)):
+        # best match of each topography within each ICA
+        abs_corrs = np.where(available, np.abs(corrs), 0.)
+        best = np.maximum.reduceat(abs_corrs, bounds[:-1], axis=1)
+        best[np.arange(len(maps)), owner] = 0.
+        n_matches = np.where(available, (best > threshold).sum(axis=1), -1)
+        seed = np.argmax(n_matches)
+        if n_matches[seed] + 1 < min_subjects * len(icas):
+            break
+
+        members = [seed] + [
+            start + np.argmax(abs_corrs[seed, start:stop])
+            for n_ica, (start, stop) in enumerate(zip(bounds[:-1],
+                                                      bounds[1:]))
+            if best[seed, n_ica] > threshold]
+        signs = np.sign(corrs[seed, members])
+        prior.append((signs[:, np.newaxis] * maps[members]).mean(axis=0))
+        support.append(len(members) / len(icas))
+        available[members] = False
+
+    maps = np.array(prior).reshape(-1, len(ch_names))
+    if len(maps):
+        maps = _zscore_rows(maps)
+    logger.info('Found %s topographies shared by at least %.0f%% of %s '
+                'ICAs' % (len(maps), 100 * min_subjects, len(icas)))
+
+    return maps, np.array(support), ch_names
+
+
+def save_ica_prior(fname, maps, ch_names, **info):
+    """Save prior topographies (see ``make_ica_prior``) to a .json file."""
+    Path(fname).parent.mkdir(parents=True, exist_ok=True)
+    with open(fname, 'w') as file:
+        json.dump(dict(ch_names=list(ch_names),
+                       maps=np.asarray(maps).tolist(), **info),
+                  file, indent=2)
+
+
+def read_ica_prior(fname):
+    """Read prior topographies saved with ``save_ica_prior``."""
+    with open(fname) as file:
+        prior = json.load(file)
+
+    return np.array(prior['maps']), prior['ch_names']
+
+
+def initial_unmixing(ica, maps, ch_names=None, min_norm=0.3):
+    """Initial unmixing matrix of an ICA solver from prior topographies.
+
+    The topographies are projected into the whitened PCA space of the ICA
+    (i.e., the space in which the solver works). Topographies that are
+    (almost) explained by the previous ones are skipped, the remaining
+    dimensions are filled with the principal components. The rows of the
+    resulting unmixing matrix have unit norm, i.e., all initial sources
+    have unit variance.
+
+    Parameters
+    ----------
+    ica : mne.preprocessing.ICA
+        ICA with a fitted PCA (``pca_components_`` etc.).
+    maps : np.ndarray, shape (n_maps, n_channels)
+        Prior topographies, ordered by priority.
+    ch_names : list of str | None
+        The channels of the topographies. If None, the topographies must
+        have the channels of the ICA (in the same order).
+    min_norm : float
+        Minimum norm of the part of a (normalised) topography that is not
+        explained by the previous ones.
+
+    Returns
+    -------
+    unmixing : np.ndarray, shape (n_components, n_components) | None
+        The initial unmixing matrix (None if no topography could be used).
+    """
+    if ch_names is not None:
+        missing = [ch for ch in ica.ch_names if ch not in ch_names]
+        if missing:
+            raise ValueError('The prior has no values for channel(s) %s.'
+                             % ', '.join(missing))
+        maps = maps[:, [ch_names.index(ch) for ch in ica.ch_names]]
+    elif maps.shape[1] != len(ica.ch_names):
+        raise ValueError('ICA has %s channels but the prior has %s values.'
+                         % (len(ica.ch_names), maps.shape[1]))
+
+    # topographies in the whitened PCA space
+    n_components = ica.n_components_
+    maps = (maps @ ica.pca_components_[:n_components].T
+            / np.sqrt(ica.pca_explained_variance_[:n_components]))
+
+    mixing = np.empty((n_components, 0))
+    basis = np.empty((n_components, 0))
+    for topo in maps[:n_components]:
+        topo = topo / np.linalg.norm(topo)
+        residual = topo - basis @ (basis.T @ topo)
+        norm = np.linalg.norm(residual)
+        if norm < min_norm:
+            continue
+        mixing = np.column_stack([mixing, topo])
+        basis = np.column_stack([basis, residual / norm])
+    if not mixing.shape[1]:
+        return None
+
+    # fill the remaining dimensions with the (orthogonalised) principal
+    # components, i.e., the default starting point of the solvers
+    q, _ = np.linalg.qr(np.column_stack([basis, np.identity(n_components)]))
+    mixing = np.column_stack([mixing, q[:, mixing.shape[1]:n_components]])
+
+    unmixing = np.linalg.inv(mixing)
+    return unmixing / np.linalg.norm(unmixing, axis=1, keepdims=True)
+
+
+def fit_ica_with_prior(raw, maps=None, ch_names=None, **ica_params):
+    """Fit an ICA starting from prior topographies.
+
+    The PCA of the data is computed first (i.e., the ICA is fitted without
+    solver iterations), the prior topographies are turned into an initial
+    unmixing matrix in this space (see ``initial_unmixing``), and the
+    solver is run on the whitened principal components starting from this
+    matrix, so the PCA is only computed once. The fitted ICA is the same
+    kind of object as without prior.
+
+    Only implemented for ``method='picard'``, which stops once it has
+    converged (``tol`` in ``fit_params``). Extended infomax (as in MNE)
+    runs until its learning rate has been annealed, which does not depend
+    on the starting point, so it does not get faster with a prior.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The training data (e.g., from ``make_ica_training_data``).
+    maps : np.ndarray, shape (n_maps, n_channels) | None
+        Prior topographies. If None, the solver starts from its default.
+    ch_names : list of str | None
+        The channels of the topographies (see ``initial_unmixing``).
+    **ica_params
+        Parameters of ``mne.preprocessing.ICA``.
+
+    Returns
+    -------
+    ica : mne.preprocessing.ICA
+        The fitted ICA.
+    """
+    ica = ICA(**ica_params)
+    if maps is None or not len(maps):
+        return ica.fit(raw)
+    if ica.method != 'picard':
+        raise ValueError("Starting from a prior requires method='picard', "
+                         "got %r." % ica.method)
+    from picard import picard
+
+    # fit the PCA only (infomax without iterations leaves the principal
+    # components as they are)
+    method, fit_params = ica.method, ica.fit_params
+    ica.method, ica.fit_params = 'infomax', dict(max_iter=0)
+    ica.fit(raw)
+    ica.method, ica.fit_params = method, fit_params
+    unmixing = initial_unmixing(ica, maps, ch_names)
+
+    # the whitened principal components, i.e., the data the solver works on
+    sources = ica.get_sources(raw).get_data(reject_by_annotation='omit')
+    _, unmixing, _, n_iter = picard(sources, whiten=False, w_init=unmixing,
+                                    return_n_iter=True,
+                                    random_state=ica.random_state,
+                                    **fit_params)
+
+    # as in ``ICA.fit``: undo the whitening and sort the components by
+    # explained variance
+    norms = np.sqrt(ica.pca_explained_variance_[:ica.n_components_])
+    unmixing_matrix = unmixing / norms
+    mixing_matrix = np.linalg.pinv(unmixing_matrix)
+    variance = np.sum(mixing_matrix ** 2, axis=0) \
+        * np.sum((unmixing @ sources) ** 2, axis=1)
+    del sources
+    order = np.argsort(variance)[::-1]
+    ica.unmixing_matrix_ = unmixing_matrix[order]
+    ica.mixing_matrix_ = mixing_matrix[:, order]
+    # (picard starts counting at 0)
+    ica.n_iter_ = n_iter + 1
+    logger.info('ICA fitted in %s iterations (starting from %s prior '
+                'topographies)' % (ica.n_iter_, len(maps)))
+
+    return ica
@@ -0,0 +1,77 @@
+"""
+=====================================
+Dataset-level prior for the ICA fits
+=====================================
+
+Collect the components of all previously fitted ICAs (see
+``02_run_preprocessing.py``) and find the topographies that recur in the
+ICAs of most subjects (e.g., eye movements, blinks). The average
+topographies are saved to ``derivatives/preprocessing/ica_prior.json`` and
+used as a starting point when fitting the ICA of further subjects with
+``method='picard'``, which reduces the number of iterations needed (see
+``ica_prior`` in ``02_run_preprocessing.py``).
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+# %%
+# imports
+import os
+
+from mne.preprocessing import read_ica
+from mne.utils import logger
+
+from config import (
+    FPATH_DATA_DERIVATIVES,
+    FNAME_ICA_PRIOR,
+    SUBJECT_IDS
+)
+
+from ica_utils import make_ica_prior, save_ica_prior
+
+# %%
+# settings
+# minimum (absolute) correlation of matching topographies
+threshold = 0.9
+# minimum fraction of subjects with a matching component
+min_subjects = 0.5
+
+# %%
+# load all fitted ICAs
+subjects, icas = [], []
+for subj in sorted(SUBJECT_IDS):
+    str_subj = str(subj).rjust(3, '0')
+    FPATH_ICA = os.path.join(
+        FPATH_DATA_DERIVATIVES,
+        'preprocessing',
+        'sub-%s' % str_subj,
+        'ica',
+        'sub-%s_task-%s_ica.fif' % (str_subj, 'vogel2004'))
+    if not os.path.exists(FPATH_ICA):
+        continue
+
+    subjects.append(int(subj))
+    icas.append(read_ica(FPATH_ICA, verbose=False))
+
+logger.info('Found fitted ICAs for %s subjects.' % len(subjects))
+if len(icas) < 2:
+    raise RuntimeError('At least two fitted ICAs are needed to build the '
+                       'prior, run 02_run_preprocessing.py first.')
+
+# %%
+# find the topographies shared across subjects
+maps, support, ch_names = make_ica_prior(icas,
+                                         threshold=threshold,
+                                         min_subjects=min_subjects)
+
+for n_map, fraction in enumerate(support):
+    logger.info('Topography %s: found in %.0f%% of the subjects'
+                % (n_map, 100 * fraction))
+
+save_ica_prior(FNAME_ICA_PRIOR, maps, ch_names,
+               support=support.tolist(),
+               subjects=subjects,
+               threshold=threshold,
+               min_subjects=min_subjects)
+logger.info('\nPrior saved to %s\n' % FNAME_ICA_PRIOR)
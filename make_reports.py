@@ -0,0 +1,24 @@
+"""
+=======================
+Render subject reports
+=======================
+
+Render the html-report of each subject from the sections written by the
+pipeline stages (see ``report_utils.py``) and an index page of all
+subjects. Reports whose sections did not change are not rendered again.
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+# %%
+# imports
+from mne.utils import logger
+
+from config import SUBJECT_IDS
+
+from report_utils import render_reports
+
+# %%
+fname = render_reports(sorted(int(subj) for subj in SUBJECT_IDS))
+logger.info('\nReports saved to %s\n' % fname.parent)
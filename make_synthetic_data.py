@@ -0,0 +1,293 @@
+"""
+==========================
+Synthetic BrainVision data
+==========================
+
+Write synthetic recordings (.vhdr, .eeg and .vmrk files) that follow the
+conventions of the study: channel layout of ``sensor_positions.json``,
+EOG channels 32, 63 and 64, markers and number of trials of
+``eeg_markers.json``, and blinks and saccades with the topographies of
+``ica_templates.json``. The files are named as expected by
+``00_restructure_eeg_data_directory.py``, so the full pipeline can be run
+(and load-tested) without access to the original recordings.
+
+Note that subjects are only processed by the pipeline if they are in
+``SUBJECT_IDS`` (see ``config.py``).
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+# %%
+# imports
+import os
+
+import numpy as np
+from scipy.signal import lfilter
+
+import click
+from mne.utils import logger
+
+from config import (
+    FPATH_DATA_RAW,
+    FNAME_RAW_VHDR_SES_1_TEMPLATE,
+    FNAME_RAW_VHDR_SES_2_TEMPLATE,
+    eeg_markers,
+    sensors,
+    ica_templates
+)
+
+# EOG channels (not part of sensor_positions.json)
+EOG_CHANNELS = ['32', '63', '64']
+
+# contribution of eye movements to the EOG channels
+EOG_WEIGHTS = dict(vertical_eye=[0.1, 1.0, -1.0],
+                   horizontal_eye=[1.0, 0.1, 0.1])
+
+
+def get_channels():
+    """EEG (without the reference, Cz) and EOG channels in numerical order."""
+    eeg = [ch for ch in sensors['ch_pos'] if ch != 'Cz']
+    return eeg, sorted(eeg + EOG_CHANNELS, key=int)
+
+
+def make_events(markers, n_trials, n_blocks, sfreq, rest, pause, rng,
+                n_practice=10):
+    """Create the markers of a recording (in samples).
+
+    The first block is a short practice block. Each trial consists of a cue,
+    the memory array (set size marker), the retention interval, the test
+    array and the response.
+    """
+    events = []
+    time = rest
+    trials_per_block = np.array_split(np.arange(n_trials), n_blocks)
+    for n_block, block in enumerate([range(n_practice)] + trials_per_block):
+        events.append((time, markers['task_start']))
+        time += 2.
+        for _ in block:
+            side = rng.choice(['cue_left', 'cue_right'])
+            set_size = rng.choice([2, 4, 6])
+            array = time + rng.uniform(0.3, 0.5)
+            test = array + 1.0
+            events.extend([
+                (time, markers[side]),
+                (array, markers['set_size_%s' % set_size]),
+                (array + 0.1, markers['retention']),
+                (test, markers['test_%s' % set_size]),
+                (test + rng.uniform(0.4, 1.2),
+                 markers[rng.choice(['resp_same', 'resp_diff'])]),
+            ])
+            time = events[-1][0] + rng.uniform(0.5, 1.0)
+        events.append((time + 1., markers['task_end']))
+        time += pause
+
+    events = np.array([(int(round(onset * sfreq)), code)
+                       for onset, code in events], dtype=np.int64)
+
+    return events, int(round((time + rest) * sfreq))
+
+
+def make_sources(events, markers, n_times, sfreq, rng, blink_rate=0.3,
+                 saccade_rate=0.1):
+    """Onsets and waveforms of blinks, saccades and event-related activity.
+
+    Returns a list of (onset, waveform, topography) tuples, with the
+    topography covering all channels (in µV per unit of the waveform).
+    """
+    eeg, channels = get_channels()
+    eeg_idx = [channels.index(ch) for ch in eeg]
+    eog_idx = [channels.index(ch) for ch in EOG_CHANNELS]
+
+    def topography(template, eog_weights):
+        topo = np.zeros(len(channels))
+        template = np.asarray(template)
+        topo[eeg_idx] = template / np.abs(template).max()
+        topo[eog_idx] = eog_weights
+        return topo
+
+    blink_topo = topography(ica_templates['vertical_eye'],
+                            EOG_WEIGHTS['vertical_eye'])
+    saccade_topo = topography(ica_templates['horizontal_eye'],
+                              EOG_WEIGHTS['horizontal_eye'])
+
+    # blinks: ~300 ms bumps of 100-200 µV
+    times = np.arange(int(0.4 * sfreq)) / sfreq
+    blink = np.exp(-0.5 * ((times - 0.2) / 0.05) ** 2)
+    sources = [(onset, blink * rng.uniform(100, 200), blink_topo)
+               for onset in rng.choice(n_times - len(blink),
+                                       int(blink_rate * n_times / sfreq))]
+
+    # saccades: steps to the side and back (30-60 µV)
+    for onset in rng.choice(n_times - int(sfreq),
+                            int(saccade_rate * n_times / sfreq)):
+        saccade = np.ones(int(rng.uniform(0.3, 0.9) * sfreq))
+        saccade *= rng.choice([-1, 1]) * rng.uniform(30, 60)
+        sources.append((onset, saccade, saccade_topo))
+
+    # posterior channels contralateral to the cued side show a sustained
+    # negativity during the retention interval, scaled by set size
+    pos = np.array([sensors['ch_pos'][ch] for ch in eeg])
+    posterior = np.clip(-pos[:, 1] / np.abs(pos[:, 1]).max(), 0, None)
+    hemispheres = dict(cue_left=pos[:, 0] > 0, cue_right=pos[:, 0] < 0)
+    cue_side = {markers['cue_left']: 'cue_left',
+                markers['cue_right']: 'cue_right'}
+    set_sizes = {markers['set_size_%s' % size]: size for size in (2, 4, 6)}
+
+    times = np.arange(int(1.0 * sfreq)) / sfreq
+    cda = -np.clip(times / 0.3, 0, 1)
+    side = None
+    for onset, code in events:
+        if code in cue_side:
+            side = cue_side[code]
+        elif code in set_sizes and side is not None:
+            topo = np.zeros(len(channels))
+            topo[eeg_idx] = posterior * hemispheres[side] * \
+                min(set_sizes[code], 4) / 2.
+            sources.append((onset, cda, topo))
+
+    return sources
+
+
+def write_data(fname, n_times, sfreq, sources, rng, chunk_size=10.):
+    """Write multiplexed float32 data (in µV), chunk by chunk."""
+    _, channels = get_channels()
+    n_channels = len(channels)
+    chunk = int(chunk_size * sfreq)
+
+    # background activity: 1/f like noise, alpha rhythm and line noise
+    b, a = [1.], [1., -0.98]
+    zi = np.zeros((n_channels, 1))
+    alpha_phase = rng.uniform(0, 2 * np.pi, n_channels)
+    alpha_amp = rng.uniform(2, 8, n_channels)
+
+    sources = sorted(sources, key=lambda source: source[0])
+    onsets = np.array([source[0] for source in sources])
+
+    with open(fname, 'wb') as file:
+        for start in range(0, n_times, chunk):
+            stop = min(start + chunk, n_times)
+            times = np.arange(start, stop) / sfreq
+
+            noise, zi = lfilter(b, a,
+                                rng.standard_normal((n_channels,
+                                                     stop - start)),
+                                zi=zi)
+            data = 2. * noise
+            data += alpha_amp[:, np.newaxis] * np.sin(
+                2 * np.pi * 10. * times + alpha_phase[:, np.newaxis])
+            data += 5. * np.sin(2 * np.pi * 50. * times)
+
+            # sources overlapping with this chunk
+            first = np.searchsorted(onsets, start - 2 * sfreq)
+            last = np.searchsorted(onsets, stop)
+            for onset, waveform, topo in sources[first:last]:
+                src_start, src_stop = max(onset, start), \
+                    min(onset + len(waveform), stop)
+                if src_start >= src_stop:
+                    continue
+                data[:, src_start - start:src_stop - start] += np.outer(
+                    topo, waveform[src_start - onset:src_stop - onset])
+
+            data.T.astype('<f4').tofile(file)
+
+
+def write_header(fname_vhdr, sfreq):
+    """Write the .vhdr file."""
+    _, channels = get_channels()
+    base = os.path.splitext(os.path.basename(fname_vhdr))[0]
+    lines = [
+        'Brain Vision Data Exchange Header File Version 1.0',
+        '',
+        '[Common Infos]',
+        'Codepage=UTF-8',
+        'DataFile=%s.eeg' % base,
+        'MarkerFile=%s.vmrk' % base,
+        'DataFormat=BINARY',
+        'DataOrientation=MULTIPLEXED',
+        'NumberOfChannels=%s' % len(channels),
+        'SamplingInterval=%s' % (1e6 / sfreq),
+        '',
+        '[Binary Infos]',
+        'BinaryFormat=IEEE_FLOAT_32',
+        '',
+        '[Channel Infos]',
+    ]
+    lines += ['Ch%s=%s,,1,µV' % (n_ch + 1, ch)
+              for n_ch, ch in enumerate(channels)]
+    with open(fname_vhdr, 'w', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+def write_markers(fname_vmrk, events):
+    """Write the .vmrk file (marker positions are 1-based)."""
+    base = os.path.splitext(os.path.basename(fname_vmrk))[0]
+    lines = [
+        'Brain Vision Data Exchange Marker File, Version 1.0',
+        '',
+        '[Common Infos]',
+        'Codepage=UTF-8',
+        'DataFile=%s.eeg' % base,
+        '',
+        '[Marker Infos]',
+        'Mk1=New Segment,,1,1,0',
+    ]
+    lines += ['Mk%s=Stimulus,S%s,%s,1,0' % (n_ev + 2, str(code).rjust(3),
+                                             onset + 1)
+              for n_ev, (onset, code) in enumerate(events)]
+    with open(fname_vmrk, 'w', encoding='utf-8') as file:
+        file.write('\n'.join(lines) + '\n')
+
+
+@click.command()
+@click.option("--n-subjects", default=1, type=int,
+              help="Number of subjects")
+@click.option("--first-subject", default=1, type=int,
+              help="Number of the first subject")
+@click.option("--session", default=1, type=int, help="Session number")
+@click.option("--sfreq", default=500., type=float, help="Sampling rate")
+@click.option("--n-trials", default=None, type=int,
+              help="Number of trials (default: see eeg_markers.json)")
+@click.option("--n-blocks", default=5, type=int,
+              help="Number of task blocks")
+@click.option("--rest", default=60., type=float,
+              help="Duration of resting state before and after the task (s)")
+@click.option("--pause", default=30., type=float,
+              help="Duration of the pauses between blocks (s)")
+@click.option("--output", default=None, type=str,
+              help="Output directory (default: raw data directory)")
+@click.option("--seed", default=42, type=int, help="Random seed")
+def make_synthetic_data(n_subjects, first_subject, session, sfreq, n_trials,
+                        n_blocks, rest, pause, output, seed):
+    """Write synthetic recordings for a number of subjects."""
+    session_ids = eeg_markers.get('ses-%s' % session, eeg_markers['ses-1'])
+    markers = session_ids['vogel2004']['markers']
+    n_trials = n_trials or session_ids['vogel2004']['n_trials']
+
+    template = {1: FNAME_RAW_VHDR_SES_1_TEMPLATE,
+                2: FNAME_RAW_VHDR_SES_2_TEMPLATE}[session]
+    output = output or str(FPATH_DATA_RAW)
+    os.makedirs(output, exist_ok=True)
+
+    for subj in range(first_subject, first_subject + n_subjects):
+        rng = np.random.default_rng([seed, subj, session])
+        fname_vhdr = os.path.join(output, os.path.basename(
+            template.format(subj=subj)))
+        base = os.path.splitext(fname_vhdr)[0]
+
+        events, n_times = make_events(markers, n_trials, n_blocks, sfreq,
+                                      rest, pause, rng)
+        sources = make_sources(events, markers, n_times, sfreq, rng)
+
+        write_data(base + '.eeg', n_times, sfreq, sources, rng)
+        write_markers(base + '.vmrk', events)
+        # the header is written last (it marks a complete recording)
+        write_header(fname_vhdr, sfreq)
+
+        logger.info('Wrote %s (%.1f min, %s markers)'
+                    % (fname_vhdr, n_times / sfreq / 60, len(events)))
+
+
+# %%
+if __name__ == '__main__':
+    make_synthetic_data.main(standalone_mode=False)
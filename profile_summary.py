@@ -0,0 +1,127 @@
+"""
+==================================
+Summary of run time and memory use
+==================================
+
+Collect the profiles written by the pipeline stages (see ``profiling.py``)
+and summarise them across the dataset: one row per subject, session, stage
+and step (``profiles.tsv``) and, for each stage and step, the mean and
+maximum across subjects (``summary.tsv``). Both tables are written to
+``derivatives/profiling``. The time and I/O of a step don't include the
+steps nested in it (e.g., ``cache_read`` within ``events``), which are
+listed separately.
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+# %%
+# imports
+import csv
+import json
+
+import numpy as np
+
+import click
+from mne.utils import logger
+
+from config import FPATH_DATA_PROFILING
+
+# measures recorded for each step (summed up for repeated steps)
+MEASURES = ['wall_time', 'cpu_time', 'read_bytes', 'write_bytes',
+            'read_chars', 'write_chars']
+
+
+def read_profiles(path=FPATH_DATA_PROFILING):
+    """One row per subject, session, stage and step."""
+    rows = dict()
+    for fname in sorted(path.glob('sub-*/*_profile.json')):
+        with open(fname) as file:
+            profile = json.load(file)
+        for record in profile['steps']:
+            idx = (profile['subject'], profile['session'], profile['stage'],
+                   record['step'])
+            if idx not in rows:
+                rows[idx] = dict(subject=idx[0], session=idx[1],
+                                 stage=idx[2], step=idx[3], calls=0,
+                                 peak_rss=None,
+                                 **{measure: None for measure in MEASURES})
+            row = rows[idx]
+            row['calls'] += 1
+            for measure in MEASURES:
+                if record[measure] is not None:
+                    row[measure] = (row[measure] or 0) + record[measure]
+            if record['peak_rss'] is not None:
+                row['peak_rss'] = max(row['peak_rss'] or 0,
+                                      record['peak_rss'])
+
+    return list(rows.values())
+
+
+def summarise(rows):
+    """Mean and maximum of each measure per stage and step."""
+    groups = dict()
+    for row in rows:
+        groups.setdefault((row['stage'], row['step']), []).append(row)
+
+    summary = []
+    for (stage, step), group in sorted(groups.items()):
+        entry = dict(stage=stage, step=step, n_subjects=len(group))
+        for measure in MEASURES + ['peak_rss']:
+            values = [row[measure] for row in group
+                      if row[measure] is not None]
+            entry['%s_mean' % measure] = np.mean(values) if values else None
+            entry['%s_max' % measure] = max(values) if values else None
+        summary.append(entry)
+
+    return summary
+
+
+def write_table(fname, rows):
+    """Write a list of dicts as a tab separated file."""
+    with open(fname, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=list(rows[0]),
+                                delimiter='\t')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+@click.command()
+@click.option("--stage", "stages", multiple=True, type=str,
+              help="Only summarise these stage(s) (default: all)")
+def profile_summary(stages):
+    """Summarise the profiles of all subjects."""
+    rows = read_profiles()
+    if stages:
+        rows = [row for row in rows if row['stage'] in stages]
+    if not rows:
+        logger.info('No profiles found in %s' % FPATH_DATA_PROFILING)
+        return
+
+    summary = summarise(rows)
+    write_table(FPATH_DATA_PROFILING / 'profiles.tsv', rows)
+    write_table(FPATH_DATA_PROFILING / 'summary.tsv', summary)
+
+    logger.info('\n%-6s %-12s %5s %10s %10s %10s %10s %10s'
+                % ('stage', 'step', 'n', 'wall (s)', 'max (s)', 'cpu (s)',
+                   'rss (MB)', 'read (MB)'))
+    for entry in summary:
+        logger.info('%-6s %-12s %5d %10.1f %10.1f %10.1f %10s %10s'
+                    % (entry['stage'], entry['step'], entry['n_subjects'],
+                       entry['wall_time_mean'], entry['wall_time_max'],
+                       entry['cpu_time_mean'],
+                       _megabytes(entry['peak_rss_max']),
+                       _megabytes(entry['read_chars_mean'])))
+    logger.info('\nTables written to %s\n' % FPATH_DATA_PROFILING)
+
+    return summary
+
+
+def _megabytes(value):
+    """Format a number of bytes (or None) as megabytes."""
+    return 'n/a' if value is None else '%.0f' % (value / 1e6)
+
+
+# %%
+if __name__ == '__main__':
+    profile_summary.main(standalone_mode=False)
@@ -0,0 +1,170 @@
+"""Record run time, CPU time, memory and I/O of named processing steps.
+
+Profiling is started once per run of a stage script (``start_profiling``).
+Afterwards, each step is wrapped in ``with step('name'):`` and the results
+are saved as a .json sidecar in ``derivatives/profiling`` (``save_profile``).
+Outside of a profiled run, ``step`` does nothing.
+
+Steps can be nested (e.g., ``'cache_read'`` within ``'events'``). The run
+time, CPU time and I/O of a step don't include those of the steps nested
+in it, so the steps of a run can be summed up without counting anything
+twice.
+
+Peak memory is measured per (outermost) step where the system allows to
+reset the peak resident set size (Linux, via ``/proc/self/clear_refs``),
+otherwise it is the peak of the process so far. Nested steps don't reset
+it, i.e., their peak is the peak of the enclosing step so far. CPU time
+and I/O are those of the current process (including its threads, but not
+its child processes).
+"""
+import os
+import json
+import time
+
+from contextlib import contextmanager
+from pathlib import Path
+
+from config import FPATH_DATA_PROFILING
+
+# the profile of the current run (None if not profiling)
+_steps = None
+# the steps currently running (the innermost last), with the summed up
+# measures of the steps nested in them
+_open_steps = []
+
+
+def _read_proc(fname):
+    """Read ``key: value`` pairs from a file in /proc/self (if it exists)."""
+    try:
+        with open(os.path.join('/proc/self', fname)) as file:
+            lines = file.readlines()
+    except OSError:
+        return dict()
+
+    values = dict()
+    for line in lines:
+        key, _, value = line.partition(':')
+        value = value.split()
+        if value and value[0].isdigit():
+            values[key] = int(value[0])
+    return values
+
+
+def _reset_peak_rss():
+    """Reset the peak resident set size of the process (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def _peak_rss():
+    """Peak resident set size of the process in bytes."""
+    status = _read_proc('status')
+    if 'VmHWM' in status:
+        return status['VmHWM'] * 1024
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def _io_counters():
+    """Bytes read and written by the process so far."""
+    io = _read_proc('io')
+    # read_bytes and write_bytes are the bytes fetched from or sent to the
+    # storage layer, rchar and wchar also include reads from the page cache
+    return dict(read_bytes=io.get('read_bytes'),
+                write_bytes=io.get('write_bytes'),
+                read_chars=io.get('rchar'),
+                write_chars=io.get('wchar'))
+
+
+def start_profiling():
+    """Start recording steps (discards the steps of a previous run)."""
+    global _steps
+    _steps = []
+    _open_steps.clear()
+
+
+@contextmanager
+def step(name):
+    """Record wall time, CPU time, peak memory and I/O of a block of code.
+
+    Parameters
+    ----------
+    name : str
+        Name of the step (e.g., ``'filter'``). Steps with the same name are
+        recorded separately (and summed up by ``profile_summary.py``).
+        Steps nested in this one are recorded with ``parent=name``.
+    """
+    if _steps is None:
+        yield
+        return
+
+    # (a nested step must not reset the peak of the enclosing step)
+    parent = _open_steps[-1]['step'] if _open_steps else None
+    peak_reset = False if _open_steps else _reset_peak_rss()
+    io_start = _io_counters()
+    nested = dict(step=name, wall_time=0., cpu_time=0.,
+                  **{key: 0 for key in io_start})
+    _open_steps.append(nested)
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        measures = dict(wall_time=time.perf_counter() - wall_start,
+                        cpu_time=time.process_time() - cpu_start)
+        io_stop = _io_counters()
+        for key in io_start:
+            if io_start[key] is None or io_stop[key] is None:
+                measures[key] = None
+            else:
+                measures[key] = io_stop[key] - io_start[key]
+        _open_steps.pop()
+        if _open_steps:
+            for key, value in measures.items():
+                if value is not None:
+                    _open_steps[-1][key] += value
+
+        record = dict(step=name,
+                      parent=parent,
+                      peak_rss=_peak_rss(),
+                      peak_rss_per_step=peak_reset)
+        for key, value in measures.items():
+            # (without the nested steps)
+            record[key] = None if value is None else value - nested[key]
+        _steps.append(record)
+
+
+def profile_fname(subj, session, stage):
+    """Path to the profile of a stage, subject and session."""
+    str_subj = str(subj).rjust(3, '0')
+    return FPATH_DATA_PROFILING / ('sub-%s' % str_subj) / (
+        'sub-%s_ses-%s_stage-%s_profile.json' % (str_subj, session, stage))
+
+
+def save_profile(fname, **info):
+    """Save the recorded steps (and stop profiling).
+
+    Parameters
+    ----------
+    fname : str | pathlib.Path
+        Path to the .json sidecar (see ``profile_fname``).
+    **info
+        Additional information about the run (e.g., subject, options).
+    """
+    global _steps
+    if _steps is None:
+        return
+
+    Path(fname).parent.mkdir(parents=True, exist_ok=True)
+    with open(fname, 'w') as file:
+        json.dump(dict(**info, steps=_steps), file, indent=2, default=str)
+    _steps = None
@@ -0,0 +1,135 @@
+"""Utility functions for working with continuous (raw) EEG data."""
+import numpy as np
+
+from mne import Annotations
+from mne.io import RawArray
+
+
+def find_task_blocks(events, start_code, end_code, n_times, sfreq,
+                     first_samp=0, pad=(0., 0.), skip=0):
+    """Find the sample ranges of task blocks from start and end markers.
+
+    Each end marker is paired with the last start marker preceding it. If a
+    start marker is missing, the block starts right after the previous block
+    (or at the beginning of the recording).
+
+    Parameters
+    ----------
+    events : np.ndarray, shape (n_events, 3)
+        The events (e.g., from ``mne.events_from_annotations``).
+    start_code : int
+        Event code marking the start of a block.
+    end_code : int
+        Event code marking the end of a block.
+    n_times : int
+        Number of samples in the recording.
+    sfreq : float
+        The sampling frequency.
+    first_samp : int
+        The first sample of the recording (event samples include it).
+    pad : tuple of float
+        Time (in seconds) to keep before the start and after the end marker.
+    skip : int
+        Number of blocks at the beginning to discard.
+
+    Returns
+    -------
+    starts, stops : np.ndarray
+        First and last (inclusive) sample of each block.
+    """
+    start_samps = events[events[:, 2] == start_code, 0] - first_samp
+    end_samps = events[events[:, 2] == end_code, 0] - first_samp
+
+    # the last start marker before each end marker (-1 if there is none)
+    last_start = np.searchsorted(start_samps, end_samps) - 1
+    previous_end = np.concatenate(([-1], end_samps[:-1]))
+    valid = last_start >= 0
+    valid[valid] = start_samps[last_start[valid]] > previous_end[valid]
+
+    starts = previous_end + 1
+    starts[valid] = start_samps[last_start[valid]] \
+        - int(round(pad[0] * sfreq))
+    stops = end_samps + int(round(pad[1] * sfreq))
+
+    starts = np.clip(starts, 0, n_times - 1)[skip:]
+    stops = np.clip(stops, 0, n_times - 1)[skip:]
+
+    return starts, stops
+
+
+def extract_blocks(raw, starts, stops):
+    """Concatenate sample ranges of a recording into a new raw object.
+
+    Unlike ``concatenate_raws([raw.copy().crop(...), ...])``, the full
+    recording is never copied: only the requested samples are written into
+    the output array. If ``raw`` is not preloaded, only these samples are
+    read from disk. Annotations are kept and boundaries between blocks are
+    marked (``BAD boundary`` and ``EDGE boundary``) as in
+    ``mne.concatenate_raws``.
+
+    Parameters
+    ----------
+    raw : mne.io.Raw
+        The recording.
+    starts, stops : array-like of int
+        First and last (inclusive) sample of each block.
+
+    Returns
+    -------
+    raw_blocks : mne.io.RawArray
+        The concatenated blocks.
+    """
+    sfreq = raw.info['sfreq']
+    starts = np.asarray(starts, dtype=np.int64)
+    stops = np.asarray(stops, dtype=np.int64) + 1
+    offsets = np.concatenate(([0], np.cumsum(stops - starts)))
+
+    data = np.empty((len(raw.ch_names), offsets[-1]), dtype=np.float64)
+    for start, stop, offset in zip(starts, stops, offsets):
+        data[:, offset:offset + stop - start] = raw.get_data(start=start,
+                                                             stop=stop)
+
+    first_samp = raw.first_samp + starts[0]
+    raw_blocks = RawArray(data, raw.info, first_samp=first_samp,
+                          verbose=False)
+
+    # annotation onsets are relative to the first sample if there is no
+    # orig_time, otherwise to orig_time
+    annotations = raw.annotations
+    if annotations.orig_time is None:
+        time_offset = 0.
+    else:
+        time_offset = raw.first_samp / sfreq
+    block_times = starts / sfreq + time_offset
+    shifts = (offsets[:-1] - starts) / sfreq
+    if annotations.orig_time is not None:
+        shifts += starts[0] / sfreq
+
+    onset, duration, description, ch_names = [], [], [], []
+    for n_block, (tmin, tmax, shift) in enumerate(
+            zip(block_times, (stops / sfreq) + time_offset, shifts)):
+        in_block = np.flatnonzero((annotations.onset >= tmin)
+                                  & (annotations.onset < tmax))
+        onset.extend(annotations.onset[in_block] + shift)
+        duration.extend(np.minimum(annotations.duration[in_block],
+                                   tmax - annotations.onset[in_block]))
+        description.extend(annotations.description[in_block])
+        ch_names.extend(annotations.ch_names[in_block])
+
+        if n_block > 0:
+            # mark the boundary to the previous block
+            boundary = tmin + shift
+            onset.extend([boundary, boundary])
+            duration.extend([0., 0.])
+            description.extend(['BAD boundary', 'EDGE boundary'])
+            ch_names.extend([(), ()])
+
+    order = np.argsort(onset, kind='stable')
+    raw_blocks.set_annotations(Annotations(
+        onset=np.asarray(onset)[order],
+        duration=np.asarray(duration)[order],
+        description=np.asarray(description)[order],
+        ch_names=[ch_names[idx] for idx in order],
+        orig_time=annotations.orig_time))
+
+    return raw_blocks
@@ -0,0 +1,241 @@
+"""Rejection of epochs with data-driven peak-to-peak amplitude thresholds.
+
+The peak-to-peak amplitudes of all epochs and channels are computed in one
+pass. Instead of one threshold for all channels, each channel can get its
+own threshold (relative to the typical amplitudes of the channel), chosen
+by cross-validation as in autoreject (Jas et al., 2017): for each
+candidate, the average of the accepted training epochs is compared with the
+median of the held-out epochs, and the candidate with the smallest error is
+used. All candidates are evaluated at once, in blocks of channels and time
+points computed in parallel threads.
+
+The result is a *rejection log* (thresholds, amplitudes, and the bad
+channels of each epoch), which can be saved and applied again later on
+without recomputing it (see ``save_reject_log`` and ``drop_rejected``).
+"""
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from mne.utils import logger
+
+
+def peak_to_peak(data):
+    """Peak-to-peak amplitudes of each epoch and channel.
+
+    Parameters
+    ----------
+    data : np.ndarray, shape (n_epochs, n_channels, n_times)
+        The epochs.
+
+    Returns
+    -------
+    ptp : np.ndarray, shape (n_epochs, n_channels)
+        The peak-to-peak amplitudes.
+    """
+    return data.max(axis=-1) - data.min(axis=-1)
+
+
+def candidate_thresholds(ptp, n_thresholds=30, z_range=(2., 12.)):
+    """Candidate thresholds of each channel (relative to its amplitudes).
+
+    The k-th candidate of each channel is ``z`` robust standard deviations
+    (scaled median absolute deviation) above the median amplitude of the
+    channel, with the same ``z`` for all channels.
+
+    Parameters
+    ----------
+    ptp : np.ndarray, shape (n_epochs, n_channels)
+        The peak-to-peak amplitudes.
+    n_thresholds : int
+        Number of candidates per channel.
+    z_range : tuple of float
+        Smallest and largest ``z``.
+
+    Returns
+    -------
+    candidates : np.ndarray, shape (n_channels, n_thresholds)
+        The candidate thresholds.
+    """
+    median = np.median(ptp, axis=0)
+    scale = 1.4826 * np.median(np.abs(ptp - median), axis=0)
+    z_scores = np.linspace(*z_range, n_thresholds)
+    return median[:, np.newaxis] + scale[:, np.newaxis] * z_scores
+
+
+def find_thresholds(data, ptp=None, n_thresholds=30, z_range=(2., 12.),
+                    n_folds=5, n_jobs=1, seed=0):
+    """Choose the rejection threshold of each channel by cross-validation.
+
+    The candidates of all channels lie at the same distance from their
+    typical amplitudes (see ``candidate_thresholds``), and an epoch is
+    rejected if any channel exceeds its threshold. For each candidate and
+    fold, the average of the accepted training epochs is compared with the
+    median of the held-out epochs (root mean square difference over
+    channels and time points). The averages of all candidates and folds
+    are computed in one matrix product, split into blocks of channels and
+    time points (one per thread).
+
+    Parameters
+    ----------
+    data : np.ndarray, shape (n_epochs, n_channels, n_times)
+        The epochs.
+    ptp : np.ndarray, shape (n_epochs, n_channels) | None
+        The peak-to-peak amplitudes (computed if None).
+    n_thresholds, z_range
+        See ``candidate_thresholds``.
+    n_folds : int
+        Number of cross-validation folds.
+    n_jobs : int
+        Number of threads.
+    seed : int | None
+        Seed of the random split of the epochs into folds.
+
+    Returns
+    -------
+    thresholds : np.ndarray, shape (n_channels,)
+        The threshold of each channel.
+    candidates : np.ndarray, shape (n_channels, n_thresholds)
+        The candidate thresholds.
+    errors : np.ndarray, shape (n_thresholds,)
+        The cross-validation error of each candidate.
+    """
+    if ptp is None:
+        ptp = peak_to_peak(data)
+    if len(data) < n_folds:
+        raise ValueError('Need at least %s epochs to choose thresholds, '
+                         'got %s.' % (n_folds, len(data)))
+    n_epochs, n_jobs = len(data), max(n_jobs, 1)
+    candidates = candidate_thresholds(ptp, n_thresholds, z_range)
+    rng = np.random.default_rng(seed)
+    folds = np.array_split(rng.permutation(n_epochs), n_folds)
+
+    # epochs accepted by each candidate and used for training in each fold,
+    # shape (n_folds, n_thresholds, n_epochs)
+    good = (ptp[np.newaxis] <= candidates.T[:, np.newaxis]).all(axis=-1)
+    train = np.ones((n_folds, n_epochs), dtype=bool)
+    for n_fold, test in enumerate(folds):
+        train[n_fold, test] = False
+    accepted = train[:, np.newaxis] & good[np.newaxis]
+    counts = accepted.sum(axis=-1)
+    weights = (accepted / np.maximum(counts, 1)[..., np.newaxis]).reshape(
+        n_folds * n_thresholds, n_epochs).astype(data.dtype)
+
+    flat = data.reshape(n_epochs, -1)
+
+    def squared_errors(columns):
+        """Summed squared errors over some channels and time points."""
+        medians = np.stack([np.median(flat[test, columns], axis=0)
+                            for test in folds])
+        averages = (weights @ flat[:, columns]).reshape(
+            n_folds, n_thresholds, -1)
+        return np.sum((averages - medians[:, np.newaxis]) ** 2, axis=-1)
+
+    bounds = np.linspace(0, flat.shape[1], n_jobs + 1).astype(int)
+    blocks = [slice(start, stop) for start, stop in zip(bounds[:-1],
+                                                       bounds[1:])]
+    if n_jobs == 1:
+        errors = squared_errors(blocks[0])
+    else:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            errors = sum(pool.map(squared_errors, blocks))
+
+    # (candidates rejecting all training epochs are never chosen)
+    errors = np.where(counts > 0, np.sqrt(errors / flat.shape[1]), np.inf)
+    errors = errors.mean(axis=0)
+    return candidates[:, np.argmin(errors)], candidates, errors
+
+
+def compute_reject_log(data, ch_names, reject='auto', n_thresholds=30,
+                       z_range=(2., 12.), n_folds=5, n_jobs=1, seed=0):
+    """Find the epochs with too large peak-to-peak amplitudes.
+
+    Parameters
+    ----------
+    data : np.ndarray, shape (n_epochs, n_channels, n_times)
+        The epochs.
+    ch_names : list of str
+        The channels.
+    reject : 'auto' | float | np.ndarray
+        The threshold(s): ``'auto'`` (one per channel, see
+        ``find_thresholds``), one for all channels, or one per channel.
+    n_thresholds, z_range, n_folds, n_jobs, seed
+        See ``find_thresholds`` (only used if ``reject='auto'``).
+
+    Returns
+    -------
+    log : dict of np.ndarray
+        ``ch_names``, ``thresholds`` (per channel), ``ptp`` (per epoch and
+        channel), ``bad`` (channels of each epoch exceeding their
+        threshold), ``drop`` (epochs with at least one bad channel) and,
+        if ``reject='auto'``, the ``candidates`` and their cross-validation
+        ``errors``.
+    """
+    ptp = peak_to_peak(data)
+    log = dict(ch_names=np.array(ch_names), ptp=ptp)
+    if isinstance(reject, str) and reject == 'auto':
+        log['thresholds'], log['candidates'], log['errors'] = \
+            find_thresholds(data, ptp, n_thresholds=n_thresholds,
+                            z_range=z_range, n_folds=n_folds,
+                            n_jobs=n_jobs, seed=seed)
+    else:
+        log['thresholds'] = np.broadcast_to(
+            np.asarray(reject, dtype=float), (len(ch_names),)).copy()
+
+    log['bad'] = ptp > log['thresholds']
+    log['drop'] = log['bad'].any(axis=1)
+    logger.info('Rejected %s of %s epochs (thresholds %.0f-%.0f µV)'
+                % (log['drop'].sum(), len(data),
+                   log['thresholds'].min() * 1e6,
+                   log['thresholds'].max() * 1e6))
+    return log
+
+
+def drop_rejected(epochs, log):
+    """Drop the epochs marked in a rejection log.
+
+    As with ``epochs.drop_bad``, the drop log of each rejected epoch lists
+    the channels that exceeded their threshold.
+
+    Parameters
+    ----------
+    epochs : mne.Epochs
+        The (preloaded) epochs the log was computed from.
+    log : dict
+        The rejection log (see ``compute_reject_log``).
+
+    Returns
+    -------
+    epochs : mne.Epochs
+        The epochs (modified in place).
+    """
+    if len(log['drop']) != len(epochs):
+        raise ValueError('The rejection log has %s epochs, got %s.'
+                         % (len(log['drop']), len(epochs)))
+
+    drop_log = list(epochs.drop_log)
+    for idx, bad in zip(epochs.selection[log['drop']],
+                        log['bad'][log['drop']]):
+        drop_log[idx] = tuple(log['ch_names'][bad].tolist())
+    epochs.drop(log['drop'], reason=None)
+    epochs.drop_log = tuple(drop_log)
+    return epochs
+
+
+def save_reject_log(fname, log, key=None):
+    """Save a rejection log to a .npz file (replaced atomically)."""
+    fname = Path(fname)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    fname_tmp = fname.with_name(fname.stem + '.tmp.npz')
+    np.savez(fname_tmp, key=str(key), **log)
+    os.replace(fname_tmp, fname)
+
+
+def read_reject_log(fname):
+    """Read a rejection log saved with ``save_reject_log`` (and its key)."""
+    with np.load(fname) as file:
+        log = {name: file[name] for name in file.files}
+    return log, str(log.pop('key'))
@@ -0,0 +1,90 @@
+"""
+==============================
+Re-label fitted ICA components
+==============================
+
+Match the components of all previously fitted ICAs (see
+``02_run_preprocessing.py``) with the EOG templates in one batch, e.g.,
+after changing ``ica_templates.json`` or the thresholds in ``config.py``.
+Subjects whose excluded components change are listed at the end
+(re-run ``02_run_preprocessing.py`` for them, the fitted ICA is re-used).
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+# %%
+# imports
+import os
+import json
+
+from mne.preprocessing import read_ica
+from mne.utils import logger
+
+from config import (
+    FPATH_DATA_DERIVATIVES,
+    SUBJECT_IDS,
+    EOG_TEMPLATE_LABELS,
+    EOG_TEMPLATE_THRESHOLDS,
+    EOG_ALL_COMPONENTS_SUBJECTS,
+    ica_templates
+)
+
+from ica_utils import (
+    find_eog_components,
+    select_bad_components,
+    save_eog_components
+)
+
+# %%
+# load all fitted ICAs
+subjects, icas, fnames = [], [], []
+for subj in sorted(SUBJECT_IDS):
+    str_subj = str(subj).rjust(3, '0')
+    FPATH_ICA = os.path.join(
+        FPATH_DATA_DERIVATIVES,
+        'preprocessing',
+        'sub-%s' % str_subj,
+        'ica',
+        'sub-%s_task-%s_ica.fif' % (str_subj, 'vogel2004'))
+    if not os.path.exists(FPATH_ICA):
+        continue
+
+    subjects.append(int(subj))
+    icas.append(read_ica(FPATH_ICA, verbose=False))
+    fnames.append(FPATH_ICA.replace('_ica.fif', '_eog-components.json'))
+
+logger.info('Found fitted ICAs for %s subjects.' % len(subjects))
+
+# %%
+# match the components of all subjects with the templates
+for ica in icas:
+    ica.labels_ = dict()
+eog_components = find_eog_components(
+    icas,
+    ica_templates,
+    labels=EOG_TEMPLATE_LABELS,
+    thresholds=[EOG_TEMPLATE_THRESHOLDS.get(subj, dict())
+                for subj in subjects],
+    subjects=subjects)
+
+# %%
+# save the new labels and report changes
+changed = []
+for subj, ica, components, fname in zip(subjects, icas, eog_components,
+                                        fnames):
+    bad_components = select_bad_components(
+        ica.labels_, first_only=subj not in EOG_ALL_COMPONENTS_SUBJECTS)
+
+    previous = None
+    if os.path.exists(fname):
+        with open(fname) as file:
+            previous = json.load(file)['exclude']
+    if previous != bad_components:
+        changed.append(subj)
+        logger.info('Subject %s: %s -> %s' % (subj, previous, bad_components))
+
+    save_eog_components(fname, components, bad_components)
+
+logger.info('\nExcluded components changed for %s subjects: %s\n'
+            % (len(changed), changed))
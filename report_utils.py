@@ -0,0 +1,225 @@
+"""Subject reports assembled from the sections written by each stage.
+
+Each stage writes its own section of the report of a subject (a
+*fragment*) to ``derivatives/report/sub-XXX/fragments``: an ``.html`` file
+with the content (figures are embedded as PNG images) and a small ``.json``
+file with its title and caption. Writing a section neither reads nor
+rewrites the rest of the report. The HTML page of each subject and the
+index page of the dataset are rendered from the fragments once all stages
+are done (see ``render_reports``), and only if fragments were added,
+changed or removed.
+
+The pages are plain HTML and not :class:`mne.Report` files, so they lack
+the interactive table of contents and tag filters of MNE reports. The
+``Subj_XXX_preprocessing_report.hdf5`` and ``.html`` files written by
+earlier versions of the pipeline are no longer updated (they can still be
+opened with ``mne.open_report``).
+"""
+import os
+import io
+import json
+import time
+import base64
+
+from html import escape
+from pathlib import Path
+
+from config import FPATH_DATA_REPORT
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>
+body {{font-family: sans-serif; margin: 2em auto; max-width: 1200px;}}
+img {{max-width: 100%;}}
+table {{border-collapse: collapse;}}
+td, th {{border: 1px solid #ccc; padding: 0.3em 0.6em; text-align: left;}}
+.caption {{color: #555;}}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+{body}
+</body>
+</html>
+"""
+
+
+def report_dir(subj):
+    """Directory of the report of a subject."""
+    return FPATH_DATA_REPORT / ('sub-%03d' % subj)
+
+
+def report_fname(subj):
+    """Path to the (rendered) report of a subject."""
+    return report_dir(subj) / ('sub-%03d_report.html' % subj)
+
+
+def fragment_fname(subj, stage, session, ext='.html'):
+    """Path to the section of the report written by a stage."""
+    return report_dir(subj) / 'fragments' / (
+        'ses-%s_stage-%s%s' % (session, stage, ext))
+
+
+def _write_atomic(fname, text):
+    """Write a text file (replaced atomically)."""
+    fname = Path(fname)
+    fname.parent.mkdir(parents=True, exist_ok=True)
+    fname_tmp = fname.with_name(fname.name + '.tmp')
+    with open(fname_tmp, 'w', encoding='utf-8') as file:
+        file.write(text)
+    os.replace(fname_tmp, fname)
+
+
+def figure_html(fig, dpi=100):
+    """Embed one or more figures as PNG images (the figures are closed)."""
+    # (imported here, rendering the reports does not need matplotlib)
+    import matplotlib.pyplot as plt
+
+    figs = fig if isinstance(fig, (list, tuple)) else [fig]
+    images = []
+    for fig in figs:
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png', dpi=dpi, bbox_inches='tight')
+        plt.close(fig)
+        images.append('<img src="data:image/png;base64,%s">'
+                      % base64.b64encode(buffer.getvalue()).decode('ascii'))
+    return '\n'.join(images)
+
+
+def table_html(rows):
+    """A two-column table from (name, value) pairs."""
+    return '<table>\n%s\n</table>' % '\n'.join(
+        '<tr><th>%s</th><td>%s</td></tr>' % (escape(str(name)),
+                                             escape(str(value)))
+        for name, value in rows)
+
+
+def write_fragment(subj, stage, session, title, content, caption=None):
+    """Write (or replace) the section of the report of a stage.
+
+    Parameters
+    ----------
+    subj, session : int
+        Subject and session.
+    stage : str
+        The stage writing the section (e.g., ``'02'``).
+    title : str
+        Title of the section.
+    content : str
+        HTML content (see ``figure_html`` and ``table_html``).
+    caption : str | None
+        Short description (also shown on the index page).
+    """
+    body = '<h2 id="ses-%s_stage-%s">%s</h2>\n' % (session, stage,
+                                                    escape(title))
+    if caption:
+        body += '<p class="caption">%s</p>\n' % escape(caption)
+    _write_atomic(fragment_fname(subj, stage, session), body + content)
+    # the description is written last, it marks the fragment as complete
+    _write_atomic(fragment_fname(subj, stage, session, '.json'),
+                  json.dumps(dict(subject=subj, stage=stage,
+                                  session=session, title=title,
+                                  caption=caption, created=time.time()),
+                             indent=2))
+
+
+def read_fragments(subj):
+    """Descriptions of the sections of the report of a subject."""
+    fragments = []
+    for fname in sorted((report_dir(subj) / 'fragments').glob('*.json')):
+        with open(fname) as file:
+            fragments.append(json.load(file))
+    return sorted(fragments, key=lambda frag: (frag['session'],
+                                               frag['stage']))
+
+
+def render_report(subj, lazy=True):
+    """Render the report of a subject from its sections.
+
+    Parameters
+    ----------
+    subj : int
+        The subject.
+    lazy : bool
+        Whether to skip rendering if no section was added, changed or
+        removed since the report was rendered last.
+
+    Returns
+    -------
+    fname : pathlib.Path | None
+        Path to the report (None if there are no sections).
+    """
+    fname = report_fname(subj)
+    fragments = read_fragments(subj)
+    if not fragments:
+        return None
+    fnames = [fragment_fname(subj, frag['stage'], frag['session'])
+              for frag in fragments]
+    # the sections the report is rendered from (saved next to it)
+    rendered = [[f.name, f.stat().st_mtime_ns] for f in fnames]
+    fname_rendered = fname.with_suffix('.json')
+    if lazy and fname.exists() and fname_rendered.exists():
+        with open(fname_rendered) as file:
+            if json.load(file) == rendered:
+                return fname
+
+    toc = '<ul>\n%s\n</ul>' % '\n'.join(
+        '<li><a href="#ses-%s_stage-%s">Session %s: %s</a></li>'
+        % (frag['session'], frag['stage'], frag['session'],
+           escape(frag['title'])) for frag in fragments)
+    sections = []
+    for frag_fname in fnames:
+        with open(frag_fname, encoding='utf-8') as file:
+            sections.append(file.read())
+    _write_atomic(fname, PAGE.format(title='Subject %03d' % subj,
+                                     body='\n'.join([toc] + sections)))
+    _write_atomic(fname_rendered, json.dumps(rendered, indent=2))
+    return fname
+
+
+def render_index(subjects):
+    """Render the index page of all subject reports.
+
+    Only the descriptions of the sections are read (not the figures).
+
+    Parameters
+    ----------
+    subjects : list of int
+        The subjects (subjects without report sections are skipped).
+
+    Returns
+    -------
+    fname : pathlib.Path
+        Path to the index page.
+    """
+    rows = []
+    for subj in sorted(subjects):
+        fragments = read_fragments(subj)
+        if not fragments:
+            continue
+        link = '<a href="%s">sub-%03d</a>' % (
+            report_fname(subj).relative_to(FPATH_DATA_REPORT).as_posix(),
+            subj)
+        sections = '<br>\n'.join(
+            'Session %s, %s%s' % (frag['session'], escape(frag['title']),
+                                  ': %s' % escape(frag['caption'])
+                                  if frag['caption'] else '')
+            for frag in fragments)
+        rows.append('<tr><td>%s</td><td>%s</td></tr>' % (link, sections))
+
+    fname = FPATH_DATA_REPORT / 'index.html'
+    _write_atomic(fname, PAGE.format(
+        title='Subject reports',
+        body='<table>\n<tr><th>Subject</th><th>Sections</th></tr>\n'
+             '%s\n</table>' % '\n'.join(rows)))
+    return fname
+
+
+def render_reports(subjects, lazy=True):
+    """Render the reports of several subjects and the index page."""
+    for subj in subjects:
+        render_report(subj, lazy=lazy)
+    return render_index(subjects)
@@ -0,0 +1,131 @@
+"""
+=====================
+Batch pipeline runner
+=====================
+
+Run pipeline stages for many subjects in parallel. Each worker process
+imports MNE and ``config.py`` only once and then processes one subject
+after the other. Failures are isolated to the subject in question.
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+# %%
+# imports
+import os
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import click
+from mne.utils import logger
+
+from config import (
+    SUBJECT_IDS,
+    BAD_SUBJECTS_SES_01,
+    BAD_SUBJECTS_SES_02,
+    jobs as n_cpus
+)
+
+from utils import STAGES, run_stage
+from report_utils import render_reports
+
+
+def get_subjects(session):
+    """Get all valid subjects for a session (i.e., without bad subjects)."""
+    bad_subjects = {1: BAD_SUBJECTS_SES_01, 2: BAD_SUBJECTS_SES_02}
+    return sorted(int(subj) for subj in SUBJECT_IDS
+                  if subj not in bad_subjects.get(session, {}))
+
+
+def _init_worker():
+    """Make sure worker processes never open figure windows."""
+    import matplotlib
+    matplotlib.use('Agg')
+    # run the stages in this process (not in the worker, see worker.py)
+    os.environ['PIPELINE_WORKER'] = 'off'
+
+
+def log_summary(results):
+    """Print a table with the status and duration of each job."""
+    logger.info('\n%-6s %-8s %-8s %-8s %10s  %s'
+                % ('stage', 'subject', 'session', 'status', 'time (s)',
+                   'error'))
+    for res in sorted(results,
+                      key=lambda r: (r['stage'], r['subj'], r['session'])):
+        logger.info('%-6s %-8s %-8s %-8s %10.1f  %s'
+                    % (res['stage'], res['subj'], res['session'],
+                       res['status'], res['duration'], res['error'] or ''))
+
+    n_failed = sum(res['status'] == 'failed' for res in results)
+    logger.info('\n%s jobs done, %s failed, %.1f s total processing time.\n'
+                % (len(results), n_failed,
+                   sum(res['duration'] for res in results)))
+
+
+@click.command()
+@click.option("--stage", "stages", multiple=True,
+              type=click.Choice(list(STAGES)), default=list(STAGES),
+              help="Pipeline stage(s) to run (default: all)")
+@click.option("--subj", "subjects", multiple=True, type=int,
+              help="Subject number(s) (default: all valid subjects)")
+@click.option("--session", "sessions", multiple=True, type=int,
+              default=[1], help="Session number(s)")
+@click.option("--overwrite", default=False, type=bool, help="Overwrite?")
+@click.option("--report", default=False, type=bool,
+              help="Generate HTML-report?")
+@click.option("--jobs", default=1, type=int,
+              help="The number of jobs to run in parallel within a subject")
+@click.option("--max-workers", default=n_cpus, type=int,
+              help="The number of subjects to process in parallel")
+def run_batch(stages, subjects, sessions, overwrite, report, jobs,
+              max_workers):
+    """Run the given stages for all subjects using a process pool."""
+    # config.py reads the .json files relative to the repository
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    valid = set(int(subj) for subj in SUBJECT_IDS)
+    invalid = set(subjects) - valid
+    if invalid:
+        raise ValueError(f"'{sorted(invalid)}' are not valid subject IDs."
+                         f"\nUse: {SUBJECT_IDS}")
+
+    # (subject, session) pairs to process
+    jobs_todo = [(subj, session) for session in sessions
+                 for subj in (subjects or get_subjects(session))]
+
+    results = []
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=_init_worker) as pool:
+        for stage in sorted(stages):
+            logger.info('\nRunning stage %s for %s subjects/sessions '
+                        '(%s workers)...\n'
+                        % (stage, len(jobs_todo), max_workers))
+            futures = [
+                pool.submit(run_stage, stage,
+                            subj=subj, session=session,
+                            overwrite=overwrite, report=report, jobs=jobs)
+                for subj, session in jobs_todo
+            ]
+            stage_results = [future.result()
+                             for future in as_completed(futures)]
+            results.extend(stage_results)
+
+            # only run the next stage for subjects that did not fail
+            failed = {(res['subj'], res['session']) for res in stage_results
+                      if res['status'] == 'failed'}
+            jobs_todo = [job for job in jobs_todo if job not in failed]
+
+    log_summary(results)
+
+    # the reports are rendered once, from the sections written by the stages
+    if report:
+        fname = render_reports(sorted({subj for subj, _ in jobs_todo}))
+        logger.info('\nReports saved to %s\n' % fname.parent)
+
+    return results
+
+
+# %%
+if __name__ == '__main__':
+    run_batch.main(standalone_mode=False)
@@ -0,0 +1,321 @@
+"""
+===========================
+Incremental pipeline runner
+===========================
+
+Run pipeline stages 00-03 as a dependency graph of (stage, subject, session)
+nodes. A node is only re-run if it is stale, i.e., if the content of its
+inputs (data files, code, configuration parameters) changed since its last
+successful run or if its outputs are missing. Nodes whose dependencies are
+done are run in parallel.
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+# %%
+# imports
+import os
+import ast
+import json
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from pathlib import Path
+
+import click
+from mne.utils import logger
+
+from config import (
+    FPATH_DATA_RAW,
+    FPATH_DATA_BIDS,
+    FPATH_DATA_DERIVATIVES,
+    FNAME_SOURCEDATA_TEMPLATE,
+    FNAME_ICA_PRIOR,
+    SUBJECT_IDS,
+    CHECK_SUBJECTS_SES_01,
+    EOG_TEMPLATE_LABELS,
+    EOG_TEMPLATE_THRESHOLDS,
+    EOG_ALL_COMPONENTS_SUBJECTS,
+    eeg_markers,
+    sensors,
+    ica_templates,
+    jobs as n_cpus
+)
+
+from utils import STAGES, run_stage
+from cache import fingerprint, hash_file
+from epoch_store import epochs_fname
+from event_utils import events_fname
+from report_utils import fragment_fname, render_reports
+from run_batch import get_subjects, log_summary, _init_worker
+
+# state of the last successful run of each node
+FPATH_STATE = FPATH_DATA_DERIVATIVES / 'pipeline' / 'state.json'
+
+
+
+def local_imports(fname):
+    """Local modules imported by a script (directly or indirectly).
+
+    The imports are read from the code without running it, and only
+    modules of the repository are followed. Imports within functions are
+    not (e.g., the modules that ``worker.py`` loads in advance).
+
+    Parameters
+    ----------
+    fname : str
+        File name of the script (relative to the repository).
+
+    Returns
+    -------
+    modules : list of str
+        File names of the local modules (without ``fname`` itself).
+    """
+    parent = Path(__file__).parent.resolve()
+    found, queue = set(), [fname]
+    while queue:
+        with open(parent / queue.pop()) as file:
+            tree = ast.parse(file.read())
+        nodes = list(tree.body)
+        while nodes:
+            node = nodes.pop()
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef,
+                                 ast.Lambda)):
+                continue
+            nodes.extend(ast.iter_child_nodes(node))
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and not node.level:
+                names = [node.module]
+            else:
+                continue
+            for name in names:
+                module = name.split('.')[0] + '.py'
+                if module not in found and (parent / module).is_file():
+                    found.add(module)
+                    queue.append(module)
+
+    return sorted(found - {fname})
+
+
+def _files(path, pattern='*'):
+    """All files in a directory (empty if it does not exist)."""
+    path = Path(path)
+    return sorted(f for f in path.glob(pattern) if f.is_file())
+
+
+def _sourcedata_dir(subj, session):
+    """Directory of the restructured brainvision files."""
+    return Path(FNAME_SOURCEDATA_TEMPLATE.format(
+        subj=subj, session=session, ext='')).parent
+
+
+def _bids_dir(subj, session):
+    """Directory of the BIDS files of a subject and session."""
+    return FPATH_DATA_BIDS / ('sub-%03d' % subj) / ('ses-%s' % session) / \
+        'eeg'
+
+
+def _preprocessed_fname(subj):
+    """Path to the preprocessed data of a subject."""
+    return FPATH_DATA_DERIVATIVES / 'preprocessing' / ('sub-%03d' % subj) / \
+        'eeg' / ('sub-%03d_task-vogel2004_preprocessed-raw.fif' % subj)
+
+
+def stage_inputs(stage, subj, session):
+    """Data files read by a stage."""
+    if stage == '00':
+        # e.g., Exp23_0001.vhdr (session 1) or Exp23_0001_2.vhdr (session 2)
+        files = _files(FPATH_DATA_RAW, '*%04d*' % subj)
+        is_ses_2 = ['%04d_2' % subj in fname.name for fname in files]
+        return [fname for fname, ses_2 in zip(files, is_ses_2)
+                if ses_2 == (session == 2)]
+    elif stage == '01':
+        return _files(_sourcedata_dir(subj, session))
+    elif stage == '02':
+        # the ICA is fitted starting from the group prior (if there is one)
+        return _files(_bids_dir(subj, session)) + \
+            _files(FNAME_ICA_PRIOR.parent, FNAME_ICA_PRIOR.name)
+    elif stage == '03':
+        return [_preprocessed_fname(subj), events_fname(subj, session)]
+
+
+def stage_outputs(stage, subj, session, report):
+    """Files written by a stage."""
+    if stage == '00':
+        return _files(_sourcedata_dir(subj, session), '*.vhdr')
+    elif stage == '01':
+        return _files(_bids_dir(subj, session), '*.vhdr') + \
+            ([fragment_fname(subj, stage, session)] if report else [])
+    elif stage == '02':
+        return [_preprocessed_fname(subj), events_fname(subj, session)] + \
+            ([fragment_fname(subj, stage, session)] if report else [])
+    elif stage == '03':
+        # (imported here, erp_utils imports mne and scipy)
+        from erp_utils import erp_fname
+
+        return [erp_fname(subj, session), epochs_fname(subj, session),
+                epochs_fname(subj, session, 'reject-log', '.npz')] + \
+            ([fragment_fname(subj, stage, session)] if report else [])
+
+
+def stage_params(stage, subj):
+    """Configuration parameters used by a stage."""
+    params = dict()
+    if stage == '01':
+        params.update(sensors=sensors,
+                      check=CHECK_SUBJECTS_SES_01.get(subj))
+    elif stage == '02':
+        params.update(markers=eeg_markers,
+                      templates=ica_templates,
+                      labels=EOG_TEMPLATE_LABELS,
+                      thresholds=EOG_TEMPLATE_THRESHOLDS.get(subj),
+                      all_components=subj in EOG_ALL_COMPONENTS_SUBJECTS,
+                      check=CHECK_SUBJECTS_SES_01.get(subj))
+    return params
+
+
+def node_signature(stage, subj, session):
+    """Hash of the content of everything a node depends on."""
+    parent = Path(__file__).parent.resolve()
+    code = [(fname, hash_file(parent / fname))
+            for fname in [STAGES[stage]] + local_imports(STAGES[stage])]
+    inputs = [(fname.name, hash_file(fname))
+              for fname in stage_inputs(stage, subj, session)
+              if fname.exists()]
+
+    # (whether a report is written is not part of it, missing report
+    # sections are found by ``stage_outputs``)
+    return fingerprint(stage, subj, session, code, inputs,
+                       stage_params(stage, subj))
+
+
+def is_stale(node, state, report):
+    """Check if a node needs to be (re-)run."""
+    stage, subj, session = node
+    outputs = stage_outputs(stage, subj, session, report)
+    if not all(fname.exists() for fname in outputs):
+        return True
+    return state.get('%s/%s/%s' % node) != node_signature(*node)
+
+
+def _prepare(node, report):
+    """Remove outputs that would keep a stage from running again."""
+    stage, subj, session = node
+    # 00 skips subjects that are already in the sourcedata directory
+    if stage == '00':
+        for fname in stage_outputs(stage, subj, session, report):
+            os.remove(fname)
+
+
+@click.command()
+@click.option("--stage", "stages", multiple=True,
+              type=click.Choice(list(STAGES)), default=list(STAGES),
+              help="Pipeline stage(s) to bring up to date (default: all)")
+@click.option("--subj", "subjects", multiple=True, type=int,
+              help="Subject number(s) (default: all valid subjects)")
+@click.option("--session", "sessions", multiple=True, type=int,
+              default=[1], help="Session number(s)")
+@click.option("--report", default=False, type=bool,
+              help="Generate HTML-report?")
+@click.option("--jobs", default=1, type=int,
+              help="The number of jobs to run in parallel within a subject")
+@click.option("--max-workers", default=n_cpus, type=int,
+              help="The number of nodes to run in parallel")
+@click.option("--dry-run", default=False, type=bool,
+              help="Only show which nodes are stale?")
+def run_pipeline(stages, subjects, sessions, report, jobs, max_workers,
+                 dry_run):
+    """Re-run all stale (stage, subject, session) nodes."""
+    # config.py reads the .json files relative to the repository
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    valid = set(int(subj) for subj in SUBJECT_IDS)
+    invalid = set(subjects) - valid
+    if invalid:
+        raise ValueError(f"'{sorted(invalid)}' are not valid subject IDs."
+                         f"\nUse: {SUBJECT_IDS}")
+
+    state = dict()
+    if FPATH_STATE.exists():
+        with open(FPATH_STATE) as file:
+            state = json.load(file)
+
+    # each stage depends on the previous stage of the same subject and
+    # session, so each (subject, session) is a chain of nodes
+    stages = sorted(stages)
+    chains = [[(stage, subj, session) for stage in stages]
+              for session in sessions
+              for subj in (subjects or get_subjects(session))]
+
+    if dry_run:
+        for chain in chains:
+            for node in chain:
+                if is_stale(node, state, report):
+                    logger.info('stale: stage %s, subject %s, session %s'
+                                % node)
+                    # everything downstream might change as well
+                    break
+        return
+
+    results = []
+    running = dict()
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=_init_worker) as pool:
+
+        def submit_next(chain):
+            """Run the first stale node of a chain."""
+            while chain:
+                node = chain.pop(0)
+                if not is_stale(node, state, report):
+                    logger.info('up to date: stage %s, subject %s, '
+                                'session %s' % node)
+                    continue
+                _prepare(node, report)
+                stage, subj, session = node
+                future = pool.submit(run_stage, stage,
+                                     subj=subj, session=session,
+                                     overwrite=True, report=report, jobs=jobs)
+                running[future] = (node, chain)
+                return
+
+        for chain in chains:
+            submit_next(chain)
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node, chain = running.pop(future)
+                result = future.result()
+                results.append(result)
+                if result['status'] == 'failed':
+                    # don't run downstream nodes
+                    continue
+
+                # the signature is computed after the run, so the next run
+                # only notices changes that happened afterwards
+                state['%s/%s/%s' % node] = node_signature(*node)
+                FPATH_STATE.parent.mkdir(parents=True, exist_ok=True)
+                with open(FPATH_STATE, 'w') as file:
+                    json.dump(state, file, indent=2)
+
+                submit_next(chain)
+
+    if results:
+        log_summary(results)
+    else:
+        logger.info('\nEverything is up to date.\n')
+
+    # the reports are rendered once, from the sections written by the stages
+    if report:
+        fname = render_reports(sorted(
+            {subj for session in sessions
+             for subj in (subjects or get_subjects(session))}))
+        logger.info('\nReports saved to %s\n' % fname.parent)
+
+    return results
+
+
+# %%
+if __name__ == '__main__':
+    run_pipeline.main(standalone_mode=False)
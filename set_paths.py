@@ -1,10 +1,10 @@
 """General utility functions that are re-used in different scripts."""
+import sys
 from os import path
 from pathlib import Path
 
 import json
 import click
-from mne.utils import logger
 
 # get path to current file
 parent = Path(__file__).parent.resolve()
@@ -53,6 +53,12 @@ def set_paths(
 
 # write .json file containing basic set of paths needed for the study
 paths = set_paths.main(standalone_mode=False)
+# e.g., after --help, click returns an exit code instead of the paths
+if not isinstance(paths, dict):
+    sys.exit(paths)
+
+# (imported here, so that e.g. --help does not wait for MNE)
+from mne.utils import logger
 for key, val in paths.items():
     logger.info(f"    > Setting '{key}': to -> {val}")  # noqa
 if paths['overwrite']:
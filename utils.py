@@ -1,7 +1,23 @@
 """General utility functions that are re-used in different scripts."""
+import sys
+import os
+import time
+import runpy
+import shutil
+import traceback
+
+from contextlib import contextmanager
 
 import click
-from mne.utils import logger
+
+# -----------------------------------------------------------------------------
+# pipeline stages (in the order in which they should be run)
+STAGES = {
+    '00': '00_restructure_eeg_data_directory.py',
+    '01': '01_data_to_bids.py',
+    '02': '02_run_preprocessing.py',
+    '03': '03_subject_level_erps.py',
+}
 
 
 @click.command()
@@ -12,6 +28,15 @@ from mne.utils import logger
 @click.option("--interactive", default=False, type=bool, help="Interactive?")
 @click.option("--report", default=False, type=bool, help="Generate HTML-report?")
 @click.option("--jobs", default=1, type=int, help="The number of hobs to run in parallel")
+@click.option("--cache", default=True, type=bool,
+              help="Re-use cached intermediate results?")
+@click.option("--lazy", default=True, type=bool,
+              help="Only read the data segments needed from disk?")
+@click.option("--mode", default='copy',
+              type=click.Choice(['copy', 'hardlink', 'symlink', 'reflink']),
+              help="How to transfer data files")
+@click.option("--all-subjects", default=False, type=bool,
+              help="Process all subjects at once?")
 def get_inputs(
         subj,
         session,
@@ -19,7 +44,11 @@ def get_inputs(
         overwrite,
         interactive,
         report,
-        jobs
+        jobs,
+        cache,
+        lazy,
+        mode,
+        all_subjects
 ):
     """Parse inputs in case script is run from command line.
     See Also
@@ -34,7 +63,11 @@ def get_inputs(
         overwrite=overwrite,
         interactive=interactive,
         report=report,
-        jobs=jobs
+        jobs=jobs,
+        cache=cache,
+        lazy=lazy,
+        mode=mode,
+        all_subjects=all_subjects
     )
 
     return inputs
@@ -42,10 +75,15 @@ def get_inputs(
 
 def parse_overwrite(defaults):
     """Parse which variables to overwrite."""
-    logger.info("\nParsing command line options...\n")
-
     # invoke `get_inputs()` as command line application
     inputs = get_inputs.main(standalone_mode=False, default_map=defaults)
+    # e.g., after --help, click returns an exit code instead of the inputs
+    if not isinstance(inputs, dict):
+        sys.exit(inputs)
+
+    # (imported here, so that e.g. --help does not wait for MNE)
+    from mne.utils import logger
+    logger.info("\nParsing command line options...\n")
 
     # check if any defaults should be overwritten
     overwrote = 0
@@ -60,3 +98,187 @@ def parse_overwrite(defaults):
         logger.info("Nothing to overwrite, use defaults defined in script.\n")
 
     return defaults
+
+
+def run_stage(stage, argv=None, **options):
+    """Run a pipeline stage for one subject within the current interpreter.
+
+    The stage script is executed via ``runpy`` with ``sys.argv`` set to the
+    given command line options, so modules imported by a previous call
+    (e.g., MNE, ``config.py``) are re-used instead of imported again.
+
+    Parameters
+    ----------
+    stage : str
+        Key in ``STAGES`` (e.g., ``'02'``) or path to the stage script.
+    argv : list of str | None
+        Command line arguments of the script (e.g., ``['--subj=1']``). If
+        None, the arguments are created from ``options``.
+    **options
+        Command line options for the script (e.g., ``subj=1, session=1``).
+
+    Returns
+    -------
+    result : dict
+        The stage, the options, the ``status`` ('ok' or 'failed'),
+        the ``duration`` in seconds and an ``error`` message (if any).
+    """
+    fname = STAGES.get(stage, stage)
+    fname = os.path.join(os.path.dirname(os.path.abspath(__file__)), fname)
+
+    if argv is None:
+        argv = ['--%s=%s' % (key, val) for key, val in options.items()]
+    sys_argv = sys.argv
+    sys.argv = [fname] + list(argv)
+
+    status, error = 'ok', None
+    start = time.perf_counter()
+    try:
+        runpy.run_path(fname, run_name='__main__')
+    except SystemExit as exit_code:
+        # scripts exit early to skip bad or missing subjects
+        if exit_code.code not in (None, 0):
+            status, error = 'failed', 'exit code %s' % exit_code.code
+    except Exception as err:  # noqa
+        status, error = 'failed', '%s: %s' % (type(err).__name__, err)
+        from mne.utils import logger
+        logger.info(traceback.format_exc())
+    finally:
+        sys.argv = sys_argv
+        # don't let figures pile up between subjects
+        if 'matplotlib.pyplot' in sys.modules:
+            sys.modules['matplotlib.pyplot'].close('all')
+
+    return dict(stage=stage,
+                status=status,
+                duration=time.perf_counter() - start,
+                error=error,
+                **options)
+
+
+def transfer_file(src, dst, mode='copy'):
+    """Transfer a file to a new location.
+
+    Parameters
+    ----------
+    src, dst : str | pathlib.Path
+        Source and destination of the file.
+    mode : 'copy' | 'hardlink' | 'symlink' | 'reflink'
+        How to transfer the file. Hard links and reflinks (copy-on-write
+        clones) don't use extra disk space. If the file system does not
+        support the requested mode, the file is copied.
+
+    Returns
+    -------
+    mode : str
+        The mode that was actually used.
+    """
+    if mode not in ('copy', 'hardlink', 'symlink', 'reflink'):
+        raise ValueError("mode must be 'copy', 'hardlink', 'symlink' or "
+                         "'reflink', got %s" % mode)
+
+    if os.path.lexists(dst):
+        os.remove(dst)
+
+    try:
+        if mode == 'hardlink':
+            os.link(src, dst)
+        elif mode == 'symlink':
+            os.symlink(os.path.abspath(src), dst)
+        elif mode == 'reflink':
+            _reflink(src, dst)
+    except (OSError, NotImplementedError) as err:
+        from mne.utils import logger
+        logger.info('Could not %s %s (%s), copying instead.'
+                    % (mode, src, err))
+        if os.path.lexists(dst):
+            os.remove(dst)
+        mode = 'copy'
+
+    if mode == 'copy':
+        shutil.copy(src, dst)
+
+    return mode
+
+
+def _reflink(src, dst):
+    """Clone a file (copy-on-write), e.g., on btrfs or xfs (Linux only)."""
+    try:
+        import fcntl
+    except ImportError:
+        raise NotImplementedError('reflinks are not supported on this system')
+
+    # FICLONE request code, see ioctl_ficlone(2)
+    ficlone = 0x40049409
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        fcntl.ioctl(dst_file.fileno(), ficlone, src_file.fileno())
+
+
+def transfer_brainvision(fname_src, fname_dst, mode='copy'):
+    """Transfer a BrainVision recording (.vhdr, .eeg and .vmrk files).
+
+    The binary .eeg file is transferred as is (see ``transfer_file``). If
+    the files are renamed, the references to the .eeg and .vmrk files in
+    the (small, text based) header files are updated in new copies of the
+    headers, so the binary data is never rewritten.
+
+    Parameters
+    ----------
+    fname_src, fname_dst : str
+        Path to the source and destination .vhdr file.
+    mode : 'copy' | 'hardlink' | 'symlink' | 'reflink'
+        How to transfer the binary data.
+
+    Returns
+    -------
+    modes : dict
+        The mode used for each file.
+    """
+    from mne.utils import logger
+
+    src_base = os.path.splitext(fname_src)[0]
+    dst_base = os.path.splitext(fname_dst)[0]
+
+    renamed = os.path.basename(src_base) != os.path.basename(dst_base)
+    renames = {
+        os.path.basename(src_base) + ext: os.path.basename(dst_base) + ext
+        for ext in ['.eeg', '.vmrk']
+    }
+
+    # the .vhdr file is written last (it marks a complete transfer)
+    modes = dict()
+    for ext in ['.eeg', '.vmrk', '.vhdr']:
+        src, dst = src_base + ext, dst_base + ext
+        if ext != '.eeg' and renamed:
+            with open(src, encoding='latin-1') as file:
+                header = file.read()
+            for old, new in renames.items():
+                header = header.replace('=' + old, '=' + new)
+            with open(dst, 'w', encoding='latin-1') as file:
+                file.write(header)
+            modes[ext] = 'rewrite'
+        else:
+            modes[ext] = transfer_file(src, dst, mode=mode)
+        logger.info('%s -> %s (%s)' % (src, dst, modes[ext]))
+
+    return modes
+
+
+@contextmanager
+def file_lock(fname):
+    """Lock a file, so only one process at a time executes a block of code.
+
+    On systems without ``fcntl`` (i.e., Windows), nothing is locked.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+
+    with open(fname, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
@@ -0,0 +1,318 @@
+"""
+==========================
+Persistent pipeline worker
+==========================
+
+A long-lived Python process that keeps MNE, ``config.py`` (montage,
+markers, templates) and the filter kernels of previous runs in memory and
+runs the stage scripts submitted to it, one after the other. Jobs are sent
+over a Unix socket, and the output of each job is streamed back to the
+caller.
+
+While the worker is running, the stage scripts submit themselves to it
+(see ``submit_to_worker``), so e.g. ``python 03_subject_level_erps.py
+--subj=1`` does not import MNE again. Set the environment variable
+``PIPELINE_WORKER=off`` to run a script in its own process anyway. If a
+module of the repository (e.g., ``config.py``) or one of its .json files
+was edited, the modules are imported again before the next job. Jobs
+submitted from another working directory or with other settings of the
+libraries in the environment (e.g., ``MNE_*`` or ``OMP_NUM_THREADS``, see
+``ENV_PREFIXES``) are refused by the worker and run in their own process.
+
+    # start the worker (e.g., in another terminal)
+    python worker.py
+    # stop it
+    python worker.py --stop=True
+
+Authors: José C. García Alanis <alanis.jcg@gmail.com>
+
+License: BSD (3-clause)
+"""
+# %%
+# imports
+# (only light modules, this file is imported by all stage scripts)
+import os
+import sys
+import json
+import socket
+import hashlib
+import tempfile
+
+from contextlib import redirect_stdout, redirect_stderr
+
+import click
+
+# one worker per copy of the repository
+FNAME_SOCKET = os.path.join(
+    tempfile.gettempdir(),
+    'eegml-worker-%s.sock' % hashlib.sha1(os.path.dirname(
+        os.path.abspath(__file__)).encode()).hexdigest()[:12])
+
+# marks the line with the result of a job (the rest is output of the job)
+RESULT_PREFIX = '\x00result '
+
+# environment variables that change how the stages run (most of them are
+# only read when the libraries are imported)
+ENV_PREFIXES = ('MNE_', 'OMP_', 'MKL_', 'OPENBLAS_', 'NUMEXPR_', 'VECLIB_',
+                'MPL', 'PYTHON')
+
+# working directory and environment of the worker (see ``serve``)
+_WORKER = dict()
+
+# modification times of the modules (and .json files) of the repository
+# when they were imported by the worker
+_MTIMES = dict()
+
+
+def _connect():
+    """Connect to the worker (returns None if it is not running)."""
+    if not os.path.exists(FNAME_SOCKET):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(FNAME_SOCKET)
+    except OSError:
+        # e.g., a worker that did not shut down properly
+        conn.close()
+        return None
+    return conn
+
+
+def submit(request, out=None):
+    """Send a request to the worker and stream its output.
+
+    Parameters
+    ----------
+    request : dict
+        The stage script, its command line arguments, the working directory
+        and environment of the caller (``script``, ``argv``, ``cwd``,
+        ``env``) or a command (e.g., ``dict(command='stop')``).
+    out : file-like | None
+        Where to write the output of the job. If None, ``sys.stdout``.
+
+    Returns
+    -------
+    result : dict | None
+        The result of the job (see ``utils.run_stage``), None if the worker
+        is not running.
+    """
+    conn = _connect()
+    if conn is None:
+        return None
+    out = sys.stdout if out is None else out
+
+    result = None
+    with conn, conn.makefile('w', encoding='utf-8') as writer, \
+            conn.makefile('r', encoding='utf-8') as reader:
+        writer.write(json.dumps(request) + '\n')
+        writer.flush()
+        for line in reader:
+            if line.startswith(RESULT_PREFIX):
+                result = json.loads(line[len(RESULT_PREFIX):])
+                break
+            out.write(line)
+            out.flush()
+
+    if result is None:
+        raise RuntimeError('The worker stopped before the job was done.')
+    return result
+
+
+def submit_to_worker(fname):
+    """Run a stage script in the worker instead, if one is running.
+
+    Called at the top of the stage scripts. If the worker is running, the
+    script with its command line arguments is run by the worker and the
+    process exits with the status of the job. Otherwise (or within the
+    worker itself, in an interactive session, or if the worker refused the
+    job) nothing happens.
+
+    Parameters
+    ----------
+    fname : str
+        Path to the stage script (i.e., ``__file__``).
+    """
+    if os.environ.get('PIPELINE_WORKER') == 'off' or hasattr(sys, 'ps1'):
+        return
+
+    result = submit(dict(script=os.path.abspath(fname),
+                         argv=sys.argv[1:],
+                         cwd=os.getcwd(),
+                         env=_job_env(os.environ)))
+    if result is None:
+        return
+    if result['status'] == 'refused':
+        sys.stdout.write('Not run by the worker: %s\n' % result['error'])
+        return
+    sys.exit(0 if result['status'] == 'ok' else 1)
+
+
+def _job_env(environ):
+    """The variables of an environment that matter for a job."""
+    return {name: value for name, value in environ.items()
+            if name.startswith(ENV_PREFIXES)}
+
+
+def _refuse(request):
+    """Why the worker can't run a job like the caller would (or None)."""
+    if request.get('cwd') != _WORKER['cwd']:
+        return 'working directory %s, not %s' % (request.get('cwd'),
+                                                 _WORKER['cwd'])
+    env = request.get('env')
+    if env is None:
+        return 'no environment sent'
+    differ = sorted(name for name in set(env) | set(_WORKER['env'])
+                    if env.get(name) != _WORKER['env'].get(name))
+    if differ:
+        return 'environment differs from the worker (%s)' % ', '.join(differ)
+    return None
+
+
+def _warm_up():
+    """Import the modules and load the values used by all stages."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot  # noqa: F401
+    import mne  # noqa: F401
+    import mne.preprocessing  # noqa: F401
+    import mne_bids  # noqa: F401
+
+    import config
+    for name in ('eeg_markers', 'sensors', 'montage', 'ica_templates'):
+        getattr(config, name)
+
+    # modules of the stages (e.g., filter kernels are kept in filter_utils)
+    import utils  # noqa: F401
+    import cache  # noqa: F401
+    import event_utils  # noqa: F401
+    import filter_utils  # noqa: F401
+    import ica_utils  # noqa: F401
+    import erp_utils  # noqa: F401
+
+    _MTIMES.clear()
+    _MTIMES.update(_repo_mtimes())
+
+
+def _repo_modules():
+    """Names of the imported modules that are part of the repository."""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    return [name for name, module in list(sys.modules.items())
+            if name != '__main__' and getattr(module, '__file__', None)
+            and os.path.dirname(os.path.abspath(module.__file__)) == repo]
+
+
+def _repo_mtimes():
+    """Modification times of the imported modules and the .json files."""
+    repo = os.path.dirname(os.path.abspath(__file__))
+    fnames = [sys.modules[name].__file__ for name in _repo_modules()]
+    # (e.g., the markers and templates read by config.py)
+    fnames += [os.path.join(repo, fname) for fname in os.listdir(repo)
+               if fname.endswith('.json')]
+    return {os.path.abspath(fname): os.stat(fname).st_mtime_ns
+            for fname in fnames if os.path.exists(fname)}
+
+
+def _reload_changed():
+    """Import the modules of the repository again if any was edited.
+
+    The modules import names from each other (e.g., ``from config import
+    ...``), so if any of them (or a .json file read by ``config.py``) was
+    edited since the warm-up, all of them are removed from ``sys.modules``
+    and imported again. Returns the names of the edited files.
+    """
+    mtimes = _repo_mtimes()
+    changed = sorted(os.path.basename(fname) for fname, mtime
+                     in mtimes.items() if _MTIMES.get(fname) != mtime)
+    if changed:
+        for name in _repo_modules():
+            del sys.modules[name]
+        _warm_up()
+    return changed
+
+
+def _handle(conn):
+    """Run the job sent over a connection (returns False to stop)."""
+    with conn, conn.makefile('r', encoding='utf-8') as reader, \
+            conn.makefile('w', encoding='utf-8', buffering=1) as writer:
+        request = json.loads(reader.readline())
+        if request.get('command') == 'stop':
+            writer.write(RESULT_PREFIX + json.dumps(
+                dict(status='ok', stopped=True)) + '\n')
+            return False
+
+        # the job would not run as in the caller's process
+        refused = _refuse(request)
+        if refused is not None:
+            writer.write(RESULT_PREFIX + json.dumps(
+                dict(status='refused', error=refused)) + '\n')
+            sys.stdout.write('%s: refused (%s)\n'
+                             % (os.path.basename(request['script']), refused))
+            return True
+
+        # output of the job (including the MNE logger) goes to the caller
+        with redirect_stdout(writer), redirect_stderr(writer):
+            changed = _reload_changed()
+            if changed:
+                sys.stdout.write('Worker: re-imported the modules (%s '
+                                 'changed).\n' % ', '.join(changed))
+            from utils import run_stage
+            result = run_stage(request['script'], argv=request['argv'])
+        writer.write(RESULT_PREFIX + json.dumps(result) + '\n')
+        sys.stdout.write('%s %s: %s (%.1f s)\n'
+                         % (os.path.basename(request['script']),
+                            ' '.join(request['argv']), result['status'],
+                            result['duration']))
+    return True
+
+
+def serve():
+    """Run jobs until the worker is stopped."""
+    if _connect() is not None:
+        raise RuntimeError('A worker is already running (%s).'
+                           % FNAME_SOCKET)
+
+    # the scripts run by the worker must not submit themselves again
+    os.environ['PIPELINE_WORKER'] = 'off'
+    # config.py reads the .json files relative to the repository
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    _WORKER.update(cwd=os.getcwd(), env=_job_env(os.environ))
+    _warm_up()
+
+    if os.path.exists(FNAME_SOCKET):
+        os.remove(FNAME_SOCKET)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        server.bind(FNAME_SOCKET)
+        server.listen()
+        sys.stdout.write('Worker ready (%s).\n' % FNAME_SOCKET)
+        sys.stdout.flush()
+        running = True
+        while running:
+            conn, _ = server.accept()
+            try:
+                running = _handle(conn)
+            except (OSError, ValueError) as err:
+                # e.g., the caller went away during the job
+                sys.stdout.write('Job aborted: %s\n' % err)
+            sys.stdout.flush()
+    finally:
+        server.close()
+        if os.path.exists(FNAME_SOCKET):
+            os.remove(FNAME_SOCKET)
+
+
+@click.command()
+@click.option("--stop", default=False, type=bool,
+              help="Stop the running worker?")
+def run_worker(stop):
+    """Start (or stop) the pipeline worker."""
+    if stop:
+        if submit(dict(command='stop')) is None:
+            sys.stdout.write('No worker running.\n')
+        return
+    serve()
+
+
+# %%
+if __name__ == '__main__':
+    run_worker.main(standalone_mode=False)